@@ -0,0 +1,108 @@
+"""Measure how long the asyncio event loop stalls while dabble runs.
+
+A ticker coroutine asks to be woken every millisecond and records how
+late it actually wakes up, while many concurrent "requests" each look up
+an alternative and record an action. Three storages are compared:
+
+  blocking   FSResultStorage called directly from the coroutines, as
+             dabble behaved before it had an asyncio interface
+  threaded   FSResultStorage behind ThreadedResultStorage
+  native     AsyncFSResultStorage
+
+Usage: python bench/aio_stall.py [requests] [existing assignments]
+"""
+
+import asyncio
+import shutil
+import sys
+import tempfile
+import time
+
+from dabble.aio import AsyncFSResultStorage, ThreadedResultStorage
+from dabble.backends.fs import FSResultStorage, encode_line
+
+
+class Blocking(object):
+    # the synchronous storage, awaited in name only
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def get_alternative(self, identity, test_name):
+        return self.storage.get_alternative(identity, test_name)
+
+    async def set_alternative(self, identity, test_name, alternative):
+        return self.storage.set_alternative(identity, test_name, alternative)
+
+    async def record(self, identity, test_name, alternative, action):
+        return self.storage.record(identity, test_name, alternative, action)
+
+
+def populate(directory, existing):
+    with open(FSResultStorage(directory).alts_path, 'w') as fp:
+        for n in range(existing):
+            fp.write(encode_line({'i': 'existing-%d' % n, 't': 'bench', 'n': n % 2}))
+
+async def request(storage, n):
+    identity = b'user-%d' % n
+    alternative = await storage.get_alternative(identity, 'bench')
+    if alternative is None:
+        alternative = n % 2
+        await storage.set_alternative(identity, 'bench', alternative)
+    await storage.record(identity, 'bench', alternative, 'show')
+
+async def ticker(lags, done):
+    loop = asyncio.get_event_loop()
+    while not done.is_set():
+        start = loop.time()
+        await asyncio.sleep(0.001)
+        lags.append(loop.time() - start - 0.001)
+
+async def run(storage, requests, concurrency=50):
+    lags = []
+    done = asyncio.Event()
+    tick = asyncio.ensure_future(ticker(lags, done))
+
+    start = time.time()
+    for batch in range(0, requests, concurrency):
+        await asyncio.gather(*[request(storage, n) for n in
+                               range(batch, min(batch + concurrency, requests))])
+    elapsed = time.time() - start
+
+    done.set()
+    await tick
+    return elapsed, sorted(lags)
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    existing = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    print('%d requests, %d existing assignments' % (requests, existing))
+    print('%-10s %10s %12s %12s %12s' % ('storage', 'total (s)', 'p50 lag (ms)', 'p99 lag (ms)', 'max lag (ms)'))
+    for name in ('blocking', 'threaded', 'native'):
+        directory = tempfile.mkdtemp()
+        try:
+            populate(directory, existing)
+            if name == 'blocking':
+                storage = Blocking(FSResultStorage(directory))
+            elif name == 'threaded':
+                storage = ThreadedResultStorage(FSResultStorage(directory))
+            else:
+                storage = AsyncFSResultStorage(directory)
+
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            elapsed, lags = loop.run_until_complete(run(storage, requests))
+            loop.close()
+        finally:
+            shutil.rmtree(directory)
+
+        if not lags:
+            lags = [elapsed]
+        print('%-10s %10.2f %12.2f %12.2f %12.2f' % (
+            name, elapsed,
+            lags[len(lags) // 2] * 1000,
+            lags[int(len(lags) * 0.99)] * 1000,
+            lags[-1] * 1000))
+
+if __name__ == '__main__':
+    main()
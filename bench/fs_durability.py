@@ -0,0 +1,68 @@
+"""Measure FSResultStorage's write throughput under each durability mode.
+
+Several threads record actions as fast as they can, to a storage which
+is either shared (every write locked) or segmented (see the README), with
+each of the durability modes:
+
+  none    the operating system writes the data back when it chooses
+  fsync   every write is synced before it returns
+  group   writes wait for a sync shared by every write of the interval
+
+Run it on the filesystem the storage would use; syncs on a tmpfs or a
+disk with a volatile write cache cost far less than on stable storage.
+
+Usage: python bench/fs_durability.py [threads] [seconds] [sync interval] [directory]
+"""
+
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from dabble.backends.fs import FSResultStorage
+
+
+def run(storage, threads, seconds):
+    counts = [0] * threads
+    deadline = time.time() + seconds
+
+    def write(worker):
+        n = 0
+        while time.time() < deadline:
+            storage.record(b'user-%d-%d' % (worker, n), 'bench', n % 2, 'show')
+            n += 1
+        counts[worker] = n
+
+    workers = [threading.Thread(target=write, args=(worker, )) for worker in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / (time.time() - start)
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3
+    interval = float(sys.argv[3]) if len(sys.argv) > 3 else 0.002
+    parent = sys.argv[4] if len(sys.argv) > 4 else None
+
+    print('%d threads, %.1fs each, group sync interval %.3fs' % (threads, seconds, interval))
+    print('%-10s %-8s %14s' % ('storage', 'mode', 'writes/s'))
+    for segmented in (False, True):
+        for durability in ('none', 'fsync', 'group'):
+            directory = tempfile.mkdtemp(dir=parent)
+            try:
+                storage = FSResultStorage(directory, segmented=segmented, durability=durability,
+                                          sync_interval=interval)
+                storage.save_test('bench', ['a', 'b'], ['show'])
+                rate = run(storage, threads, seconds)
+                storage.writer.close()
+            finally:
+                shutil.rmtree(directory)
+
+            print('%-10s %-8s %14.0f' % (segmented and 'segmented' or 'shared', durability, rate))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Measure what filtering lines before parsing them saves FSResultStorage.
+
+A storage is populated with several tests' assignments and results, then
+lookups are timed twice: once parsing every line of the files read (as
+dabble did before), and once rejecting lines which cannot match by
+searching the raw data for the encoded values being looked for.
+
+  get (hit)   get_alternative() of an assigned identity
+  get (miss)  get_alternative() of an unassigned identity
+  save_test   save_test() of an existing test
+  report      report() on one of the tests
+
+Usage: python bench/fs_scan.py [identities] [tests] [repeat]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+from binascii import hexlify
+
+from dabble.backends import fs
+from dabble.backends.fs import FSResultStorage, encode_line
+
+
+def populate(storage, identities, tests):
+    steps = ['show', 'click', 'buy']
+    now = fs.epoch(fs.utcnow())
+    with open(storage.tests_path, 'w') as fp:
+        for t in range(tests):
+            fp.write(encode_line({'t': 'test-%d' % t, 'a': ['a', 'b'], 's': steps}))
+    with open(storage.alts_path, 'w') as alts:
+        with open(storage.partition(fs.utcnow()), 'w') as results:
+            for n in range(identities):
+                identity = hexlify(('user-%d' % n).encode('ascii')).decode('ascii')
+                for t in range(tests):
+                    test_name = 'test-%d' % t
+                    alts.write(encode_line({'i': identity, 't': test_name, 'n': n % 2, 'd': now}))
+                    for step in steps[:n % 4]:
+                        results.write(encode_line({'i': identity, 't': test_name, 'n': n % 2,
+                                                   's': step, 'd': now}))
+
+def timed(operation, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        operation()
+    return (time.time() - start) / repeat
+
+def main():
+    identities = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    tests = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    directory = tempfile.mkdtemp()
+    try:
+        storage = FSResultStorage(directory)
+        populate(storage, identities, tests)
+
+        last = 'test-%d' % (tests - 1)
+        operations = [
+            ('get (hit)', lambda: storage.get_alternative(b'user-%d' % (identities - 1), last)),
+            ('get (miss)', lambda: storage.get_alternative(b'nobody', last)),
+            ('save_test', lambda: storage.save_test(last, ['a', 'b'], ['show', 'click', 'buy'])),
+            ('report', lambda: storage.report(last)),
+        ]
+
+        print('%d identities, %d tests' % (identities, tests))
+        print('%-12s %14s %14s %8s' % ('operation', 'parse all (ms)', 'pushdown (ms)', 'speedup'))
+        encoded_values = fs.encoded_values
+        for name, operation in operations:
+            fs.encoded_values = lambda pattern: []
+            try:
+                before = timed(operation, repeat)
+            finally:
+                fs.encoded_values = encoded_values
+            after = timed(operation, repeat)
+            print('%-12s %14.2f %14.2f %7.1fx' % (name, before * 1000, after * 1000, before / after))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Measure dabble's request and report paths on the running interpreter.
+
+Run it under each interpreter to compare (CPython 2 and 3, PyPy):
+
+  request   one page view: hash the user's identity, look up (or set)
+            their alternative and record a step, through ABTest with
+            FSResultStorage; a third of the users go on to convert
+  report    report() on the test, once every request has been recorded
+
+Usage: python bench/interpreters.py [requests] [repeat]
+"""
+
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from dabble import ABTest, IdentityProvider, configure
+from dabble.backends.fs import FSResultStorage
+
+
+class Provider(IdentityProvider):
+    identity = None
+
+    def get_identity(self):
+        return self.identity
+
+def timed(operation, repeat):
+    # the best of `repeat` runs, so that a JIT has warmed up
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        operation()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    directory = tempfile.mkdtemp()
+    try:
+        provider = Provider()
+        storage = FSResultStorage(directory)
+        configure(provider, storage)
+        test = ABTest('bench', ['a', 'b'], ['show', 'buy'])
+
+        runs = []
+        def serve():
+            # new users on every run, so each assigns an alternative
+            run = len(runs)
+            runs.append(run)
+            for n in range(requests):
+                provider.identity = 'user-%d-%d' % (run, n)
+                test.alternative
+                test.record('show')
+                if n % 3 == 0:
+                    test.record('buy')
+
+        request = timed(serve, repeat) / requests
+        report = timed(lambda: storage.report('bench'), repeat)
+
+        print('%s %s' % (platform.python_implementation(), platform.python_version()))
+        print('%-10s %14.1f us' % ('request', request * 1e6))
+        print('%-10s %14.1f ms  (%d users)' % ('report', report * 1e3, requests * repeat))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -23,13 +23,17 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-__all__ = ('configure', 'IdentityProvider', 'ResultStorage', 'ABTest', 'ABParameter')
+__all__ = ('configure', 'IdentityProvider', 'ResultStorage', 'ABTest', 'ABParameter',
+           'Lazy', 'Factory', 'StorageUnavailable')
 
 __version__ = '0.2.3'
 
-from datetime import datetime
-from hashlib import sha1
+from importlib import import_module
 import random
+import threading
+
+from dabble.hashers import IdentityHasher, SHA1Hasher
+from dabble.util import bucket, fraction, utcnow
 
 class IdentityProvider(object):
     """:class:`IdentityProvider` is used to identify a user over
@@ -46,6 +50,13 @@ class IdentityProvider(object):
         """
         raise Exception('Not implemented. Use a sub-class of IdentityProvider')
 
+class StorageUnavailable(Exception):
+    """Raised by a :class:`ResultStorage` when it cannot answer a
+    call in time (see :class:`dabble.guard.GuardedResultStorage`).
+    :class:`AB` falls back to a deterministic alternative when it
+    sees this exception rather than failing the page.
+    """
+
 class ResultStorage(object):
     """:class:`ResultStorage` provides an interface for storing
     and retrieving A/B test results to a persistent medium, often
@@ -58,13 +69,13 @@ class ResultStorage(object):
     possible.
     """
 
-    def save_test(self, test_name, alternatives, steps):
+    def save_test(self, test_name, alternatives, steps, sampling=None):
         """Save an ABTest.
 
         Unlike the :meth:`record` method, this method should not save
         a new record when called with the same `test_name`. Instead,
         it should check if such a test already exists, and that it has
-        the same set of alternatives, and raise if not.
+        the same set of alternatives and sampling rates, and raise if not.
 
         :Parameters:
           - `test_name`: the string name of the test, as set in
@@ -73,34 +84,70 @@ class ResultStorage(object):
             used by the :class:`ABTest`
           - `steps`: an ordered list of the steps the user will proceed
             through during the test (used for funnel analysis)
+          - `sampling`: `None`, or a list giving, for each step, the
+            fraction of identities whose actions are recorded (see
+            :class:`ABTest`); reports on sampled tests must be scaled
+            up accordingly (see :func:`dabble.util.funnel_report`)
         """
         raise Exception('Not implemented. Use a sub-class of ResultStorage')
 
-    def record(self, identity, test_name, alternative, action):
+    def load_tests(self):
+        """Return a dictionary describing every saved test, keyed by
+        test name. Each value is a dictionary with keys `alternatives`,
+        `steps` and `sampling`, as passed to :meth:`save_test`.
+
+        This is called once, by :func:`configure`, so that creating
+        an :class:`ABTest` need not touch storage unless the test is
+        new; it should read all tests at once. Storages which do not
+        override it return an empty dictionary, in which case
+        :meth:`save_test` is called for every :class:`ABTest`.
+        """
+        return {}
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
         """Save a user's action to the persistent medium.
 
         :Parameters:
-          - `identity`: the hashed identity of the user, as returned
-            by :meth:`IdentityProvider.get_identity`
+          - `identity`: the hashed identity of the user, a byte string
+            returned by the configured :class:`~dabble.hashers.IdentityHasher`
           - `test_name`: the string name of the test, as set in
             :meth:`AB.__init__`
           - `alternative`: the postitive integer index of the alternative
             displayed to the user
           - `action`: the string name of the action the user took
+          - `timestamp`: the time (a naive UTC :class:`~datetime.datetime`)
+            the action was taken; if `None`, the current time
         """
         raise Exception('Not implemented. Use a sub-class of ResultStorage')
 
+    def record_many(self, records):
+        """Save several actions at once. Sub-classes may override
+        this to write the batch more efficiently than one
+        :meth:`record` call per action.
+
+        :Parameters:
+          - `records`: an iterable of ``(identity, test_name,
+            alternative, action, timestamp)`` tuples, with the
+            arguments to :meth:`record`
+        """
+        for record in records:
+            self.record(*record)
+
     def has_action(self, identity, test_name, alternative, action):
         """Return `True` if the user with the given identity, has the given
         action recorded for the given test name and alternative, else `False`.
 
+        This is called while rendering pages (see :attr:`ABTest.completed`),
+        so it should cost no more than a single indexed lookup.
+
         :Parameters:
-          - `identity`: the hashed identity of the user, as returned
-            by :meth:`IdentityProvider.get_identity`
+          - `identity`: the hashed identity of the user, a byte string
+            returned by the configured :class:`~dabble.hashers.IdentityHasher`
           - `test_name`: the string name of the test, as set in
             :meth:`AB.__init__`
           - `alternative`: the postitive integer index of the alternative
-            displayed to the user
+            displayed to the user, or `None` to match the action under
+            any alternative
           - `action`: the name of an action
         """
         raise Exception('Not implemented. Use a sub-class of ResultStorage')
@@ -109,8 +156,8 @@ class ResultStorage(object):
         """Record the given alternative for the user.
 
         :Parameters:
-          - `identity`: the hashed identity of the user, as returned
-            by :meth:`IdentityProvider.get_identity`
+          - `identity`: the hashed identity of the user, a byte string
+            returned by the configured :class:`~dabble.hashers.IdentityHasher`
           - `test_name`: the string name of the test, as set in
             :meth:`AB.__init__`
           - `alternative`: the postitive integer index of the alternative
@@ -118,52 +165,103 @@ class ResultStorage(object):
         """
         raise Exception('Not implemented. Use a sub-class of ResultStorage')
 
+    def set_alternatives(self, assignments):
+        """Record alternatives for several users at once. Sub-classes
+        may override this to write the batch more efficiently than
+        one :meth:`set_alternative` call per user, and need not check
+        for users already assigned a different alternative.
+
+        :Parameters:
+          - `assignments`: an iterable of ``(identity, test_name,
+            alternative)`` tuples, with the arguments to
+            :meth:`set_alternative`
+        """
+        for assignment in assignments:
+            self.set_alternative(*assignment)
+
     def get_alternative(self, identity, test_name):
         """Return the alternative for the user, as previously set with
         :meth:`set_alternative`. Return `None` if no previous call for
         the given identity and test name has happened.
 
         :Parameters:
-          - `identity`: the hashed identity of the user, as returned
-            by :meth:`IdentityProvider.get_identity`
+          - `identity`: the hashed identity of the user, a byte string
+            returned by the configured :class:`~dabble.hashers.IdentityHasher`
           - `test_name`: the string name of the test, as set in
             :meth:`AB.__init__`
         """
         raise Exception('Not implemented. Use a sub-class of ResultStorage')
 
-    def report(self, test_name, a, b):
-        """Return report data for the alternatives of a given test
-        where users have either action `a` only, or actions `a` and
-        `b`. Other actions, and duplicate or repeated actions are
-        ignored.
+    def get_alternatives(self, identities, test_name):
+        """Return the alternatives of several users at once, as
+        :meth:`get_alternative` would, as a dictionary by identity of
+        those which have one. Sub-classes may override this to look
+        up the batch more efficiently than one :meth:`get_alternative`
+        call per user.
 
-        Action `a` is ordinarily a "start" action, for instance an
-        action denoting "user was shown a page with an A/B test on it".
-        Action `b` is ordinarily a "target" action, for instance an
-        action denoting "user filled out the form being tested".
+        :Parameters:
+          - `identities`: an iterable of hashed identities
+          - `test_name`: the string name of the test, as set in
+            :meth:`AB.__init__`
+        """
+        found = {}
+        for identity in identities:
+            alternative = self.get_alternative(identity, test_name)
+            if alternative is not None:
+                found[identity] = alternative
+        return found
+
+    def report(self, test_name, since=None, until=None, quantiles=None):
+        """Return report data for the alternatives of a given test,
+        describing how many users progressed through each of the
+        test's steps, in order. Other actions, and duplicate or
+        repeated actions are ignored.
 
         The output is a dictionary in the following format:
 
             {   test_name: "...",
-                alternatives: ["...", "...", ...],
                 results: [
-                    {   attempted: N,
-                        converted: M,
+                    {   alternative: "...",
+                        funnel: [
+                            {   stage: ("step 1", "step 2"),
+                                attempted: N,
+                                converted: M,
+                            }, ...
+                        ]
                     }, ...
                 ]
             }
 
         The dictionaries in the `results` array should be in the same
-        order as the alternatives listed in the alternatives array,
-        which need not be the same order as they are configured in
-        the :class:`ABTest`.
-
-        The values `N` and `M` within the result objects should count
-        unique identities who attempted or completed the action. An
-        attempt is defined as an identity with at least one recorded
-        `a` action; a completion is defined as an identity with at
-        least one recorded `a` action followed by (chronologically)
-        at least one recorded `b` action.
+        order as the alternatives are configured in the :class:`ABTest`,
+        and each `funnel` has one entry for each consecutive pair of
+        steps.
+
+        The values `N` and `M` within the funnel entries should count
+        unique identities who attempted or completed the stage. An
+        attempt is defined as an identity which has recorded each of
+        the steps up to and including the first step of the stage, in
+        order; a completion is defined as an attempt followed
+        (chronologically) by the second step of the stage.
+
+        Tests which sample their identities (see :class:`ABTest`) report
+        `N` and `M` scaled up to estimate the counts for all identities,
+        along with the counts actually observed and the variance of the
+        estimates. :func:`dabble.util.funnel_report` produces this format.
+
+        When `since` or `until` are given, an identity is only counted
+        at a step if it first took each of the steps up to and
+        including it within the window, from `since` (inclusive) until
+        `until` (exclusive); steps repeated within the window, but
+        first taken before it, are not counted. Storages should avoid
+        reading actions recorded after the window.
+
+        When `quantiles` are given, each funnel entry also has a
+        `time_to_convert`: a dictionary with the given `quantiles` of
+        the seconds each completion took after its attempt (`None`
+        where there were none), and the :class:`~dabble.sketch.TDigest`
+        they were estimated from, as its `digest`. Digests of reports
+        on separate storages can be merged.
 
         Implementation of the report is delegated to the storage
         class since dabble cannot know the most efficient way to
@@ -172,8 +270,59 @@ class ResultStorage(object):
         :Parameters:
           - `test_name`: the string name of the test, as set in
             :meth:`AB.__init__`
-          - `a`: a string identifying a start action
-          - `b`: a string identifying a completion action
+          - `since`: a naive UTC :class:`~datetime.datetime`, or `None`
+          - `until`: a naive UTC :class:`~datetime.datetime`, or `None`
+          - `quantiles`: a sequence of numbers between 0 and 1, like
+            ``(0.5, 0.9, 0.99)``, or `None`
+        """
+        raise Exception('Not implemented. Use a sub-class of ResultStorage')
+
+    def report_many(self, test_names, since=None, until=None, quantiles=None):
+        """Return a dictionary mapping each of `test_names` to its
+        :meth:`report`. Storages should override this to read the
+        stored results once for all of the tests, rather than once
+        for each.
+        """
+        return dict((test_name, self.report(test_name, since, until, quantiles))
+                    for test_name in test_names)
+
+    def report_all(self, since=None, until=None, quantiles=None):
+        """Return :meth:`report_many` for every test known."""
+        return self.report_many(set(self.list_tests()), since, until, quantiles)
+
+    def timeseries(self, test_name, start, end, resolution='minute'):
+        """Return the number of identities reaching each step of a
+        test, per alternative, in each minute, hour or day (as given
+        by `resolution`) from `start` (inclusive) until `end`
+        (exclusive). Identities are counted as by :meth:`report`, in
+        the period in which they took each step. Storages should keep
+        these counts up to date as actions are recorded, rather than
+        read every action on each call.
+
+        The output is a dictionary in the following format:
+
+            {   test_name: "...",
+                resolution: "minute",
+                times: [datetime, ...],
+                results: [
+                    {   alternative: "...",
+                        steps: {
+                            "step 1": [N, ...],
+                            ...
+                        }
+                    }, ...
+                ]
+            }
+
+        where `times` are the starts of the periods, and each step
+        has a count for each of them. Periods older than the storage
+        keeps at the given resolution have counts of 0.
+
+        :Parameters:
+          - `test_name`: the string name of the test
+          - `start`: a naive UTC :class:`~datetime.datetime`
+          - `end`: a naive UTC :class:`~datetime.datetime`
+          - `resolution`: "minute", "hour" or "day"
         """
         raise Exception('Not implemented. Use a sub-class of ResultStorage')
 
@@ -181,18 +330,191 @@ class ResultStorage(object):
         """Return a list of string test names known."""
         raise Exception('Not implemented. Use a sub-class of ResultStorage')
 
+    def export_alternatives(self, test_name, after=None):
+        """Iterate over the alternatives recorded for a test, as
+        ``(identity, alternative)`` tuples, in a stable order.
+
+        If `after` is given, it is a tuple yielded by an earlier
+        export, and the export resumes after it. Tuples yielded before
+        it may be yielded again, but none recorded before the earlier
+        export is left out.
+
+        :Parameters:
+          - `test_name`: the string name of the test
+          - `after`: a tuple to resume after, or `None`
+        """
+        raise Exception('Not implemented. Use a sub-class of ResultStorage')
+
+    def export_results(self, test_name, after=None):
+        """Iterate over the actions recorded for a test which count
+        towards its :meth:`report`, as ``(identity, alternative,
+        action, timestamp)`` tuples, in a stable order. Repeated
+        actions, and actions taken out of the order of the test's
+        steps, are left out; `timestamp` is `None` for actions
+        recorded before timestamps were kept. Recording exactly these
+        actions in another storage gives the same :meth:`report`.
+        `after` resumes an export, as for :meth:`export_alternatives`.
+
+        :Parameters:
+          - `test_name`: the string name of the test
+          - `after`: a tuple to resume after, or `None`
+        """
+        raise Exception('Not implemented. Use a sub-class of ResultStorage')
+
+class ProxyResultStorage(ResultStorage):
+    """:class:`ProxyResultStorage` forwards every call to another
+    :class:`ResultStorage`. It is a convenient base for storages
+    which wrap a backend to add behavior to only some of its methods.
+    Attributes not defined on the proxy are looked up on the wrapped
+    storage, so backend-specific methods remain reachable.
+    """
+
+    def __init__(self, storage):
+        if not isinstance(storage, ResultStorage):
+            raise Exception('storage must extend ResultStorage')
+        self.storage = storage
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def save_test(self, test_name, alternatives, steps, sampling=None):
+        return self.storage.save_test(test_name, alternatives, steps, sampling)
+
+    def load_tests(self):
+        return self.storage.load_tests()
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        return self.storage.record(identity, test_name, alternative, action, timestamp)
 
-def configure(identity_provider, result_storage):
+    def record_many(self, records):
+        return self.storage.record_many(records)
+
+    def has_action(self, identity, test_name, alternative, action):
+        return self.storage.has_action(identity, test_name, alternative, action)
+
+    def set_alternative(self, identity, test_name, alternative):
+        return self.storage.set_alternative(identity, test_name, alternative)
+
+    def set_alternatives(self, assignments):
+        return self.storage.set_alternatives(assignments)
+
+    def get_alternative(self, identity, test_name):
+        return self.storage.get_alternative(identity, test_name)
+
+    def get_alternatives(self, identities, test_name):
+        return self.storage.get_alternatives(identities, test_name)
+
+    def report(self, test_name, since=None, until=None, quantiles=None):
+        return self.storage.report(test_name, since, until, quantiles)
+
+    def report_many(self, test_names, since=None, until=None, quantiles=None):
+        return self.storage.report_many(test_names, since, until, quantiles)
+
+    def report_all(self, since=None, until=None, quantiles=None):
+        return self.storage.report_all(since, until, quantiles)
+
+    def timeseries(self, test_name, start, end, resolution='minute'):
+        return self.storage.timeseries(test_name, start, end, resolution)
+
+    def list_tests(self):
+        return self.storage.list_tests()
+
+    def export_alternatives(self, test_name, after=None):
+        return self.storage.export_alternatives(test_name, after)
+
+    def export_results(self, test_name, after=None):
+        return self.storage.export_results(test_name, after)
+
+
+def sampling_rates(steps, sample):
+    # normalize the `sample` argument of ABTest (None, a
+    # rate for every step, or a dict of rates by step name)
+    # to None or a list of rates, one for each step
+    if sample is None:
+        return None
+    if not isinstance(sample, dict):
+        sample = dict((step, sample) for step in steps)
+
+    rates = [float(sample.get(step, 1)) for step in steps]
+    for rate in rates:
+        if not 0 < rate <= 1:
+            raise Exception('sampling rates must be greater than 0 and at most 1')
+    if rates != sorted(rates):
+        raise Exception('sampling rates may not decrease from one step to the next')
+
+    if rates[0] == 1:
+        return None
+    return rates
+
+
+def configure(identity_provider, result_storage, hasher=None, dedup=None, tracer=None):
     if not isinstance(identity_provider, IdentityProvider):
         raise Exception('identity_provider must extend IdentityProvider')
     if not isinstance(result_storage, ResultStorage):
         raise Exception('result_storage must extend ResultStorage')
+    if hasher is not None and not isinstance(hasher, IdentityHasher):
+        raise Exception('hasher must extend IdentityHasher')
 
     if AB._id_provider is not None or AB._storage is not None:
         raise Exception('configure called multiple times')
 
+    if tracer is not None:
+        from dabble.trace import TracingResultStorage
+        result_storage = TracingResultStorage(result_storage, tracer)
+
     AB._id_provider = identity_provider
     AB._storage = result_storage
+    AB._hasher = hasher or SHA1Hasher()
+    AB._dedup = dedup
+    AB._tracer = tracer
+    AB._tests = result_storage.load_tests()
+
+class _Result(object):
+    # yielded by the storage call generators of AB and ABTest to
+    # give their result
+
+    def __init__(self, value):
+        self.value = value
+
+def _drive(calls, storage):
+    # run a generator like AB._alternative(), which yields the storage
+    # calls it needs as tuples of the method name and its arguments
+    # (or another such generator, whose result it needs) and is sent
+    # each result or thrown the exception raised, until it yields a
+    # _Result or ends; dabble.aio._drive() does the same with an
+    # AsyncResultStorage
+    result = error = None
+    while True:
+        try:
+            if error is None:
+                call = calls.send(result)
+            else:
+                call = calls.throw(error)
+        except StopIteration:
+            return None
+        if isinstance(call, _Result):
+            calls.close()
+            return call.value
+
+        result = error = None
+        try:
+            if isinstance(call, tuple):
+                result = getattr(storage, call[0])(*call[1:])
+            else:
+                result = _drive(call, storage)
+        except Exception as e:
+            error = e
+
+class _Untraced(object):
+    # stands in for a span when no tracer is configured
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+_untraced = _Untraced()
 
 class AB(object):
     """TODO.
@@ -201,6 +523,17 @@ class AB(object):
     # these are set by the configure() function
     _id_provider = None
     _storage = None
+    _hasher = SHA1Hasher()
+    _dedup = None
+    _tracer = None
+
+    # definitions of the tests known to storage, keyed by
+    # test name; also set by configure()
+    _tests = {}
+
+    # set by dabble.aio.configure(), or on first use
+    # of one of the awaitable methods
+    _astorage = None
 
     # track the number of alternatives for each
     # named test; helps prevent errors where some
@@ -216,19 +549,57 @@ class AB(object):
         self.test_name = test_name
         self.alternatives = alternatives
 
+    def _span(self, name):
+        # time an operation if a dabble.trace.Tracer is configured
+        if self._tracer is None:
+            return _untraced
+        return self._tracer.span(name, test=self.test_name)
+
     @property
     def identity(self):
-        return sha1(unicode(self._id_provider.get_identity())).hexdigest()
+        with self._span('hash'):
+            return self._hasher.hash(self._id_provider.get_identity())
 
     @property
     def alternative(self):
-        alternative = self._storage.get_alternative(self.identity, self.test_name)
-
-        if alternative is None:
-            alternative = random.randrange(len(self.alternatives))
-            self._storage.set_alternative(self.identity, self.test_name, alternative)
-
-        return alternative
+        return _drive(self._alternative(), self._storage)
+
+    def _alternative(self):
+        # a generator of storage calls (see _drive), shared with dabble.aio
+        with self._span('alternative'):
+            identity = self.identity
+            try:
+                alternative = yield ('get_alternative', identity, self.test_name)
+                if alternative is None and self._hasher.previous is not None:
+                    previous = self._hasher.previous.hash(self._id_provider.get_identity())
+                    alternative = yield ('get_alternative', previous, self.test_name)
+                    if alternative is not None:
+                        yield ('set_alternative', identity, self.test_name, alternative)
+            except StorageUnavailable:
+                # storage is slow or down; show a stable alternative,
+                # and save it for the writes made under it. storages
+                # refuse to replace an alternative already set (as does
+                # GuardedResultStorage.replay()), so a real assignment
+                # made earlier still wins once storage recovers
+                alternative = bucket(identity, len(self.alternatives))
+                try:
+                    yield ('set_alternative', identity, self.test_name, alternative)
+                except Exception:
+                    pass
+                yield _Result(alternative)
+
+            if alternative is None:
+                alternative = random.randrange(len(self.alternatives))
+                yield ('set_alternative', identity, self.test_name, alternative)
+
+            yield _Result(alternative)
+
+    def aalternative(self):
+        """Return an awaitable for :attr:`alternative`
+        (see :mod:`dabble.aio`).
+        """
+        from dabble import aio
+        return aio.alternative(self)
 
 class ABTest(AB):
     # can be added to a class definition to define information
@@ -242,21 +613,151 @@ class ABTest(AB):
     #       formname = ABParameter('my_test', ['form_one', 'form_two'])
     #
     #       def GET(self):
-    #           if abtest.completed:
+    #           if self.abtest.completed:
     #               raise web.seeother('/page/after/form/completion')
     #           render('template.html', form=self.get_form(self.formname))
+    #
+    # on very busy pages, the actions of only a sample of identities
+    # need be recorded; each step can be given the fraction of
+    # identities to record, and reports are scaled up to match:
+    #
+    #       abtest = ABTest('my_test', ['Complete Form', 'Brief Form'],
+    #                       ['Form Shown', 'Form Filled'],
+    #                       sample={'Form Shown': 0.1})
+    #
+    # identities are sampled by a hash of their identity and the test
+    # name, so each user is either always or never recorded at a step.
+    # rates may not decrease from one step to the next (a funnel is
+    # only counted when its first step is recorded); steps not named
+    # are always recorded, which keeps `completed` working for everyone.
 
-    def __init__(self, test_name, alternatives, steps):
+    def __init__(self, test_name, alternatives, steps, sample=None):
         super(ABTest, self).__init__(test_name, alternatives)
-        self._storage.save_test(test_name, alternatives, steps)
+        self.steps = steps
+        self.sampling = sampling_rates(steps, sample)
+
+        # only touch storage if the test is new or has changed
+        test = {'alternatives': alternatives, 'steps': steps, 'sampling': self.sampling}
+        if self._tests.get(test_name) != test:
+            self._storage.save_test(test_name, alternatives, steps, self.sampling)
+            self._tests[test_name] = test
+
+    def sampled(self, identity, action):
+        """Return `True` if `action` should be recorded for `identity`
+        (a hashed identity).
+        """
+        if self.sampling is None or action not in self.steps:
+            return True
+        rate = self.sampling[self.steps.index(action)]
+        return rate >= 1 or fraction(identity, self.test_name) < rate
+
+    def has_action(self, action):
+        """Return `True` if the current user has recorded `action`
+        in this test. If storage is unavailable, return `False`.
+        """
+        return _drive(self._has_action(action), self._storage)
+
+    def _has_action(self, action):
+        with self._span('has_action'):
+            try:
+                found = yield ('has_action', self.identity, self.test_name, None, action)
+            except StorageUnavailable:
+                found = False
+            yield _Result(found)
+
+    @property
+    def completed(self):
+        """`True` if the current user has reached the last step."""
+        return self.has_action(self.steps[-1])
+
+    def ahas_action(self, action):
+        """Return an awaitable for :meth:`has_action`
+        (see :mod:`dabble.aio`).
+        """
+        from dabble import aio
+        return aio.has_action(self, action)
 
     def record(self, action):
-        self._storage.record(
-            self.identity,
-            self.test_name,
-            self.alternative,
-            action,
-        )
+        _drive(self._record(action), self._storage)
+
+    def _record(self, action):
+        with self._span('record'):
+            identity = self.identity
+            if not self.sampled(identity, action):
+                return
+
+            # skip repeats of the first step already recorded (see
+            # dabble.dedup.Deduplicator for why only the first step)
+            dedup = self._dedup
+            key = None
+            if dedup is not None and action == self.steps[0]:
+                key = dedup.key(identity, self.test_name, action)
+                if key in dedup and (not dedup.verify or (yield self._has_action(action))):
+                    return
+
+            alternative = yield self._alternative()
+            yield ('record', identity, self.test_name, alternative, action, utcnow())
+            if key is not None:
+                dedup.add(key)
+
+    def arecord(self, action):
+        """Return an awaitable for :meth:`record`
+        (see :mod:`dabble.aio`).
+        """
+        from dabble import aio
+        return aio.record(self, action)
+
+class Lazy(object):
+
+    def __init__(self, target):
+        """An alternative of an :class:`ABParameter` which is built
+        the first time it is shown, rather than when the parameter is
+        defined, and then kept for later requests. Alternatives which
+        are never shown by a process are never built by it.
+
+        :Parameters:
+          - `target`: a callable taking no arguments, which returns the
+            alternative, or the import path of the alternative, as
+            "package.module:name" (or "package.module.name")
+        """
+        self.target = target
+        self.lock = threading.Lock()
+        self.resolved = False
+        self.value = None
+
+    def get(self):
+        if not self.resolved:
+            with self.lock:
+                if not self.resolved:
+                    self.value = self._load()
+                    self.resolved = True
+        return self.value
+
+    def _load(self):
+        if callable(self.target):
+            return self.target()
+
+        if ':' in self.target:
+            module, name = self.target.split(':', 1)
+        else:
+            module, name = self.target.rsplit('.', 1)
+        value = import_module(module)
+        for attr in name.split('.'):
+            value = getattr(value, attr)
+        return value
+
+class Factory(object):
+
+    def __init__(self, factory):
+        """An alternative of an :class:`ABParameter` which is built
+        anew each time it is shown, by calling `factory` (with no
+        arguments), for alternatives which must not be shared between
+        requests.
+        """
+        self.factory = factory
+
+    def get(self):
+        return self.factory()
 
 class ABParameter(AB):
     # a descriptor object which can be used to vary parameters
@@ -265,8 +766,28 @@ class ABParameter(AB):
     # each viewer who views the given class will always be
     # consistently shown the Nth choice from among the
     # alternatives, even between different attributes in the
-    # class, so long as the name is the same between them
+    # class, so long as the name is the same between them.
+    #
+    # alternatives wrapped in Lazy or Factory are only built
+    # when (and each time, for a Factory) they are shown
 
     def __get__(self, instance, owner):
-        return self.alternatives[self.alternative]
+        return self._value(self.alternative)
+
+    def _value(self, alternative):
+        value = self.alternatives[alternative]
+        if isinstance(value, (Lazy, Factory)):
+            return value.get()
+        return value
+
+    def aget(self):
+        """Return an awaitable for the value of this parameter for
+        the current user (see :mod:`dabble.aio`). Since attribute
+        access goes through :meth:`__get__`, fetch the parameter
+        itself from the class ``__dict__``:
+
+            value = await Page.__dict__['formname'].aget()
+        """
+        from dabble import aio
+        return aio.value(self)
 
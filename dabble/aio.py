@@ -0,0 +1,282 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('configure', 'AsyncResultStorage', 'ThreadedResultStorage',
+           'AsyncFSResultStorage')
+
+from dabble import AB, ResultStorage, _Result
+from dabble.backends.fs import AlternativeIndex, FSResultStorage, encode_line
+from dabble.compat import hexlify
+from dabble.util import epoch, utcnow
+
+from functools import partial
+from lockfile import AlreadyLocked, LockTimeout
+import asyncio
+
+
+class AsyncResultStorage(object):
+    """:class:`AsyncResultStorage` has the same methods, with the same
+    arguments and meaning, as :class:`~dabble.ResultStorage`, except
+    that each is a coroutine.
+    """
+
+    async def save_test(self, test_name, alternatives, steps, sampling=None):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def record(self, identity, test_name, alternative, action, timestamp=None):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def has_action(self, identity, test_name, alternative, action):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def set_alternative(self, identity, test_name, alternative):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def get_alternative(self, identity, test_name):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def report(self, test_name, since=None, until=None, quantiles=None):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def report_many(self, test_names, since=None, until=None, quantiles=None):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def report_all(self, since=None, until=None, quantiles=None):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+    async def list_tests(self):
+        raise Exception('Not implemented. Use a sub-class of AsyncResultStorage')
+
+
+class ThreadedResultStorage(AsyncResultStorage):
+
+    def __init__(self, storage, executor=None):
+        """Adapt a :class:`~dabble.ResultStorage` to the
+        :class:`AsyncResultStorage` interface by running each of its
+        methods in `executor` (by default, the event loop's default
+        executor).
+        """
+        if not isinstance(storage, ResultStorage):
+            raise Exception('storage must extend ResultStorage')
+
+        self.storage = storage
+        self.executor = executor
+
+    def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def save_test(self, test_name, alternatives, steps, sampling=None):
+        return await self._run(self.storage.save_test, test_name, alternatives, steps,
+                               sampling)
+
+    async def record(self, identity, test_name, alternative, action, timestamp=None):
+        return await self._run(self.storage.record, identity, test_name, alternative, action,
+                               timestamp)
+
+    async def has_action(self, identity, test_name, alternative, action):
+        return await self._run(self.storage.has_action, identity, test_name, alternative, action)
+
+    async def set_alternative(self, identity, test_name, alternative):
+        return await self._run(self.storage.set_alternative, identity, test_name, alternative)
+
+    async def get_alternative(self, identity, test_name):
+        return await self._run(self.storage.get_alternative, identity, test_name)
+
+    async def report(self, test_name, since=None, until=None, quantiles=None):
+        return await self._run(self.storage.report, test_name, since, until, quantiles)
+
+    async def report_many(self, test_names, since=None, until=None, quantiles=None):
+        return await self._run(self.storage.report_many, test_names, since, until,
+                               quantiles)
+
+    async def report_all(self, since=None, until=None, quantiles=None):
+        return await self._run(self.storage.report_all, since, until, quantiles)
+
+    async def list_tests(self):
+        return await self._run(self.storage.list_tests)
+
+
+class AsyncFSResultStorage(AsyncResultStorage):
+
+    def __init__(self, directory, executor=None, poll=0.005):
+        """Store A/B test results in the filesystem, in the same
+        format (and compatibly with) :class:`~dabble.backends.fs.FSResultStorage`,
+        without blocking the event loop.
+
+        Each write is a single small append, made in `executor` once
+        the lock file is taken; the lock is tried without waiting, and
+        the event loop waits between attempts rather than a thread.
+        Assignments are looked up in an in-memory index, which is built
+        in `executor` the first time it is needed and afterwards only
+        reads (also in `executor`) the lines other processes have
+        appended since. Actions are looked up in the storage's index of
+        first steps, and reports and test definitions, which scan whole
+        files, run in `executor`.
+
+        :Parameters:
+          - `directory`: an existing directory in the filesystem where
+            results can be stored
+          - `executor`: the :class:`concurrent.futures.Executor` used
+            for file access (by default, the event loop's default
+            executor)
+          - `poll`: seconds to wait between attempts to take the lock
+        """
+        self.storage = FSResultStorage(directory)
+        self.executor = executor
+        self.poll = poll
+
+        self.alt_index = AlternativeIndex(self.storage.alt_files)
+
+    def _run(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def _refresh(self, index):
+        # refreshes of the same index wait for each other in
+        # TailIndex.refresh(), not in the event loop
+        await self._run(index.refresh)
+
+    async def _append(self, filename, **line):
+        data = encode_line(line)
+        while not await self._run(self._try_append, filename, data):
+            await asyncio.sleep(self.poll)
+
+    def _try_append(self, filename, data):
+        # one attempt to take the locks and append data, made in
+        # the executor; returns False if either lock is held
+        if not self.storage.thread_lock.acquire(False):
+            return False
+        try:
+            try:
+                self.storage.lock.acquire(timeout=0.001)
+            except (AlreadyLocked, LockTimeout):
+                return False
+            try:
+                with open(filename, 'a') as fp:
+                    fp.write(data)
+            finally:
+                self.storage.lock.release()
+        finally:
+            self.storage.thread_lock.release()
+        return True
+
+    async def save_test(self, test_name, alternatives, steps, sampling=None):
+        return await self._run(self.storage.save_test, test_name, alternatives, steps,
+                               sampling)
+
+    async def record(self, identity, test_name, alternative, action, timestamp=None):
+        timestamp = timestamp or utcnow()
+        line = dict(i=hexlify(identity), t=test_name, n=alternative, s=action,
+                    d=epoch(timestamp))
+        await self._append(self.storage.partition(timestamp), **line)
+        await self._run(self.storage.first_steps.add, [line])
+
+    async def has_action(self, identity, test_name, alternative, action):
+        return await self._run(self.storage.first_steps.has, hexlify(identity), test_name,
+                               alternative, action)
+
+    async def set_alternative(self, identity, test_name, alternative):
+        existing = await self.get_alternative(identity, test_name)
+        if existing is not None and existing != alternative:
+            raise Exception(
+                'different alternative already set for identity %s' % hexlify(identity))
+
+        await self._append(self.storage.alts_path, i=hexlify(identity), t=test_name,
+                           n=alternative, d=epoch(utcnow()))
+
+    async def get_alternative(self, identity, test_name):
+        await self._refresh(self.alt_index)
+        return self.alt_index.alternatives.get((hexlify(identity), test_name))
+
+    async def report(self, test_name, since=None, until=None, quantiles=None):
+        return await self._run(self.storage.report, test_name, since, until, quantiles)
+
+    async def report_many(self, test_names, since=None, until=None, quantiles=None):
+        return await self._run(self.storage.report_many, test_names, since, until,
+                               quantiles)
+
+    async def report_all(self, since=None, until=None, quantiles=None):
+        return await self._run(self.storage.report_all, since, until, quantiles)
+
+    async def list_tests(self):
+        return await self._run(self.storage.list_tests)
+
+
+def configure(async_storage):
+    """Use `async_storage` for the awaitable methods of the A/B
+    classes (:meth:`~dabble.AB.aalternative`, :meth:`~dabble.ABTest.arecord`,
+    :meth:`~dabble.ABTest.ahas_action` and :meth:`~dabble.ABParameter.aget`).
+
+    If this is not called, those methods run the storage given to
+    :func:`dabble.configure` in the event loop's default executor.
+    """
+    if not isinstance(async_storage, AsyncResultStorage):
+        raise Exception('async_storage must extend AsyncResultStorage')
+
+    AB._astorage = async_storage
+
+def _storage():
+    if AB._astorage is None:
+        if AB._storage is None:
+            raise Exception('configure has not been called')
+        AB._astorage = ThreadedResultStorage(AB._storage)
+    return AB._astorage
+
+async def _drive(calls, storage):
+    # dabble._drive(), awaiting the calls on an AsyncResultStorage
+    result = error = None
+    while True:
+        try:
+            if error is None:
+                call = calls.send(result)
+            else:
+                call = calls.throw(error)
+        except StopIteration:
+            return None
+        if isinstance(call, _Result):
+            calls.close()
+            return call.value
+
+        result = error = None
+        try:
+            if isinstance(call, tuple):
+                result = await getattr(storage, call[0])(*call[1:])
+            else:
+                result = await _drive(call, storage)
+        except Exception as e:
+            error = e
+
+async def alternative(ab):
+    return await _drive(ab._alternative(), _storage())
+
+async def record(abtest, action):
+    await _drive(abtest._record(action), _storage())
+
+async def has_action(abtest, action):
+    return await _drive(abtest._has_action(action), _storage())
+
+async def value(parameter):
+    return parameter._value(await alternative(parameter))
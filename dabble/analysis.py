@@ -0,0 +1,186 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('analyze', 'analyze_many')
+
+from math import erfc, sqrt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from scipy import special
+except ImportError:
+    special = None
+
+
+def _erfc(x):
+    # the complementary error function of each element of x, with
+    # scipy's ufunc if it is installed, or else math.erfc
+    if special is not None:
+        return special.erfc(x)
+    return numpy.frompyfunc(erfc, 1, 1)(x).astype(float)
+
+def analyze(report, control=0, resamples=4000, confidence=0.95, prior=(1, 1), seed=None):
+    """Return :func:`analyze_many` of a single report."""
+    return analyze_many([report], control, resamples, confidence, prior, seed)[report['test_name']]
+
+def analyze_many(reports, control=0, resamples=4000, confidence=0.95, prior=(1, 1), seed=None):
+    """Compare the alternatives of tests at each stage of their
+    funnels, from the output of :meth:`~dabble.ResultStorage.report`.
+    Each stage of each alternative is compared with the same stage of
+    the `control` alternative:
+
+      - `rate`: the conversion rate, converted / attempted
+      - `interval`: a bootstrap confidence interval of the rate
+      - `difference`: the rate less the control's, and its bootstrap
+        confidence interval (`difference_interval`)
+      - `z` and `p_value`: a two-proportion (pooled) z-test of the
+        difference, two-sided
+      - `posterior`: the Beta distribution of the rate given a Beta
+        `prior` (as `alpha` and `beta`), with its `mean`, a credible
+        `interval`, and the probability that the rate is greater than
+        the control's (`p_better`)
+
+    Every stage of every alternative of every test is computed at once
+    with NumPy arrays; the bootstrap and posterior samples are drawn in
+    one batch of `resamples` each. The bootstrap resamples each stage's
+    attempts with replacement, which for conversions amounts to a
+    binomial draw. Comparisons with the control are `None`
+    for the control itself, and values which cannot be computed (for
+    lack of attempts) are `None`. Sampled tests are analyzed with the
+    counts actually observed.
+
+    Return a dictionary mapping test names to reports, in the format
+    of :meth:`~dabble.ResultStorage.report`, with the values above
+    added to each funnel entry.
+
+    :Parameters:
+      - `reports`: a sequence of reports, or a dictionary of them as
+        returned by :meth:`~dabble.ResultStorage.report_many`
+      - `control`: the index of the alternative compared against
+      - `resamples`: the number of bootstrap and posterior samples
+      - `confidence`: the coverage of the intervals
+      - `prior`: the parameters (alpha, beta) of the Beta prior
+      - `seed`: a seed for the random draws, for repeatable results
+    """
+    if numpy is None:
+        raise Exception('dabble.analysis requires numpy')
+
+    if isinstance(reports, dict):
+        reports = reports.values()
+    reports = list(reports)
+
+    # attempts and conversions as arrays indexed by
+    # (test, alternative, stage), padded with zeros
+    tests = len(reports)
+    alts = max(len(report['results']) for report in reports) if reports else 0
+    stages = max(len(result['funnel']) for report in reports
+                 for result in report['results']) if alts else 0
+    attempted = numpy.zeros((tests, alts, stages), dtype=numpy.int64)
+    converted = numpy.zeros((tests, alts, stages), dtype=numpy.int64)
+    for t, report in enumerate(reports):
+        if control >= len(report['results']):
+            raise Exception('test "%s" has no alternative %d' % (report['test_name'], control))
+        for a, result in enumerate(report['results']):
+            for s, stage in enumerate(result['funnel']):
+                counts = stage.get('sampled', stage)
+                attempted[t, a, s] = counts['attempted']
+                converted[t, a, s] = counts['converted']
+
+    rand = numpy.random.RandomState(seed)
+    tail = (1 - confidence) / 2.0 * 100
+    bounds = [tail, 100 - tail]
+
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        valid = attempted > 0
+        rate = numpy.where(valid, converted / attempted.astype(float), 0.0)
+
+        # two-proportion z-test against the control
+        pooled = (converted + converted[:, control:control + 1]) / \
+            (attempted + attempted[:, control:control + 1]).astype(float)
+        error = numpy.sqrt(pooled * (1 - pooled) *
+                           (1.0 / attempted + 1.0 / attempted[:, control:control + 1]))
+        difference = rate - rate[:, control:control + 1]
+        z = difference / error
+        p_value = _erfc(numpy.abs(z) / sqrt(2))
+
+        # bootstrap: resampling a stage's attempts draws
+        # binomially many conversions at the observed rate
+        boot = rand.binomial(attempted[..., None], rate[..., None],
+                             size=(tests, alts, stages, resamples)) / \
+            numpy.maximum(attempted, 1)[..., None].astype(float)
+        interval = numpy.percentile(boot, bounds, axis=-1)
+        difference_interval = numpy.percentile(boot - boot[:, control:control + 1], bounds,
+                                               axis=-1)
+
+    # beta posteriors, and how often a draw from each
+    # beats the corresponding draw for the control
+    alpha = prior[0] + converted
+    beta = prior[1] + attempted - converted
+    draws = rand.beta(alpha[..., None], beta[..., None], size=(tests, alts, stages, resamples))
+    credible = numpy.percentile(draws, bounds, axis=-1)
+    p_better = (draws > draws[:, control:control + 1]).mean(axis=-1)
+
+    def value(array, *index):
+        number = array[index]
+        return None if numpy.isnan(number) else float(number)
+
+    def pair(array, *index):
+        lower, upper = value(array[0], *index), value(array[1], *index)
+        return None if lower is None else (lower, upper)
+
+    analyses = {}
+    for t, report in enumerate(reports):
+        results = []
+        for a, result in enumerate(report['results']):
+            funnel = []
+            for s, stage in enumerate(result['funnel']):
+                entry = dict(stage)
+                if not valid[t, a, s]:
+                    entry.update(rate=None, interval=None)
+                else:
+                    entry.update(rate=value(rate, t, a, s), interval=pair(interval, t, a, s))
+                if a == control or not valid[t, a, s] or not valid[t, control, s]:
+                    entry.update(difference=None, difference_interval=None,
+                                 z=None, p_value=None)
+                else:
+                    entry.update(difference=value(difference, t, a, s),
+                                 difference_interval=pair(difference_interval, t, a, s),
+                                 z=value(z, t, a, s), p_value=value(p_value, t, a, s))
+                entry['posterior'] = {
+                    'alpha': int(alpha[t, a, s]),
+                    'beta': int(beta[t, a, s]),
+                    'mean': float(alpha[t, a, s]) / (alpha[t, a, s] + beta[t, a, s]),
+                    'interval': pair(credible, t, a, s),
+                    'p_better': None if a == control else float(p_better[t, a, s]),
+                }
+                funnel.append(entry)
+            results.append(dict(result, funnel=funnel))
+        analyses[report['test_name']] = dict(report, results=results)
+
+    return analyses
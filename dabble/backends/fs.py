@@ -26,13 +26,55 @@
 __all__ = ('FSResultStorage', )
 
 from dabble import ResultStorage
+from dabble.compat import Full, Queue, hexlify, quote, range, text_type, to_bytes, to_text
+from dabble.rollup import Rollup
+from dabble.sketch import TDigest
 from dabble.util import *
 
-from os.path import exists, join, abspath
-from os import SEEK_END
+from os.path import basename, dirname, exists, join, abspath
+from os import O_APPEND, O_CREAT, O_WRONLY, SEEK_END, close, fstat, fsync, getpid, \
+    listdir, mkdir, remove, rename, stat, write
+from os import open as os_open
+from binascii import unhexlify
+from collections import deque
+from datetime import datetime, timedelta
+from itertools import islice
 from lockfile import FileLock
+from socket import gethostname
+import bz2
+import gzip
+import heapq
 import json
+import sqlite3
+import threading
+import time
 
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+
+# compression name -> (file extension, open function)
+codecs = {
+    'gzip': ('gz', gzip.open),
+    'bz2': ('bz2', bz2.BZ2File),
+}
+if lzma is not None:
+    codecs['lzma'] = ('xz', lzma.open)
+if zstd is not None:
+    codecs['zstd'] = ('zst', zstd.open)
+
+
+# the size of the reads made by find_lines() and TailIndex
+scan_size = 1 << 20
 
 def find_lines(filename, **pattern):
     """Find a line (JSON-formatted) in the given file where
@@ -41,20 +83,85 @@ def find_lines(filename, **pattern):
     values in `pattern`. Additional keys in the line are
     ignored. If no matching line is found, or if the
     file does not exist, return None.
+
+    The file is read in large blocks, and only lines which
+    contain the JSON encoding of every value in `pattern`
+    (see :func:`candidates`) are parsed.
     """
     if exists(filename):
-        with file(filename, 'r') as fp:
-            for line in fp:
-                try:
-                    data = json.loads(line)
-                except:
-                    continue
-                matches = True
-                for key, value in pattern.iteritems():
-                    matches = matches and key in data and data[key] == value
-                if matches:
+        needles = encoded_values(pattern)
+        with open(filename, 'rb') as fp:
+            # a last line without a newline (perhaps
+            # still being written) is yielded if it parses
+            for block in read_blocks(fp):
+                for data in match_lines(candidates(block, needles), **pattern):
                     yield data
 
+def read_blocks(fp):
+    """Yield the contents of the file object `fp`, read
+    :data:`scan_size` bytes at a time, in blocks of whole lines; the
+    last block may not end with a newline.
+    """
+    rest = b''
+    while True:
+        block = fp.read(scan_size)
+        if not block:
+            break
+        block = rest + block
+        end = block.rfind(b'\n') + 1
+        rest = block[end:]
+        if end:
+            yield block[:end]
+    if rest:
+        yield rest
+
+def encoded_values(pattern):
+    """Return the JSON encodings of the values in `pattern`
+    which any line matching it must contain, most selective
+    (longest) first.
+    """
+    needles = [to_bytes(json.dumps(value)) for value in pattern.values()
+               if isinstance(value, (str, text_type, int)) and not isinstance(value, bool)]
+    return sorted(needles, key=len, reverse=True)
+
+def candidates(block, needles):
+    """Yield the lines of `block` (a byte string of whole lines) which
+    contain each of `needles`, without parsing them. Lines are found
+    by searching `block` for the first needle, so lines without it
+    cost next to nothing.
+    """
+    if not needles:
+        for line in block.splitlines():
+            yield line
+        return
+
+    first, others = needles[0], needles[1:]
+    pos = block.find(first)
+    while pos != -1:
+        start = block.rfind(b'\n', 0, pos) + 1
+        stop = block.find(b'\n', pos)
+        if stop == -1:
+            stop = len(block)
+        line = block[start:stop]
+        if all(needle in line for needle in others):
+            yield line
+        pos = block.find(first, stop)
+
+def match_lines(lines, **pattern):
+    """Like :func:`find_lines`, but search an iterable
+    of lines rather than a file.
+    """
+    for line in lines:
+        try:
+            data = json.loads(line)
+        except:
+            continue
+        matches = True
+        for key, value in pattern.items():
+            matches = matches and key in data and data[key] == value
+        if matches:
+            yield data
+
 def find_line(filename, **pattern):
     """Return the first line that would be found by
     :func:`find_lines`.
@@ -63,107 +170,1260 @@ def find_line(filename, **pattern):
         return line
     return None
 
-lock = None
+def encode_line(line):
+    """Serialize `line` (a dict) as a line of compact JSON."""
+    return json.dumps(line, separators=(',', ':')) + '\n'
+
+# the lockfile's link name is fixed when it is created, so
+# threads sharing it would all believe they hold it; threads
+# within a process therefore also take an ordinary lock. each
+# directory has one of each, shared by all of its storages in
+# the process, so that storages of different directories do
+# not wait for each other
+locks = {}
+locks_lock = threading.Lock()
+
+def directory_locks(directory):
+    """Return the lock for threads and the file lock of a
+    directory, as a pair, creating them on first use.
+    """
+    # a file lock's name includes the process id when it is
+    # created, so processes forked since must make their own
+    key = (getpid(), abspath(directory))
+    with locks_lock:
+        if key not in locks:
+            locks[key] = (threading.Lock(), FileLock(join(key[1], 'lock.dabble')))
+        return locks[key]
+
 def append_line(filename, **line):
     """Safely (i.e. with locking) append a line to
     the given file, serialized as JSON.
     """
-    global lock
+    append_lines(filename, [line])
+
+def append_lines(filename, lines, writer=None, locks=None, hook=None):
+    """Safely (i.e. with locking) append several lines
+    (dicts) to the given file, serialized as JSON, in a
+    single write. `locks` are the pair of locks to take (see
+    :func:`directory_locks`), by default those of the file's
+    directory. If a :class:`FileWriter` is given, it makes
+    the write, and waits for it to be as durable as the
+    writer requires once the locks are released. If `hook`
+    is given, it is called with the file name and the seconds
+    spent waiting for the locks (see :mod:`dabble.trace`).
+    """
+    thread_lock, lock = locks or directory_locks(dirname(filename))
+
+    data = ''.join(encode_line(line) for line in lines)
+    if not data:
+        return
+    start = hook and time.time()
+    ticket = None
+    with thread_lock, lock:
+        if hook:
+            hook(filename, time.time() - start)
+        if writer is not None:
+            ticket = writer.append(filename, data, shared=True)
+        else:
+            with open(filename, 'a') as fp:
+                fp.seek(0, SEEK_END)
+                fp.write(data)
+    if writer is not None:
+        writer.wait(ticket)
+
+def tally(tests, results, since=None, until=None, quantiles=None):
+    """Count the identities reaching each step of the funnels of
+    `tests` (a dictionary of test lines, as in tests.dabble, by test
+    name) in `results` (an iterable of result lines, in timestamp
+    order), as :meth:`FSResultStorage.report` does. Return a pair of
+    dictionaries by test name: the counts, as sparsearrays indexed by
+    alternative and step, and, if `quantiles` are given, the
+    :class:`~dabble.sketch.TDigest` of the seconds taken to complete
+    each stage, as sparsearrays indexed by alternative and stage.
+
+    An identity is counted at a step the first time it takes it, if
+    it first took each of the steps before it in order (steps recorded
+    at the same instant count as taken in the order of the test's
+    steps; see :func:`step_order`). With `since`,
+    each identity's results must be preceded by those from before the
+    window, or at least by the first time it took each step (see
+    :func:`with_history`), to tell first steps from repeats.
+    """
+    trials = dict((test_name, sparsearray(int)) for test_name in tests)
+    timings = dict((test_name, sparsearray(TDigest)) for test_name in tests)
+    maxstep = dict((test_name, {}) for test_name in tests)
+    # the steps each identity has taken, as a bit mask
+    taken = dict((test_name, {}) for test_name in tests)
+    # the time each identity reached its furthest step
+    reached = dict((test_name, {}) for test_name in tests)
+    # identities which took the first step before the window
+    before = dict((test_name, set()) for test_name in tests)
+
+    start = since and epoch(since)
+    end = until and epoch(until)
+
+    for result in step_order(tests, results):
+        test = tests.get(result.get('t'))
+        if test is None:
+            continue
+        if end and result['d'] >= end:
+            continue
+        name, identity = test['t'], result['i']
+        step = test['s'].index(result['s'])
+        mask = taken[name].get(identity, 0)
+        if mask & 1 << step:
+            # a repeat
+            continue
+        taken[name][identity] = mask | 1 << step
+        if step != maxstep[name].get(identity, -1) + 1:
+            continue
+        maxstep[name][identity] = step
+        if step == 0 and start and result['d'] < start:
+            before[name].add(identity)
+        if identity in before[name]:
+            continue
+
+        trials[name][result['n']][step] += 1
+        if quantiles is not None and 'd' in result:
+            # results.dabble has no timestamps to time
+            previous = reached[name].get(identity)
+            if step > 0 and previous is not None:
+                timings[name][result['n']][step - 1].add(result['d'] - previous)
+            reached[name][identity] = result['d']
+
+    return trials, timings
+
+def step_order(tests, results):
+    """Yield `results` (result lines, in timestamp order), putting
+    those recorded at the same instant in the order of the steps of
+    their tests (in `tests`, as for :func:`tally`), so that which of
+    several steps taken at once was taken first does not depend on
+    the order they were written in.
+    """
+    def key(result):
+        test = tests.get(result.get('t'))
+        if test is None or result.get('s') not in test['s']:
+            return -1
+        return test['s'].index(result['s'])
+
+    instant = []
+    for result in results:
+        if instant and result.get('d') != instant[0].get('d'):
+            for earlier in sorted(instant, key=key):
+                yield earlier
+            instant = []
+        if 'd' in result:
+            instant.append(result)
+        else:
+            # results.dabble has no timestamps, and its
+            # results are kept in the order they were written
+            yield result
+    for earlier in sorted(instant, key=key):
+        yield earlier
+
+def resume(export, after):
+    """Yield the tuples of `export()` (a callable returning the
+    tuples of an export, in a stable order) following `after`, or
+    all of them, if `after` is `None` or no longer among them.
+    """
+    resumed = after is None
+    for exported in export():
+        if resumed:
+            yield exported
+        elif exported == tuple(after):
+            resumed = True
+
+    if not resumed:
+        for exported in export():
+            yield exported
+
+def merge_lines(sources):
+    """Merge iterables of lines (dicts), each in the order of the
+    lines' timestamps (``'d'``), into one iterable in timestamp order.
+    Lines without a timestamp come first, and lines with the same
+    timestamp keep the order of `sources`.
+    """
+    if len(sources) == 1:
+        return iter(sources[0])
+
+    def keyed(n, lines):
+        for seq, data in enumerate(lines):
+            yield (data.get('d', 0), n, seq), data
+
+    return (data for key, data in heapq.merge(*[keyed(n, lines)
+                                               for n, lines in enumerate(sources)]))
+
+def process_id():
+    """Identify the current process among all those which may
+    write to a storage directory.
+    """
+    return '%s-%d' % (gethostname().replace('.', '_'), getpid())
+
+durabilities = ('none', 'fsync', 'group')
+
+class FileWriter(object):
+    """Append to files through descriptors which are kept open. Each
+    append is a single ``write()`` to a file opened with ``O_APPEND``,
+    which the operating system does atomically, so files written only
+    by the current process need no locking.
+
+    `durability` is when appends reach the disk: "none" leaves it to
+    the operating system, "fsync" syncs the file after every append,
+    and "group" syncs each file appended to at most once every
+    `interval` seconds (see :class:`GroupCommit`), with appends waiting
+    for the sync which follows them.
+    """
+
+    # the number of files kept open; all are closed to make
+    # room, since results files are written one day at a time
+    max_open = 8
+
+    def __init__(self, durability='none', interval=0.1):
+        if durability not in durabilities:
+            raise Exception('unknown durability "%s"' % durability)
+
+        self.durability = durability
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.pid = None
+        self.fds = {}
+        self.commit = None
+
+    def append(self, filename, data, shared=False):
+        """Append `data` to `filename`. Files which are `shared` with
+        other processes may have been replaced since they were opened
+        (see :meth:`FSResultStorage.archive`), so the caller must hold
+        the lock. Return a ticket to pass to :meth:`wait`.
+        """
+        data = to_bytes(data)
+        with self.lock:
+            if self.pid != getpid():
+                # descriptors inherited from before a fork
+                # are left to the parent
+                self.pid = getpid()
+                self.fds = {}
+                if self.durability == 'group':
+                    self.commit = GroupCommit(self.interval)
+
+            fd = self.fds.get(filename)
+            if fd is not None and shared and self._replaced(filename, fd):
+                self._close([self.fds.pop(filename)])
+                fd = None
+            if fd is None:
+                if len(self.fds) >= self.max_open:
+                    self._close(self.fds.values())
+                    self.fds = {}
+                fd = self.fds[filename] = os_open(filename, O_WRONLY | O_APPEND | O_CREAT, 0o644)
+
+            if write(fd, data) != len(data):
+                raise IOError('short write to "%s"' % filename)
+
+            if self.durability == 'fsync':
+                fsync(fd)
+            elif self.commit is not None:
+                return self.commit.add(fd)
+
+    def wait(self, ticket):
+        """Wait until the append which returned `ticket` is durable."""
+        if ticket is not None:
+            self.commit.wait(ticket)
+
+    def _replaced(self, filename, fd):
+        try:
+            st = stat(filename)
+        except OSError:
+            return True
+        opened = fstat(fd)
+        return (st.st_dev, st.st_ino) != (opened.st_dev, opened.st_ino)
+
+    def _close(self, fds):
+        # appends to the descriptors are synced before they are
+        # closed, as a later group sync would no longer see them
+        if self.commit is not None and fds:
+            self.commit.wait(max(self.commit.add(fd) for fd in fds))
+        for fd in fds:
+            close(fd)
+
+    def close(self):
+        """Close (and, if need be, sync) every open file."""
+        with self.lock:
+            if self.pid == getpid():
+                self._close(self.fds.values())
+            self.fds = {}
+
+class GroupCommit(object):
+    """Sync files in groups. Descriptors are :meth:`add`-ed after
+    each write to them, and a thread calls ``fsync()`` once on each
+    descriptor added since its last round, starting a round at most
+    once every `interval` seconds. :meth:`wait` blocks until the round
+    covering an add has finished, so concurrent writers share syncs.
+    The thread exits when no writes are waiting.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.thread = None
+        self.pending = set()
+        self.started = 0
+        self.finished = 0
+        self.synced_at = 0
+        self.errors = {}
+
+    def add(self, fd):
+        """Note a write to `fd`, returning a ticket for :meth:`wait`."""
+        with self.condition:
+            self.pending.add(fd)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            return self.started + 1
+
+    def wait(self, ticket):
+        with self.condition:
+            while self.finished < ticket:
+                self.condition.wait()
+            error = self.errors.get(ticket)
+        if error is not None:
+            raise error
+
+    def run(self):
+        while True:
+            delay = self.synced_at + self.interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self.condition:
+                if not self.pending:
+                    self.thread = None
+                    return
+                fds, self.pending = self.pending, set()
+                self.started += 1
+                ticket = self.started
+                self.synced_at = time.time()
+
+            error = None
+            for fd in fds:
+                try:
+                    fsync(fd)
+                except OSError as e:
+                    error = e
+
+            with self.condition:
+                self.finished = ticket
+                if error is not None:
+                    self.errors[ticket] = error
+                for old in [old for old in self.errors if old < ticket - 1000]:
+                    del self.errors[old]
+                self.condition.notify_all()
+
+def read_segment(filename):
+    """Yield the decompressed contents of an archive segment, in
+    blocks of whole lines (see :func:`read_blocks`), using the codec
+    given by its file extension. The segment is decompressed as the
+    blocks are read.
+    """
+    ext = filename.rsplit('.', 1)[-1]
+    for extension, opener in codecs.values():
+        if extension == ext:
+            fp = opener(filename, 'rb')
+            try:
+                for block in read_blocks(fp):
+                    yield block
+            finally:
+                fp.close()
+            return
+    raise Exception('unknown compression for "%s"' % filename)
+
+def prefetch(func, items, ahead=4, buffered=4):
+    """Yield, for each of `items` in order, an iterator over the
+    values yielded by ``func(item)``. Up to `ahead` items beyond those
+    whose iterators have been yielded are started at once, in threads,
+    each of which holds up to `buffered` values until they are read.
+    """
+    items = iter(items)
+    pending = deque()
+    stopped = threading.Event()
+    done = object()
+
+    def start(item):
+        queue = Queue(buffered)
+        def put(value):
+            # gives up once the values are no longer wanted
+            while not stopped.is_set():
+                try:
+                    return queue.put(value, timeout=0.1)
+                except Full:
+                    continue
+        def run():
+            try:
+                for value in func(item):
+                    if stopped.is_set():
+                        return
+                    put((None, value))
+                put((done, None))
+            except Exception as e:
+                put((e, None))
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        pending.append(queue)
+
+    def values(queue):
+        while True:
+            error, value = queue.get()
+            if error is done:
+                return
+            if error is not None:
+                raise error
+            yield value
+
+    try:
+        for item in islice(items, ahead):
+            start(item)
+        while pending:
+            queue = pending.popleft()
+            for item in islice(items, 1):
+                start(item)
+            yield values(queue)
+    except GeneratorExit:
+        stopped.set()
+        raise
+
+class TailIndex(object):
+    """An in-memory index over one or more files of JSON lines, which
+    is kept up to date by reading only the lines appended to each
+    file since it was last refreshed. Sub-classes implement
+    :meth:`clear` and :meth:`add` to build whatever structure they
+    need from the lines.
+
+    `filenames` is a callable returning the files to index, so files
+    may be added over time. If any file is replaced or truncated, the
+    index is rebuilt from the start of every file.
+
+    `filenames` is called on every refresh, unless the `directories`
+    holding the files are given, in which case it is only called again
+    once one of them changes. If `live` is given, it is a callable
+    telling whether a file may still be appended to; only those files
+    are checked on every refresh, and the rest at least every
+    `recheck` seconds, or when the directories change.
+    """
+
+    def __init__(self, filenames, directories=(), live=None, recheck=60):
+        self.filenames = filenames
+        self.directories = directories
+        self.live = live
+        self.recheck = recheck
+        self.lock = threading.Lock()
+        self.positions = {}
+        self.listed = None
+        self.mtimes = None
+        self.checked = 0
+        self.clear()
+
+    def clear(self):
+        raise Exception('Not implemented. Use a sub-class of TailIndex')
+
+    def add(self, data):
+        raise Exception('Not implemented. Use a sub-class of TailIndex')
+
+    def refresh(self):
+        with self.lock:
+            now = time.time()
+            partial = not self._listing_changed(now) and now < self.checked + self.recheck
+            if partial:
+                files = self._stat(filename for filename in self.listed if self.live(filename))
+            else:
+                self.listed = self.filenames()
+                self.checked = now
+                files = self._stat(self.listed)
+
+            present = set(filename for filename, st in files)
+            for filename, st in files:
+                inode, offset = self.positions.get(filename, (st.st_ino, 0))
+                if inode != st.st_ino or st.st_size < offset or \
+                        not partial and not present.issuperset(self.positions):
+                    # a file was replaced, truncated or removed
+                    self.positions = {}
+                    self.clear()
+                    if partial:
+                        files = self._stat(self.listed)
+                    break
+
+            for filename, st in files:
+                inode, offset = self.positions.get(filename, (st.st_ino, 0))
+                if st.st_size != offset:
+                    self._read(filename, st.st_ino, offset)
+
+    def _stat(self, filenames):
+        files = []
+        for filename in filenames:
+            try:
+                files.append((filename, stat(filename)))
+            except OSError:
+                continue
+        return files
+
+    def _listing_changed(self, now):
+        # whether the files may have been added, removed or
+        # replaced since they were listed; a directory changed
+        # within the last second may change again without its
+        # mtime doing so
+        if not self.directories or self.live is None:
+            return True
+        mtimes = []
+        for directory in self.directories:
+            try:
+                mtimes.append(stat(directory).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        changed = self.listed is None or mtimes != self.mtimes or \
+            any(mtime is not None and now - mtime < 1 for mtime in mtimes)
+        self.mtimes = mtimes
+        return changed
+
+    def _read(self, filename, inode, offset):
+        with open(filename, 'rb') as fp:
+            if fstat(fp.fileno()).st_ino != inode:
+                # replaced since it was stat()ed; the
+                # next refresh will start over
+                return
+
+            # a line still being written by another
+            # process is left for the next refresh
+            fp.seek(offset)
+            rest = b''
+            while True:
+                block = fp.read(scan_size)
+                if not block:
+                    break
+                chunk = rest + block
+                end = chunk.rfind(b'\n') + 1
+                rest = chunk[end:]
+                offset += end
+                for line in chunk[:end].splitlines():
+                    try:
+                        data = json.loads(line)
+                    except:
+                        continue
+                    self.add(data)
+
+        self.positions[filename] = (inode, offset)
+
+class RollupIndex(TailIndex):
+    """Count the results in the results files in a
+    :class:`~dabble.rollup.Rollup`, as they are appended.
+    """
 
-    data = json.dumps(line, separators=(',', ':')) + '\n'
-    with lock:
-        with file(filename, 'a') as fp:
-            fp.seek(0, SEEK_END)
-            fp.write(data)
+    def __init__(self, filenames, rollup):
+        self.rollup = rollup
+        super(RollupIndex, self).__init__(filenames)
 
+    def clear(self):
+        self.rollup.clear()
+
+    def add(self, data):
+        # results.dabble has no timestamps to count by
+        if 'd' in data:
+            self.rollup.add(data['i'], data['t'], data['n'], data['s'], data['d'])
+
+class AlternativeIndex(TailIndex):
+    """Index the alternatives files by (identity, test name),
+    keeping the earliest assignment of each.
+    """
+
+    def clear(self):
+        self.alternatives = {}
+        self.times = {}
+
+    def add(self, data):
+        key = (data['i'], data['t'])
+        d = data.get('d', 0)
+        if key not in self.alternatives or d < self.times[key]:
+            self.alternatives[key] = data['n']
+            self.times[key] = d
+
+class FirstStepIndex(object):
+    """A persistent index of the first time each identity took each
+    step of each test under each alternative, kept in an SQLite
+    database in the storage directory. :class:`FSResultStorage` adds
+    results to it as it records them, and fills it in from the results
+    already stored (in the results files and the archive) when it first
+    opens a directory, so it is never rebuilt by reading the results
+    again, and answers each question with a lookup.
+
+    `path` is the database file. If `read_only`, the database is not
+    created or written, and the index is only :meth:`complete` if a
+    writable storage has filled it in.
+    """
+
+    # seconds after which a fill() which has not added
+    # anything is taken to have died with its process
+    stale = 300
+
+    def __init__(self, path, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+
+    def _connect(self):
+        # one connection per process, shared by its threads
+        # under self.lock; None if there is no database to read
+        if self.db is not None and self.pid == getpid():
+            return self.db
+        if self.read_only and not exists(self.path):
+            return None
+        self.db = sqlite3.connect(self.path, timeout=60, isolation_level=None,
+                                  check_same_thread=False)
+        self.pid = getpid()
+        if not self.read_only:
+            self.db.execute('CREATE TABLE IF NOT EXISTS steps (t TEXT, i TEXT, s TEXT, '
+                            'n INTEGER, d REAL, PRIMARY KEY (t, i, s, n)) WITHOUT ROWID')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v REAL)')
+        return self.db
+
+    def _meta(self, db):
+        try:
+            return dict(db.execute('SELECT k, v FROM meta'))
+        except sqlite3.OperationalError:
+            # created, but not yet set up
+            return {}
+
+    def complete(self):
+        """Return whether the index holds every result stored."""
+        with self.lock:
+            db = self._connect()
+            return db is not None and 'complete' in self._meta(db)
+
+    def add(self, lines):
+        """Add result `lines` (dicts, as in the results files)."""
+        # the earliest time of each step in the batch; the results
+        # in results.dabble have none, and only show a step was taken
+        earliest = {}
+        for line in lines:
+            try:
+                key = tuple(to_text(line[field]) for field in 'tis') + (line['n'], )
+            except KeyError:
+                continue
+            d = line.get('d')
+            if key not in earliest or d is not None and \
+                    (earliest[key] is None or d < earliest[key]):
+                earliest[key] = d
+
+        with self.lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for key, d in earliest.items():
+                    inserted = db.execute('INSERT OR IGNORE INTO steps VALUES (?, ?, ?, ?, ?)',
+                                          key + (d, )).rowcount
+                    if not inserted and d is not None:
+                        db.execute('UPDATE steps SET d = ? WHERE t = ? AND i = ? AND s = ? '
+                                   'AND n = ? AND (d IS NULL OR d > ?)', (d, ) + key + (d, ))
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+
+    def fill(self, results, batch=10000):
+        """Add `results` (a callable returning an iterable of every
+        result stored) and mark the index complete, unless it is
+        already, or another process is filling it in.
+        """
+        with self.lock:
+            db = self._connect()
+            db.execute('BEGIN IMMEDIATE')
+            meta = self._meta(db)
+            if 'complete' in meta or time.time() - meta.get('filling', 0) < self.stale:
+                db.execute('COMMIT')
+                return
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('filling', time.time()))
+            db.execute('COMMIT')
+
+        results = iter(results())
+        while True:
+            lines = list(islice(results, batch))
+            if not lines:
+                break
+            self.add(lines)
+            with self.lock:
+                self.db.execute('UPDATE meta SET v = ? WHERE k = ?', (time.time(), 'filling'))
+
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('DELETE FROM meta WHERE k = ?', ('filling', ))
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('complete', time.time()))
+            self.db.execute('COMMIT')
+
+    def has(self, identity, test_name, alternative, action):
+        """Return whether `identity` (in hex) took `action` in the
+        test, under `alternative`, or any alternative if `None`.
+        """
+        query = 'SELECT 1 FROM steps WHERE t = ? AND i = ? AND s = ?'
+        args = [to_text(test_name), to_text(identity), to_text(action)]
+        if alternative is not None:
+            query += ' AND n = ?'
+            args.append(alternative)
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return False
+            return db.execute(query + ' LIMIT 1', args).fetchone() is not None
+
+    def lookup(self, keys, before=None, batch=500):
+        """Return a dictionary mapping (test name, identity) `keys` to
+        result lines (dicts, in timestamp order) for the first time
+        the identity took each step under each alternative; only
+        those before `before` (in seconds since the epoch), if given.
+        """
+        tests = {}
+        for test_name, identity in keys:
+            tests.setdefault(to_text(test_name), []).append(to_text(identity))
+
+        found = {}
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return found
+            for test_name, identities in tests.items():
+                for start in range(0, len(identities), batch):
+                    chunk = identities[start:start + batch]
+                    query = 'SELECT i, s, n, d FROM steps WHERE t = ? AND i IN (%s)' % \
+                        ', '.join('?' * len(chunk))
+                    args = [test_name] + chunk
+                    if before is not None:
+                        query += ' AND d < ?'
+                        args.append(before)
+                    # results without a time came first
+                    for identity, action, alternative, d in db.execute(
+                            query + ' ORDER BY i, d IS NOT NULL, d', args):
+                        found.setdefault((test_name, identity), []).append(
+                            {'i': identity, 't': test_name, 'n': alternative, 's': action,
+                             'd': d})
+        return found
+
+def with_history(results, history, size=1000):
+    """Yield `results` (an iterable of result lines), preceding the
+    first result of each (test name, identity) with the lines
+    ``history(keys)`` returns for it. `history` is called with a list
+    of the new keys in each `size` results, and returns a dictionary
+    of lists of lines by key; see :meth:`FirstStepIndex.lookup`.
+    """
+    results = iter(results)
+    seen = set()
+    while True:
+        chunk = list(islice(results, size))
+        if not chunk:
+            break
+        keys = []
+        for result in chunk:
+            key = (result.get('t'), result.get('i'))
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+        found = keys and history(keys) or {}
+        for key in keys:
+            for line in found.get(key, ()):
+                yield line
+        for result in chunk:
+            yield result
+
+class _Lazy(object):
+    # an iterable calling func() for its iterator only when first
+    # iterated, so that segments are read in the order merged
+
+    def __init__(self, func):
+        self.func = func
+
+    def __iter__(self):
+        return iter(self.func())
 
 class FSResultStorage(ResultStorage):
 
-    def __init__(self, directory):
+    def __init__(self, directory, readers=4, segmented=False, durability='none',
+                 sync_interval=0.1, read_only=False):
         """Set up storage in the filesystem for A/B test results.
+        Identities are stored as hexadecimal strings.
 
         :Parameters:
           - `directory`: an existing directory in the filesystem where
             results can be stored. Several files with the ".dabble"
             extension will be created.
-          - `namespace`: the name prefix used to name collections
+          - `readers`: the number of archive segments (see
+            :meth:`archive`) decompressed at once by reports
+          - `segmented`: if `True`, each process appends results and
+            alternatives to files of its own, without locking; see
+            :class:`FileWriter`. Storages which are not segmented
+            read these files too, so processes writing either way can
+            share a directory.
+          - `durability`: when writes reach the disk; "none" (the
+            operating system decides), "fsync" (before each write
+            returns), or "group" (writes wait for a sync shared by
+            all the writes made in the last `sync_interval` seconds)
+          - `sync_interval`: the seconds between syncs, when
+            `durability` is "group"
+          - `read_only`: if `True`, nothing is created in `directory`,
+            so that it can be reported on where it cannot be written
+            (such as a read-only mount); writes will fail
         """
-        global lock
-
         self.directory = abspath(directory)
 
         if not exists(self.directory):
             raise Exception('directory "%s" does not exist' % self.directory)
 
-        lock = FileLock(join(self.directory, 'lock.dabble'))
+        self.thread_lock, self.lock = directory_locks(self.directory)
+        # if set, called with the file name and the seconds spent
+        # waiting for the locks, on each append; see dabble.trace
+        self.lock_wait_hook = None
 
         self.tests_path = join(self.directory, 'tests.dabble')
-        self.results_path = join(self.directory, 'results.dabble')
         self.alts_path = join(self.directory, 'alts.dabble')
 
-    def save_test(self, test_name, alternatives, steps):
+        # results are partitioned into one file per (UTC) day;
+        # results.dabble holds results recorded by earlier
+        # versions of dabble, which have no timestamps
+        self.results_path = join(self.directory, 'results.dabble')
+        self.results_dir = join(self.directory, 'results')
+        if not read_only and not exists(self.results_dir):
+            mkdir(self.results_dir)
+
+        # results of archived tests are moved to compressed
+        # segments, one directory per test
+        self.archive_dir = join(self.directory, 'archive')
+        self.readers = readers
+
+        self.segmented = segmented
+        self.writer = FileWriter(durability, sync_interval)
+
+        self.alt_index = AlternativeIndex(self.alt_files)
+        self.rollup = Rollup(self.load_tests)
+        self.rollup_index = RollupIndex(self.partitions, self.rollup)
+
+        # the first time each identity took each step, for
+        # has_action() (called with every step recorded), and so that
+        # windowed reports need not read results from before the window
+        self.first_steps = FirstStepIndex(join(self.directory, 'steps.sqlite'), read_only)
+        if not read_only:
+            self.first_steps.fill(lambda: self._results(archived=list(self.load_tests())))
+
+    def partition(self, timestamp):
+        """Return the path of the file holding results recorded
+        at `timestamp` (a UTC :class:`~datetime.datetime`).
+        """
+        return join(self.results_dir, timestamp.strftime('%Y-%m-%d.dabble'))
+
+    def partitions(self, since=None, until=None):
+        """Return the paths of the files holding results recorded
+        from `since` (inclusive) until `until` (exclusive), oldest
+        first. Either bound may be `None`. results.dabble is only
+        included when neither is given, since its results have no
+        timestamps.
+        """
+        paths = []
+        if exists(self.results_path) and self._in_window('results.dabble', since, until):
+            paths.append(self.results_path)
+
+        names = exists(self.results_dir) and listdir(self.results_dir) or []
+        for name in sorted(names):
+            if self._in_window(name, since, until):
+                paths.append(join(self.results_dir, name))
+
+        return paths
+
+    def _in_window(self, name, since, until):
+        # whether the partition file called name may hold
+        # results from since (inclusive) until until (exclusive);
+        # the files of segmented storages are named like
+        # "<day>.<process id>.dabble"
+        if name == basename(self.results_path):
+            return since is None and until is None
+
+        parts = name.split('.')
+        if len(parts) not in (2, 3) or parts[-1] != 'dabble':
+            return False
+        try:
+            day = datetime.strptime(parts[0], '%Y-%m-%d')
+        except ValueError:
+            return False
+        if since is not None and day + timedelta(days=1) <= since:
+            return False
+        if until is not None and day >= until:
+            return False
+        return True
+
+    def _own(self, path):
+        # the file of this process corresponding to path
+        return '%s.%s.dabble' % (path[:-len('.dabble')], process_id())
+
+    def _append(self, filename, lines):
+        if not self.segmented:
+            return append_lines(filename, lines, self.writer, (self.thread_lock, self.lock),
+                                self.lock_wait_hook)
+
+        if dirname(filename) == self.results_dir and \
+                basename(filename).split('.')[0] < self._cutoff(1):
+            # archive() may replace the files of earlier days, so
+            # writes to them take the lock, and reopen replaced files
+            return append_lines(self._own(filename), lines, self.writer,
+                                (self.thread_lock, self.lock), self.lock_wait_hook)
+
+        data = ''.join(encode_line(line) for line in lines)
+        if data:
+            self.writer.wait(self.writer.append(self._own(filename), data))
+
+    def _cutoff(self, days):
+        # the name of the partition of `days` (UTC) days ago
+        return (utcnow() - timedelta(days=days)).strftime('%Y-%m-%d')
+
+    def alt_files(self):
+        """Return the paths of the files holding alternatives."""
+        return [self.alts_path] + sorted(
+            join(self.directory, name) for name in listdir(self.directory)
+            if name.startswith('alts.') and name.endswith('.dabble') and
+            name != basename(self.alts_path))
+
+    def _assigned(self, identity, test_name):
+        # the earliest alternative assigned to identity (in hex), in
+        # the files of every process, whether or not it segments its
+        # writes; segmented storages keep an index rather than scan
+        # each process's file
+        if self.segmented:
+            self.alt_index.refresh()
+            return self.alt_index.alternatives.get((identity, test_name))
+
+        for existing in merge_lines([find_lines(path, i=identity, t=test_name)
+                                     for path in self.alt_files()]):
+            return existing['n']
+        return None
+
+    def _archive_path(self, test_name):
+        return join(self.archive_dir, quote(to_bytes(test_name), safe=''))
+
+    def segments(self, test_name, since=None, until=None):
+        """Return a dictionary mapping the names of partition files
+        (like those returned by :meth:`partitions`) to the paths of the
+        archive segments holding the test's results from them, oldest
+        first.
+        """
+        path = self._archive_path(test_name)
+        if not exists(path):
+            return {}
+
+        segments = {}
+        for name in listdir(path):
+            try:
+                partition, number, ext = name.rsplit('.', 2)
+                number = int(number)
+            except ValueError:
+                # including segments still being written
+                continue
+            if self._in_window(partition, since, until):
+                segments.setdefault(partition, []).append((number, join(path, name)))
+
+        return dict((partition, [path for number, path in sorted(paths)])
+                    for partition, paths in segments.items())
+
+    def load_tests(self):
+        tests = {}
+        for test in find_lines(self.tests_path):
+            if test['t'] not in tests:
+                tests[test['t']] = {'alternatives': test['a'], 'steps': test['s'],
+                                    'sampling': test.get('r')}
+        return tests
+
+    def save_test(self, test_name, alternatives, steps, sampling=None):
         existing = find_line(self.tests_path, t=test_name)
-        if existing and (existing['a'] != alternatives or existing['s'] != steps):
+        if existing and (existing['a'] != alternatives or existing['s'] != steps or
+                         existing.get('r') != sampling):
             raise Exception(
                 'test "%s" already exists with different alternatives' % test_name)
 
-        append_line(self.tests_path, t=test_name, a=alternatives, s=steps)
+        if not existing:
+            line = {'t': test_name, 'a': alternatives, 's': steps}
+            if sampling is not None:
+                line['r'] = sampling
+            append_lines(self.tests_path, [line], self.writer, (self.thread_lock, self.lock),
+                         self.lock_wait_hook)
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        timestamp = timestamp or utcnow()
+        line = dict(i=hexlify(identity), t=test_name, n=alternative, s=action,
+                    d=epoch(timestamp))
+        self._append(self.partition(timestamp), [line])
+        self.first_steps.add([line])
 
-    def record(self, identity, test_name, alternative, action):
-        append_line(self.results_path,
-                    i=identity, t=test_name, n=alternative, s=action)
+    def record_many(self, records):
+        # one write per day partition touched by the batch
+        now = utcnow()
+        partitions = {}
+        for identity, test_name, alternative, action, timestamp in records:
+            timestamp = timestamp or now
+            partitions.setdefault(self.partition(timestamp), []).append(dict(
+                i=hexlify(identity), t=test_name, n=alternative,
+                s=action, d=epoch(timestamp)))
+
+        for filename in sorted(partitions):
+            self._append(filename, partitions[filename])
+            self.first_steps.add(partitions[filename])
 
     def has_action(self, identity, test_name, alternative, action):
-        return find_line(self.results_path, i=identity, t=test_name, n=alternative, a=action) is not None
+        return self.first_steps.has(hexlify(identity), test_name, alternative, action)
 
     def set_alternative(self, identity, test_name, alternative):
-        existing = find_line(self.alts_path, i=identity, t=test_name)
-        if existing and existing['n'] != alternative:
+        identity = hexlify(identity)
+        existing = self._assigned(identity, test_name)
+        if existing is not None and existing != alternative:
             raise Exception(
                 'different alternative already set for identity %s' % identity)
 
-        append_line(self.alts_path, i=identity, t=test_name, n=alternative)
+        # assignments are timestamped, so that the earliest
+        # can be found among the files of several processes
+        self._append(self.alts_path, [dict(i=identity, t=test_name, n=alternative,
+                                           d=epoch(utcnow()))])
+
+    def set_alternatives(self, assignments):
+        # existing assignments are not checked; where an identity
+        # is assigned twice, get_alternative() finds the first
+        d = epoch(utcnow())
+        self._append(self.alts_path, [dict(i=hexlify(identity), t=test_name, n=alternative, d=d)
+                                      for identity, test_name, alternative in assignments])
 
     def get_alternative(self, identity, test_name):
-        existing = find_line(self.alts_path, i=identity, t=test_name) or {}
-        return existing.get('n')
+        return self._assigned(hexlify(identity), test_name)
+
+    def get_alternatives(self, identities, test_name):
+        # batches are looked up in the index, which only reads the
+        # assignments appended since the last batch, so that a bulk
+        # assignment reads each assignment once, rather than once
+        # per batch
+        self.alt_index.refresh()
+        found = {}
+        for identity in identities:
+            alternative = self.alt_index.alternatives.get((hexlify(identity), test_name))
+            if alternative is not None:
+                found[identity] = alternative
+        return found
+
+    def report(self, test_name, since=None, until=None, quantiles=None):
+        return self.report_many([test_name], since, until, quantiles)[test_name]
+
+    def report_many(self, test_names, since=None, until=None, quantiles=None):
+        # tests.dabble and each results file are each read
+        # once, however many tests are being reported on
+        tests = {}
+        for test in find_lines(self.tests_path):
+            if test['t'] in test_names and test['t'] not in tests:
+                tests[test['t']] = test
+
+        for test_name in test_names:
+            if test_name not in tests:
+                raise Exception('unknown test "%s"' % test_name)
+
+        # a single test's results are picked out of the files
+        # before they are parsed. only the results in the window
+        # are read; the first time each identity in it took each
+        # step before it comes from the index (see tally()), or,
+        # while the index is being filled in, from every result
+        # since the epoch (but not results.dabble, which has no
+        # timestamps)
+        pattern = len(tests) == 1 and {'t': list(tests)[0]} or {}
+        if since is not None and self.first_steps.complete():
+            results = self._results(since, until, archived=tests, **pattern)
+            results = with_history((result for result in results if result.get('t') in tests),
+                                   lambda keys: self.first_steps.lookup(keys, epoch(since)))
+        else:
+            results = self._results(since and epoch_start, until, archived=tests, **pattern)
+        trials, timings = tally(tests, results, since, until, quantiles)
+
+        return dict((test_name, funnel_report(test_name, test['a'], test['s'],
+                                              trials[test_name], test.get('r'),
+                                              timings[test_name], quantiles))
+                    for test_name, test in tests.items())
+
+    def _results(self, since=None, until=None, archived=(), **pattern):
+        # yield the results matching pattern, in order, from
+        # each partition which may hold results in the window,
+        # and from the archive segments of the tests in archived.
+        # the files of each day (of several processes, and their
+        # archive segments) are merged in timestamp order
+        live = dict((basename(path), path) for path in self.partitions(since, until))
+        segments = {}
+        for test_name in archived:
+            for partition, paths in self.segments(test_name, since, until).items():
+                segments.setdefault(partition, []).extend(paths)
+
+        days = {}
+        for partition in sorted(set(live) | set(segments)):
+            sources = days.setdefault(partition.split('.')[0], [])
+            sources.extend((True, path) for path in segments.get(partition, ()))
+            if partition in live:
+                sources.append((False, live[partition]))
+
+        # segments are decompressed ahead, in parallel, a few blocks
+        # at a time, in the order they are first read (merge_lines
+        # starts each source in turn)
+        legacy = basename(self.results_path).split('.')[0]
+        order = sorted(days, key=lambda day: (day != legacy, day))
+        decompressed = prefetch(read_segment, [path for day in order
+                                               for compressed, path in days[day] if compressed],
+                                self.readers)
+
+        needles = encoded_values(pattern)
+        def segment_lines():
+            return (data for block in next(decompressed)
+                    for data in match_lines(candidates(block, needles), **pattern))
 
-    def report(self, test_name):
+        for day in order:
+            sources = [compressed and _Lazy(segment_lines) or find_lines(path, **pattern)
+                       for compressed, path in days[day]]
+            for result in merge_lines(sources):
+                yield result
+
+    def timeseries(self, test_name, start, end, resolution='minute'):
+        # the rollup is kept up to date by reading only the results
+        # appended (by any process) since it was last refreshed
+        self.rollup_index.refresh()
+        return self.rollup.timeseries(test_name, start, end, resolution)
+
+    def archive(self, test_name, compression='gzip'):
+        """Move the results of a test out of the results files, into
+        compressed segment files in the "archive" directory, one per
+        results file. :meth:`report` reads the segments as well as the
+        results files, so reports are unchanged, but reports on other
+        tests no longer read the test's results. Return the number of
+        results archived.
+
+        Archiving is meant for tests which have finished: results
+        recorded afterwards are kept in the results files until the
+        test is archived again. Files written by segmented storages for the
+        last two days (or later) are not archived, since their writers
+        do not lock them; writes to older days wait for the archive,
+        and go to a new file once it has replaced theirs.
+
+        :Parameters:
+          - `test_name`: the string name of the test
+          - `compression`: "gzip" or "bz2"; or "lzma" or "zstd", when
+            the Python standard library (or, for lzma, backports.lzma)
+            supports them
+        """
+        if compression not in codecs:
+            raise Exception('compression "%s" is not available' % compression)
+        ext, opener = codecs[compression]
+
+        archive_path = self._archive_path(test_name)
+        for path in (self.archive_dir, archive_path):
+            if not exists(path):
+                mkdir(path)
+
+        # the files segmented storages are writing are left alone,
+        # as their processes do not take the lock; they lock writes
+        # to days before yesterday, a day before these are archived,
+        # so that no write decided against locking before midnight
+        # can race an archive started after it
+        cutoff = self._cutoff(2)
+
+        archived = 0
+        with self.thread_lock, self.lock:
+            existing = self.segments(test_name)
+            for path in self.partitions():
+                partition = basename(path)
+                parts = partition.split('.')
+                if len(parts) == 3 and parts[0] >= cutoff:
+                    continue
+                name = '%s.%d.%s' % (partition, len(existing.get(partition, ())), ext)
+                segment_path = join(archive_path, name)
+                moved = 0
+
+                # the segment is complete before any results are removed,
+                # and the results file is replaced in one step, so a crash
+                # at worst leaves results in both, which report() ignores
+                segment = opener(segment_path + '.tmp', 'wb')
+                try:
+                    with open(path, 'rb') as src, open(path + '.tmp', 'wb') as dst:
+                        for line in src:
+                            try:
+                                data = json.loads(line)
+                            except:
+                                data = {}
+                            if data.get('t') == test_name:
+                                segment.write(line)
+                                moved += 1
+                            else:
+                                dst.write(line)
+                finally:
+                    segment.close()
+
+                if moved:
+                    rename(segment_path + '.tmp', segment_path)
+                    rename(path + '.tmp', path)
+                else:
+                    remove(segment_path + '.tmp')
+                    remove(path + '.tmp')
+                archived += moved
+
+        return archived
+
+    def list_tests(self):
+        """Return a list of string test names known."""
+        return list(self.load_tests())
+
+    def export_alternatives(self, test_name, after=None):
+        def export():
+            for line in merge_lines([find_lines(path, t=test_name)
+                                     for path in self.alt_files()]):
+                yield unhexlify(line['i']), line['n']
+        for exported in resume(export, after):
+            yield exported
+
+    def export_results(self, test_name, after=None):
         test = find_line(self.tests_path, t=test_name)
         if test is None:
             raise Exception('unknown test "%s"' % test_name)
 
-        report = {
-            'test_name': test_name,
-            'results': []
-        }
-
-        trials = sparsearray(int)
-        maxstep = {}
-
-        for result in find_lines(self.results_path, t=test_name):
-            step = test['s'].index(result['s'])
-            sofar = maxstep.get(result['i'])
-            if sofar is None and step == 0 or sofar is not None and step == sofar + 1:
-                trials[result['n']][step] += 1
-                maxstep[result['i']] = step
-
-        for i, alternative in enumerate(test['a']):
-            funnel = []
-            alt = {'alternative': alternative, 'funnel': funnel}
-            report['results'].append(alt)
-            for s, stepspair in enumerate(pairwise(test['s'])):
-                att = trials[i][s]
-                con = trials[i][s + 1]
-                funnel.append({
-                    'stage': stepspair,
-                    'attempted': att,
-                    'converted': con,
-                })
-
-        return report
+        if not self.first_steps.complete():
+            raise Exception('the index of first steps in "%s" is not filled in yet'
+                            % self.directory)
 
-    def list_tests(self):
-        """Return a list of string test names known."""
-        return [t['t'] for t in find_lines(self.tests_path)]
+        # the results are read in timestamp order, a batch at a
+        # time, and each is exported if it is the first time its
+        # identity took its step, and the step counts (as decided by
+        # counted(), as for MongoResultStorage), both of which are
+        # looked up in the index, so nothing is kept per identity
+        def export():
+            results = step_order({test_name: test},
+                                 self._results(archived=[test_name], t=test_name))
+            # the steps exported at the latest time read, in case
+            # one was recorded twice at once
+            latest, seen = None, set()
+            while True:
+                batch = list(islice(results, 1000))
+                if not batch:
+                    break
+                firsts = self.first_steps.lookup([(test_name, result['i'])
+                                                  for result in batch])
+                for result in batch:
+                    first = {}
+                    for line in firsts.get((test_name, result['i']), ()):
+                        if line['s'] in test['s']:
+                            first.setdefault(line['s'], line)
+                    taken = sorted(first, key=lambda step: (
+                        first[step]['d'] is not None, first[step]['d'], test['s'].index(step)))
+                    step = first.get(result['s'])
+                    if step is None or step['d'] != result.get('d') or \
+                            result['s'] not in counted(test['s'], taken, {}):
+                        continue
+
+                    if result.get('d') != latest:
+                        latest, seen = result.get('d'), set()
+                    if (result['i'], result['s']) in seen:
+                        continue
+                    seen.add((result['i'], result['s']))
+
+                    timestamp = 'd' in result and utc_from_epoch(result['d']) or None
+                    yield unhexlify(result['i']), result['n'], result['s'], timestamp
+        for exported in resume(export, after):
+            yield exported
 
@@ -26,12 +26,15 @@
 __all__ = ('MongoResultStorage', )
 
 from dabble import ResultStorage
+from dabble.compat import hexlify, range, text_type
+from dabble.sketch import TDigest
 from dabble.util import *
 
-from datetime import datetime
+from binascii import unhexlify
 from random import randrange
+from bson.binary import Binary
 from bson.son import SON
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, UpdateOne
 from pymongo.database import Database
 from pymongo.errors import DuplicateKeyError
 
@@ -42,7 +45,8 @@ class MongoResultStorage(ResultStorage):
         Setup requires at least a :class:`pymongo.database.Database` instance,
         and optionally accepts a `namespace` parameter, which is used to
         generate collection names used for storage. Three collections will be
-        used, named "<namespace>.tests" and "<namespace>.results".
+        used, named "<namespace>.tests" and "<namespace>.results". Identities
+        are stored as BSON binary (see :meth:`migrate_identities`).
 
         :Parameters:
           - `database`: a :class:`pymongo.database.Database` instance
@@ -57,82 +61,216 @@ class MongoResultStorage(ResultStorage):
         self.tests = database['%s.tests' % namespace]
         self.results = database['%s.results' % namespace]
 
-        self.results.ensure_index([('t', ASCENDING), ('i', ASCENDING)])
+        self.results.create_index([('t', ASCENDING), ('i', ASCENDING)])
+        self.results.create_index([('t', ASCENDING), ('l', ASCENDING)])
 
-    def save_test(self, test_name, alternatives, steps):
+    def load_tests(self):
+        return dict((test['_id'], {'alternatives': test['a'], 'steps': test['s'],
+                                   'sampling': test.get('r')})
+                    for test in self.tests.find())
+
+    def save_test(self, test_name, alternatives, steps, sampling=None):
         test = self.tests.find_one({'_id': test_name})
 
-        if test and test['a'] != alternatives:
+        if test and (test['a'] != alternatives or test.get('r') != sampling):
             raise Exception('test "%s" already exists with different alternatives' % test_name)
 
         elif not test:
-            self.tests.save({
+            # steps are stored as field names (in 'd')
+            for step in steps:
+                if '.' in step or step.startswith('$'):
+                    raise Exception('step names may not contain "." or start with "$"')
+
+            test = {
                 '_id': test_name,
                 'a': alternatives,
                 's': steps,
-            }, safe=True)
+            }
+            if sampling is not None:
+                test['r'] = sampling
+            self.tests.replace_one({'_id': test_name}, test, upsert=True)
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        # each result document keeps the time each step was first
+        # recorded (in 'd'), and the time of the earliest and latest
+        # action ('f' and 'l'); 'l' is indexed to find the documents
+        # active within a report's time window
+        self.results.update_one(*self._recording(identity, test_name, alternative, action,
+                                                 timestamp or utcnow()),
+                                upsert=True)
 
-    def record(self, identity, test_name, alternative, action):
-        self.results.update({
-            'i': identity,
-            't': test_name,
-            'n': alternative},
-            {'$addToSet': {'s': action}},
-            upsert=True)
+    def _recording(self, identity, test_name, alternative, action, timestamp):
+        # the filter and update recording an action
+        return ({'i': Binary(identity), 't': test_name, 'n': alternative},
+                {'$addToSet': {'s': action},
+                 '$min': {'d.' + action: timestamp, 'f': timestamp},
+                 '$max': {'l': timestamp}})
+
+    def record_many(self, records):
+        # a bulk write sends the whole batch in as few round trips
+        # as the server allows; it is ordered so that upserts of
+        # the same document are not run at once
+        now = utcnow()
+        requests = [UpdateOne(*self._recording(identity, test_name, alternative, action,
+                                               timestamp or now), upsert=True)
+                    for identity, test_name, alternative, action, timestamp in records]
+        if requests:
+            self.results.bulk_write(requests, ordered=True)
 
     def has_action(self, identity, test_name, alternative, action):
-        return self.results.find_one({'i': identity, 't': test_name, 'n': alternative, 's': action}) is not None
+        query = {'i': Binary(identity), 't': test_name, 's': action}
+        if alternative is not None:
+            query['n'] = alternative
+        return self.results.find_one(query, projection=['_id']) is not None
 
     def set_alternative(self, identity, test_name, alternative):
         # XXX: possible race condition, but one will win, and
         # for A/B testing that's probably OK.
+        identity = Binary(identity)
         result = self.results.find_one({'i': identity, 't': test_name})
         if not result:
-            self.results.save({'i': identity, 't': test_name, 'n': alternative, 's': []})
+            self.results.insert_one({'i': identity, 't': test_name, 'n': alternative, 's': []})
 
         elif result and result['n'] != alternative:
-            raise Exception('different alternative already set for identity %s' % identity)
+            raise Exception('different alternative already set for identity %s' % hexlify(identity))
+
+    def set_alternatives(self, assignments):
+        # existing assignments are kept, rather than checked
+        requests = [UpdateOne({'i': Binary(identity), 't': test_name},
+                              {'$setOnInsert': {'n': alternative, 's': []}}, upsert=True)
+                    for identity, test_name, alternative in assignments]
+        if requests:
+            self.results.bulk_write(requests, ordered=True)
 
     def get_alternative(self, identity, test_name):
-        result = self.results.find_one({'i': identity, 't': test_name}) or {}
+        result = self.results.find_one({'i': Binary(identity), 't': test_name}) or {}
         return result.get('n')
 
-    def report(self, test_name):
-        test = self.tests.find_one({'_id': test_name})
-        if test is None:
-            raise Exception('unknown test "%s"' % test_name)
+    def get_alternatives(self, identities, test_name):
+        query = {'i': {'$in': [Binary(identity) for identity in identities]}, 't': test_name}
+        found = {}
+        for result in self.results.find(query, projection=['i', 'n']):
+            found.setdefault(bytes(result['i']), result['n'])
+        return found
+
+    def report(self, test_name, since=None, until=None, quantiles=None):
+        return self.report_many([test_name], since, until, quantiles)[test_name]
+
+    def report_many(self, test_names, since=None, until=None, quantiles=None):
+        test_names = list(test_names)
+        tests = dict((test['_id'], test) for test in
+                     self.tests.find({'_id': {'$in': test_names}}))
+
+        for test_name in test_names:
+            if test_name not in tests:
+                raise Exception('unknown test "%s"' % test_name)
+
+        trials = dict((test_name, sparsearray(int)) for test_name in tests)
+        timings = dict((test_name, sparsearray(TDigest)) for test_name in tests)
 
-        report = {
-            'test_name': test_name,
-            'results': []
-        }
+        for test_name, alternative, taken, times, count in self._tally(
+                test_names, since, until, quantiles is not None):
+            steps = counted(tests[test_name]['s'], taken, times, since, until)
+            for i in range(len(steps)):
+                trials[test_name][alternative][i] += count
 
-        trials = sparsearray(int)
+            for i, (step, next_step) in enumerate(pairwise(steps)):
+                if step in times and next_step in times:
+                    elapsed = times[next_step] - times[step]
+                    timings[test_name][alternative][i].add(
+                        elapsed.days * 86400 + elapsed.seconds + elapsed.microseconds / 1e6)
 
-        for result in self.results.find({'t': test_name}):
-            if result['s'] != test['s'][:len(result['s'])]:
-                # invalid order of steps recorded
-                continue
+        return dict((test_name, funnel_report(test_name, test['a'], test['s'],
+                                              trials[test_name], test.get('r'),
+                                              timings[test_name], quantiles))
+                    for test_name, test in tests.items())
 
-            for i in xrange(len(result['s'])):
-                trials[result['n']][i] += 1
+    def _tally(self, test_names, since=None, until=None, timed=False):
+        # yield (test name, alternative, steps, times, count) for
+        # the result documents of the given tests, in one query;
+        # times (of each step) are only read for windowed or timed
+        # reports
+        if since is None and until is None and not timed:
+            # documents with identical steps are counted
+            # together by the server
+            groups = self.results.aggregate([
+                {'$match': {'t': {'$in': test_names}}},
+                {'$group': {'_id': {'t': '$t', 'n': '$n', 's': '$s'},
+                            'c': {'$sum': 1}}},
+            ])
+            if isinstance(groups, dict):
+                # PyMongo 2 returns the whole result
+                groups = groups['result']
+            for group in groups:
+                key = group['_id']
+                yield key['t'], key['n'], key['s'], {}, group['c']
+            return
 
-        for i, alternative in enumerate(test['a']):
-            funnel = []
-            alt = {'alternative': alternative, 'funnel': funnel}
-            report['results'].append(alt)
-            for s, stepspair in enumerate(pairwise(test['s'])):
-                att = trials[i][s]
-                con = trials[i][s + 1]
-                funnel.append({
-                    'stage': stepspair,
-                    'attempted': att,
-                    'converted': con,
-                })
+        query = {'t': {'$in': test_names}}
+        if since is not None:
+            query['l'] = {'$gte': since}
+        if until is not None:
+            query['f'] = {'$lt': until}
 
-        return report
+        for result in self.results.find(query, projection=['t', 'n', 's', 'd']):
+            yield result['t'], result['n'], result['s'], result.get('d', {}), 1
+
+    def migrate_identities(self):
+        """Convert identities stored by versions of dabble before
+        :class:`~dabble.hashers.IdentityHasher` was introduced, which
+        were hexadecimal strings, to the binary form now stored. Return
+        the number of result documents converted.
+
+        Existing results only remain visible to the default
+        :class:`~dabble.hashers.SHA1Hasher` (or as the `previous` hasher
+        of a :class:`~dabble.hashers.MigratingHasher`) once converted.
+        """
+        converted = 0
+        for result in self.results.find({'i': {'$type': 2}}, projection=['i']):
+            self.results.update_one({'_id': result['_id']},
+                                    {'$set': {'i': Binary(unhexlify(result['i']))}})
+            converted += 1
+        return converted
 
     def list_tests(self):
         """Return a list of string test names known."""
-        return [t['_id'] for t in self.tests.find(fields=['_id'])]
+        return [t['_id'] for t in self.tests.find(projection=['_id'])]
+
+    def _export(self, test_name, fields, after=None):
+        # result documents in _id order, from the one `after` was
+        # exported from, if it is still there
+        query = {'t': test_name}
+        if after is not None:
+            resumed = self.results.find_one(
+                {'t': test_name, 'i': Binary(after[0]), 'n': after[1]}, projection=['_id'])
+            if resumed is not None:
+                query['_id'] = {'$gte': resumed['_id']}
+
+        for result in self.results.find(query, projection=fields).sort('_id', ASCENDING):
+            identity = result['i']
+            if isinstance(identity, text_type):
+                # not yet converted by migrate_identities()
+                identity = unhexlify(identity)
+            yield bytes(identity), result
+
+    def export_alternatives(self, test_name, after=None):
+        for identity, result in self._export(test_name, ['i', 'n'], after):
+            exported = identity, result['n']
+            if after is None or exported != tuple(after):
+                yield exported
+
+    def export_results(self, test_name, after=None):
+        test = self.tests.find_one({'_id': test_name})
+        if test is None:
+            raise Exception('unknown test "%s"' % test_name)
+
+        for identity, result in self._export(test_name, ['i', 'n', 's', 'd'], after):
+            times = result.get('d', {})
+            steps = counted(test['s'], result['s'], times)
+            if after is not None and (identity, result['n']) == tuple(after[:2]) and \
+                    after[2] in steps:
+                # the rest of the document `after` was exported from
+                steps = steps[steps.index(after[2]) + 1:]
+            for step in steps:
+                yield identity, result['n'], step, times.get(step)
 
@@ -0,0 +1,149 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('assignments', 'assign')
+
+from dabble import AB
+from dabble.compat import range
+
+from bisect import bisect
+from itertools import islice
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _draw(n, count, weights, rand):
+    # draw count alternatives from range(n), with the given
+    # probabilities; rand is a numpy RandomState if numpy is
+    # available, otherwise a random.Random
+    if numpy is not None:
+        return rand.choice(n, size=count, p=weights).tolist()
+
+    cumulative = []
+    total = 0.0
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+    return [min(bisect(cumulative, rand.random() * total), n - 1) for i in range(count)]
+
+def _alternatives(test_name):
+    # the number of alternatives of a test known to storage
+    if AB._storage is None:
+        raise Exception('dabble is not configured')
+    tests = AB._storage.load_tests()
+    if test_name not in tests:
+        raise Exception('unknown test "%s"' % test_name)
+    return len(tests[test_name]['alternatives'])
+
+def assignments(test_name, identities, weights=None, batch_size=10000, seed=None):
+    """Assign alternatives of a test to many users at once, ahead of
+    their first visit; for instance, to the recipients of an email
+    campaign. Yield ``(identity, alternative)`` for each of
+    `identities`, in order, where `alternative` is the index of the
+    alternative the user will be shown.
+
+    Identities are hashed by the configured hasher, and alternatives
+    are drawn (with NumPy, if it is installed) and written to storage
+    with :meth:`~dabble.ResultStorage.set_alternatives`, a batch at a
+    time; each batch is written before it is yielded. Users who
+    already have an alternative keep it, as do users known by a
+    :class:`~dabble.hashers.MigratingHasher`'s previous identity, just
+    as :attr:`~dabble.ABTest.alternative` would find.
+
+    :Parameters:
+      - `test_name`: the string name of the test, which must be
+        known to storage
+      - `identities`: an iterable (or array) of identities, as an
+        :class:`~dabble.IdentityProvider` would return them
+      - `weights`: the relative probability of assigning each
+        alternative; by default, alternatives are equally likely
+      - `batch_size`: the number of identities hashed and
+        written at once
+      - `seed`: seed for drawing alternatives, for repeatable runs
+    """
+    storage = AB._storage
+    hasher = AB._hasher
+    n = _alternatives(test_name)
+
+    weights = weights or [1.0] * n
+    if len(weights) != n or min(weights) < 0 or not sum(weights):
+        raise Exception('weights must be %d non-negative numbers, not all zero' % n)
+    weights = [float(weight) / sum(weights) for weight in weights]
+
+    if numpy is not None:
+        rand = numpy.random.RandomState(seed)
+    else:
+        rand = random.Random(seed)
+
+    # existing assignments win over new ones; each batch's are looked
+    # up with get_alternatives(), along with those of the previous
+    # identities, and a batch is written before the next is looked
+    # up, which covers identities repeated across batches
+    previous = hasher.previous
+
+    identities = iter(identities)
+    while True:
+        batch = list(islice(identities, batch_size))
+        if not batch:
+            break
+
+        hashed = [hasher.hash(identity) for identity in batch]
+        before = [previous and previous.hash(identity) for identity in batch]
+        assigned = storage.get_alternatives(
+            hashed + [identity for identity in before if identity is not None], test_name)
+
+        drawn = iter(_draw(n, len(batch), weights, rand))
+        writes = []
+        alternatives = []
+        for hashed_identity, previous_identity in zip(hashed, before):
+            alternative = assigned.get(hashed_identity)
+            if alternative is None and previous_identity is not None:
+                alternative = assigned.get(previous_identity)
+                if alternative is not None:
+                    writes.append((hashed_identity, test_name, alternative))
+            if alternative is None:
+                alternative = next(drawn)
+                writes.append((hashed_identity, test_name, alternative))
+            # identities repeated within the batch
+            assigned[hashed_identity] = alternative
+            alternatives.append(alternative)
+
+        storage.set_alternatives(writes)
+        for identity, alternative in zip(batch, alternatives):
+            yield identity, alternative
+
+def assign(test_name, identities, **kwargs):
+    """Assign alternatives to many users, as :func:`assignments`
+    does, and return the number of users assigned to each
+    alternative, as a list.
+    """
+    counts = [0] * _alternatives(test_name)
+    for identity, alternative in assignments(test_name, identities, **kwargs):
+        counts[alternative] += 1
+    return counts
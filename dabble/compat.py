@@ -0,0 +1,62 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('PY2', 'text_type', 'range', 'izip', 'Queue', 'Empty', 'Full', 'quote',
+           'hexlify', 'to_bytes', 'to_text')
+
+import sys
+
+PY2 = sys.version_info[0] == 2
+
+if PY2:
+    text_type = unicode
+    range = xrange
+    from itertools import izip
+    from Queue import Queue, Empty, Full
+    from urllib import quote
+    from binascii import hexlify
+else:
+    text_type = str
+    range = range
+    izip = zip
+    from queue import Queue, Empty, Full
+    from urllib.parse import quote
+    from binascii import hexlify as _hexlify
+
+    def hexlify(data):
+        # hex digests are kept as (native) strings
+        return _hexlify(data).decode('ascii')
+
+def to_bytes(value):
+    # byte strings as they are, text encoded as UTF-8
+    if isinstance(value, bytes):
+        return value
+    return text_type(value).encode('utf-8')
+
+def to_text(value):
+    # text as it is, byte strings decoded as UTF-8
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
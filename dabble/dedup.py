@@ -0,0 +1,123 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('BloomFilter', 'Deduplicator')
+
+from dabble.compat import range, to_bytes
+
+from hashlib import md5
+from math import ceil, log
+import struct
+import threading
+import time
+
+
+class BloomFilter(object):
+
+    def __init__(self, capacity, error_rate):
+        """A fixed-size set of byte strings which may report false
+        positives (at about `error_rate` once `capacity` keys have
+        been added), but never false negatives.
+        """
+        self.bits = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+        self.hashes = max(1, int(round(self.bits / float(capacity) * log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing: k positions from two 64-bit hashes
+        a, b = struct.unpack('<QQ', md5(key).digest())
+        return [(a + i * b) % self.bits for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.array[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class Deduplicator(object):
+
+    def __init__(self, capacity=100000, error_rate=0.001, interval=3600, verify=True):
+        """Remember which actions this process has recently recorded,
+        so that repeats of them (for instance, page reloads recording
+        the first step of a test again) need not be written.
+
+        Two :class:`BloomFilter` generations are kept: keys are added
+        to the current one, and looked up in both. The current
+        generation becomes the previous one (and the oldest is
+        discarded) once it holds `capacity` keys or is `interval`
+        seconds old, which bounds memory use at two filters. Lookups
+        therefore have a false positive rate of up to about twice
+        `error_rate`.
+
+        Only the first step of each test's funnel is deduplicated:
+        repeats of it are never counted by reports, whereas a repeat
+        of a later step may complete a funnel an earlier occurrence
+        did not. When `verify` is `True`, the storage is asked (with
+        :meth:`~dabble.ResultStorage.has_action`) to confirm each
+        apparent repeat before it is skipped, so that false positives
+        cost a lookup rather than a lost action, and reports are the
+        same as without deduplication.
+
+        :Parameters:
+          - `capacity`: keys per generation
+          - `error_rate`: false positive rate of each generation
+          - `interval`: seconds after which a generation is rotated
+          - `verify`: confirm apparent repeats with the storage
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.interval = interval
+        self.verify = verify
+
+        self.lock = threading.Lock()
+        self._rotate()
+
+    def _rotate(self):
+        self.previous = getattr(self, 'current', None)
+        self.current = BloomFilter(self.capacity, self.error_rate)
+        self.started = time.time()
+
+    def key(self, identity, test_name, action):
+        """Return the key for `action` by (hashed) `identity` in a test."""
+        return b'\0'.join((identity, to_bytes(test_name), to_bytes(action)))
+
+    def add(self, key):
+        with self.lock:
+            if self.current.count >= self.capacity or \
+                    time.time() - self.started >= self.interval:
+                self._rotate()
+            self.current.add(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.current or \
+                self.previous is not None and key in self.previous
@@ -0,0 +1,196 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('DeferredResultStorage', )
+
+from dabble import ProxyResultStorage
+from dabble.util import utcnow
+
+from contextlib import contextmanager
+import threading
+
+
+class _Pending(object):
+    # the writes deferred by one thread
+
+    def __init__(self):
+        self.alternatives = {}
+        self.order = []
+        self.records = []
+
+
+class DeferredResultStorage(ProxyResultStorage):
+
+    def __init__(self, storage):
+        """Hold back the writes made between :meth:`begin` and
+        :meth:`flush`, and issue them together when :meth:`flush`
+        is called. Reads made in the meantime see the pending
+        writes. Writes are deferred per thread, so one storage
+        can serve concurrent requests; outside of
+        :meth:`begin`/:meth:`flush` writes go straight through.
+
+        :Parameters:
+          - `storage`: the :class:`~dabble.ResultStorage` to wrap
+        """
+        super(DeferredResultStorage, self).__init__(storage)
+        self.local = threading.local()
+
+    def _pending(self):
+        return getattr(self.local, 'pending', None)
+
+    def deferring(self):
+        """Return whether writes made by the current thread are
+        being deferred.
+        """
+        return self._pending() is not None
+
+    def begin(self):
+        """Start deferring writes made by the current thread."""
+        if self._pending() is not None:
+            raise Exception('writes are already deferred in this thread')
+        self.local.pending = _Pending()
+
+    def discard(self):
+        """Stop deferring writes made by the current thread, and
+        drop those pending without writing them.
+        """
+        self.local.pending = None
+
+    def flush(self):
+        """Stop deferring writes made by the current thread, and
+        write those pending: first the alternatives, then all of
+        the actions in one :meth:`~dabble.ResultStorage.record_many`
+        call.
+
+        Each alternative is set on its own, so that one which cannot
+        be set (because another request has set a different one
+        since, say) does not keep the rest from being written; only
+        the actions of that identity in that test are dropped. Once
+        everything else is written, an exception is raised for the
+        alternatives which could not be set.
+        """
+        pending = self._pending()
+        self.local.pending = None
+        if pending is None:
+            return
+
+        failed = []
+        for key in pending.order:
+            identity, test_name = key
+            try:
+                self.storage.set_alternative(identity, test_name, pending.alternatives[key])
+            except Exception as e:
+                failed.append((key, e))
+
+        dropped = set(key for key, e in failed)
+        records = [record for record in pending.records if record[:2] not in dropped]
+        if records:
+            self.storage.record_many(records)
+        if failed:
+            raise Exception('could not set %d deferred alternatives: %s' % (
+                len(failed), '; '.join(str(e) for key, e in failed)))
+
+    @contextmanager
+    def deferred(self):
+        """Defer the writes made within a ``with`` block, and
+        write them when it exits, even if it raised.
+        """
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.flush()
+
+    def set_alternative(self, identity, test_name, alternative):
+        pending = self._pending()
+        if pending is None:
+            return self.storage.set_alternative(identity, test_name, alternative)
+
+        key = (identity, test_name)
+        existing = pending.alternatives.get(key)
+        if existing is not None and existing != alternative:
+            raise Exception('different alternative already set for identity')
+        if existing is None:
+            pending.alternatives[key] = alternative
+            pending.order.append(key)
+
+    def set_alternatives(self, assignments):
+        if self._pending() is None:
+            return self.storage.set_alternatives(assignments)
+
+        for identity, test_name, alternative in assignments:
+            self.set_alternative(identity, test_name, alternative)
+
+    def get_alternative(self, identity, test_name):
+        pending = self._pending()
+        if pending is not None:
+            alternative = pending.alternatives.get((identity, test_name))
+            if alternative is not None:
+                return alternative
+        return self.storage.get_alternative(identity, test_name)
+
+    def get_alternatives(self, identities, test_name):
+        pending = self._pending()
+        if pending is None:
+            return self.storage.get_alternatives(identities, test_name)
+
+        found = {}
+        rest = []
+        for identity in identities:
+            alternative = pending.alternatives.get((identity, test_name))
+            if alternative is not None:
+                found[identity] = alternative
+            else:
+                rest.append(identity)
+        if rest:
+            found.update(self.storage.get_alternatives(rest, test_name))
+        return found
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        pending = self._pending()
+        if pending is None:
+            return self.storage.record(identity, test_name, alternative, action, timestamp)
+
+        # the time of the action, not of the flush, is recorded
+        timestamp = timestamp or utcnow()
+        pending.records.append((identity, test_name, alternative, action, timestamp))
+
+    def record_many(self, records):
+        pending = self._pending()
+        if pending is None:
+            return self.storage.record_many(records)
+
+        now = utcnow()
+        for identity, test_name, alternative, action, timestamp in records:
+            pending.records.append((identity, test_name, alternative, action, timestamp or now))
+
+    def has_action(self, identity, test_name, alternative, action):
+        pending = self._pending()
+        if pending is not None:
+            for record in pending.records:
+                if record[0] == identity and record[1] == test_name and \
+                   record[3] == action and alternative in (None, record[2]):
+                    return True
+        return self.storage.has_action(identity, test_name, alternative, action)
@@ -0,0 +1,178 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('federated_report', 'federated_report_many')
+
+from dabble.backends.fs import FSResultStorage, FirstStepIndex, encode_line, find_lines, \
+    merge_lines, tally, with_history
+from dabble.compat import range
+from dabble.sketch import TDigest
+from dabble.util import bucket, epoch, epoch_start, funnel_report, sparsearray
+
+from binascii import unhexlify
+from multiprocessing import Pool
+from os.path import join
+from shutil import rmtree
+import tempfile
+
+
+def _scatter(args):
+    # split the results of the tests in one directory into a file
+    # per partition, keeping the (timestamp) order they are read in
+    source, directory, tmpdir, partitions, tests, since, until, indexed = args
+    storage = FSResultStorage(directory, read_only=True)
+    pattern = len(tests) == 1 and {'t': tests[0]} or {}
+    # as in FSResultStorage.report_many(), results from before the
+    # window are needed to tell first steps from repeats, unless
+    # they can be looked up in the directories' indexes
+    if not indexed:
+        since = since and epoch_start
+
+    outputs = [open(join(tmpdir, '%d.%d.dabble' % (partition, source)), 'w')
+               for partition in range(partitions)]
+    try:
+        for result in storage._results(since, until, archived=tests, **pattern):
+            if result.get('t') in tests:
+                # identities are stored in hex
+                outputs[bucket(unhexlify(result['i']), partitions)].write(encode_line(result))
+    finally:
+        for output in outputs:
+            output.close()
+
+def _gather(args):
+    # count the funnels of one partition, whose identities' results
+    # from every directory are merged into timestamp order
+    partition, tmpdir, sources, tests, since, until, quantiles, indexes = args
+    results = merge_lines([find_lines(join(tmpdir, '%d.%d.dabble' % (partition, source)))
+                           for source in range(sources)])
+    if indexes:
+        results = with_history(results, _history([FirstStepIndex(path, read_only=True)
+                                                  for path in indexes], epoch(since)))
+    trials, timings = tally(tests, results, since, until, quantiles)
+
+    # as plain dictionaries, which can be pickled
+    return (dict((test_name, dict((n, dict(steps)) for n, steps in counts.items()))
+                 for test_name, counts in trials.items()),
+            dict((test_name, dict((n, dict(stages)) for n, stages in digests.items()))
+                 for test_name, digests in timings.items()))
+
+def _history(indexes, start):
+    # look up the first time each identity took each step before
+    # start, in every directory, for with_history()
+    def history(keys):
+        found = {}
+        for index in indexes:
+            for key, lines in index.lookup(keys, start).items():
+                found.setdefault(key, []).extend(lines)
+        return dict((key, sorted(lines, key=lambda line: line['d']))
+                    for key, lines in found.items())
+    return history
+
+def federated_report(directories, test_name, since=None, until=None, quantiles=None,
+                     workers=4, partitions=None, tmpdir=None):
+    """Return :func:`federated_report_many` of a single test."""
+    return federated_report_many(directories, [test_name], since, until, quantiles,
+                                 workers, partitions, tmpdir)[test_name]
+
+def federated_report_many(directories, test_names, since=None, until=None, quantiles=None,
+                          workers=4, partitions=None, tmpdir=None):
+    """Report on tests whose results are spread across the directories
+    of several :class:`~dabble.backends.fs.FSResultStorage` (for
+    instance, one on each web host), as
+    :meth:`~dabble.ResultStorage.report_many` would if every result
+    were in one directory. Per-directory reports cannot simply be
+    added, as an identity's steps may be recorded in several of them.
+
+    The work is done by a pool of `workers` processes, in two passes.
+    First, the results of the tests in each directory are split into
+    `partitions` (by default, one per worker) by a hash of their
+    identity, in temporary files under `tmpdir`. Then each partition's
+    results from every directory are merged into timestamp order, so
+    that its worker sees the whole history of its identities, and
+    counted. The counts of the partitions are summed into the reports.
+    Reports on a window of time only read the results in the window, if
+    every directory's index of the first time each identity took each
+    step (see :class:`~dabble.backends.fs.FirstStepIndex`) is complete.
+
+    Tests are defined by the first directory defining them. Results
+    recorded at the same instant in different directories are ordered
+    as the directories are.
+
+    :Parameters:
+      - `directories`: the paths of the storage directories
+      - `test_names`: the tests to report on
+      - `since`, `until`, `quantiles`: see
+        :meth:`~dabble.ResultStorage.report`
+      - `workers`: the number of processes to use
+      - `partitions`: the number of parts identities are split into
+      - `tmpdir`: the directory to write temporary files in
+    """
+    tests = {}
+    for directory in directories:
+        for test in find_lines(join(directory, 'tests.dabble')):
+            if test['t'] in test_names and test['t'] not in tests:
+                tests[test['t']] = test
+
+    for test_name in test_names:
+        if test_name not in tests:
+            raise Exception('unknown test "%s"' % test_name)
+
+    indexes = []
+    if since is not None:
+        storages = [FSResultStorage(directory, read_only=True) for directory in directories]
+        if all(storage.first_steps.complete() for storage in storages):
+            indexes = [storage.first_steps.path for storage in storages]
+
+    partitions = partitions or workers
+    work = tempfile.mkdtemp(dir=tmpdir)
+    pool = Pool(workers)
+    try:
+        names = sorted(tests)
+        pool.map(_scatter, [(source, directory, work, partitions, names, since, until,
+                             bool(indexes))
+                            for source, directory in enumerate(directories)])
+        counted = pool.map(_gather, [(partition, work, len(directories), tests,
+                                      since, until, quantiles, indexes)
+                                     for partition in range(partitions)])
+    finally:
+        pool.close()
+        pool.join()
+        rmtree(work)
+
+    trials = dict((test_name, sparsearray(int)) for test_name in tests)
+    timings = dict((test_name, sparsearray(TDigest)) for test_name in tests)
+    for counts, digests in counted:
+        for test_name in tests:
+            for n, steps in counts[test_name].items():
+                for step, count in steps.items():
+                    trials[test_name][n][step] += count
+            for n, stages in digests[test_name].items():
+                for stage, digest in stages.items():
+                    timings[test_name][n][stage].update(digest)
+
+    return dict((test_name, funnel_report(test_name, test['a'], test['s'],
+                                          trials[test_name], test.get('r'),
+                                          timings[test_name], quantiles))
+                for test_name, test in tests.items())
@@ -0,0 +1,327 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('GuardedResultStorage', 'CircuitBreaker')
+
+from dabble import ProxyResultStorage, StorageUnavailable
+from dabble.compat import Queue, range
+
+from collections import deque
+import threading
+import time
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        """Track failures of calls to a resource, and refuse calls
+        for a while once too many have failed in a row.
+
+        The breaker starts out closed. After `threshold` consecutive
+        failures it opens, and :meth:`allow` returns `False` until
+        `reset_timeout` seconds have passed. It then lets a single
+        probe call through; if that succeeds the breaker closes
+        again, otherwise it re-opens for another `reset_timeout`.
+
+        :Parameters:
+          - `threshold`: number of consecutive failures which
+            open the breaker
+          - `reset_timeout`: seconds to wait before probing an
+            open breaker
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def closed(self):
+        return self.opened_at is None
+
+    def allow(self):
+        """Return `True` if a call may be attempted now."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.probing or time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self.probing = True
+            return True
+
+    def success(self):
+        """Record a successful call. Return `True` if this
+        closed a previously open breaker.
+        """
+        with self.lock:
+            reopened = self.opened_at is not None
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            return reopened
+
+    def failure(self):
+        """Record a failed (or timed out) call."""
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                self.opened_at = time.time()
+            self.probing = False
+
+
+class _Call(object):
+    # a unit of work handed to a worker thread; the caller
+    # waits for it for at most the latency budget, after
+    # which the call is "abandoned" and, should it later
+    # fail, its `orphan` callback takes care of it
+
+    def __init__(self, func, args, orphan):
+        self.func = func
+        self.args = args
+        self.orphan = orphan
+
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.abandoned = False
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+
+        with self.lock:
+            self.done.set()
+            abandoned = self.abandoned
+
+        if abandoned and self.orphan is not None:
+            self.orphan(self)
+
+    def wait(self, timeout):
+        self.done.wait(timeout)
+        with self.lock:
+            if not self.done.is_set():
+                self.abandoned = True
+                return False
+            return True
+
+
+class _Pool(object):
+    # a fixed set of daemon threads, so that a call can
+    # be bounded in time without starting a thread per call
+
+    def __init__(self, size):
+        self.queue = Queue()
+        for i in range(size):
+            worker = threading.Thread(target=self.work, name='dabble-guard-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def work(self):
+        while True:
+            self.queue.get().run()
+
+    def submit(self, func, args=(), orphan=None):
+        call = _Call(func, args, orphan)
+        self.queue.put(call)
+        return call
+
+
+class GuardedResultStorage(ProxyResultStorage):
+
+    def __init__(self, storage, budget=0.1, threshold=5, reset_timeout=30.0,
+                 workers=4, spill_size=10000):
+        """Wrap a :class:`~dabble.ResultStorage` so that the calls
+        :class:`~dabble.AB` makes while rendering a page are bounded
+        in time.
+
+        Each :meth:`get_alternative`, :meth:`set_alternative`,
+        :meth:`record` and :meth:`has_action` call is run on a
+        worker thread and waited on for at most `budget` seconds.
+        Calls which time out or raise count as failures of a
+        :class:`CircuitBreaker`; while the breaker is open no calls
+        are attempted at all.
+
+        When a read cannot be answered, :class:`~dabble.StorageUnavailable`
+        is raised, and :class:`~dabble.AB` falls back to a deterministic
+        alternative derived from the identity, which it sets (unless
+        another is set first) along with the writes made under it.
+        Writes which cannot be made are kept in a bounded, in-process
+        spill queue, which is replayed by :meth:`replay` (automatically,
+        in the background, after the next call which succeeds). Writes
+        which merely time out are left to finish in the background, and
+        are spilled only if they then fail.
+
+        :Parameters:
+          - `storage`: the :class:`~dabble.ResultStorage` to wrap
+          - `budget`: seconds to wait for each storage call
+          - `threshold`: consecutive failures before the breaker opens
+          - `reset_timeout`: seconds before an open breaker is probed
+          - `workers`: number of threads used to run storage calls
+          - `spill_size`: maximum number of writes kept while storage
+            is unavailable; the oldest are dropped beyond that
+        """
+        super(GuardedResultStorage, self).__init__(storage)
+
+        self.budget = budget
+        self.breaker = CircuitBreaker(threshold, reset_timeout)
+        self.pool = _Pool(workers)
+        self.spilled = deque(maxlen=spill_size)
+        self.replaying = threading.Lock()
+        self.queue_lock = threading.Lock()
+        self.replay_queued = False
+
+    def _call(self, func, args, orphan=None):
+        # run func(*args) within the budget; return the finished
+        # _Call, or None if the breaker refused the call, or
+        # False if the call did not finish in time
+        if not self.breaker.allow():
+            return None
+
+        call = self.pool.submit(func, args, orphan)
+        if not call.wait(self.budget):
+            self.breaker.failure()
+            return False
+
+        if call.error is not None:
+            self.breaker.failure()
+        else:
+            # writes may have been spilled without the breaker
+            # opening, so any success is a chance to replay them
+            self.breaker.success()
+            if self.spilled:
+                self._queue_replay()
+        return call
+
+    def _queue_replay(self):
+        # replay in the background, unless a replay is already queued
+        with self.queue_lock:
+            if self.replay_queued:
+                return
+            self.replay_queued = True
+        self.pool.submit(self._queued_replay)
+
+    def _queued_replay(self):
+        with self.queue_lock:
+            self.replay_queued = False
+        self.replay()
+
+    def _spill(self, op, args):
+        self.spilled.append((op, args))
+
+    def _write(self, op, *args):
+        self._write_spilling(op, args, [(op, args)])
+
+    def _write_spilling(self, op, args, spills):
+        # spills lists the (op, args) calls to keep for replay
+        # should this write be refused or fail
+        def spill():
+            for spilled in spills:
+                self._spill(*spilled)
+
+        def orphan(call):
+            if call.error is not None:
+                spill()
+
+        # timed out calls (False) are left to finish, and
+        # spill themselves through orphan() if they fail
+        call = self._call(getattr(self.storage, op), args, orphan)
+        if call is None or call and call.error is not None:
+            spill()
+
+    def _read(self, op, *args):
+        call = self._call(getattr(self.storage, op), args)
+        if not call or call.error is not None:
+            raise StorageUnavailable('%s failed or took longer than %.3fs' % (op, self.budget))
+        return call.result
+
+    def get_alternative(self, identity, test_name):
+        return self._read('get_alternative', identity, test_name)
+
+    def get_alternatives(self, identities, test_name):
+        return self._read('get_alternatives', list(identities), test_name)
+
+    def has_action(self, identity, test_name, alternative, action):
+        return self._read('has_action', identity, test_name, alternative, action)
+
+    def set_alternative(self, identity, test_name, alternative):
+        self._write('set_alternative', identity, test_name, alternative)
+
+    def set_alternatives(self, assignments):
+        assignments = [tuple(assignment) for assignment in assignments]
+        self._write_spilling('set_alternatives', (assignments, ),
+                             [('set_alternative', assignment) for assignment in assignments])
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        self._write('record', identity, test_name, alternative, action, timestamp)
+
+    def record_many(self, records):
+        # a failed batch is spilled as individual records, so
+        # that replay() can check each one's alternative
+        records = [tuple(record) for record in records]
+        self._write_spilling('record_many', (records, ),
+                             [('record', record) for record in records])
+
+    def replay(self):
+        """Write spilled calls through to the wrapped storage, in
+        the order they were made. Stop (keeping the remaining calls
+        queued) at the first error. Return the number of calls
+        written (not counting those skipped or dropped).
+
+        Before each spilled call the stored alternative is checked:
+        a spilled :meth:`set_alternative` is skipped if an alternative
+        is already stored, and a spilled :meth:`record` is dropped if
+        it was made for a fallback alternative other than the stored
+        one, since the user was not shown the stored alternative.
+        """
+        if not self.replaying.acquire(False):
+            return 0
+
+        written = 0
+        try:
+            while self.spilled:
+                op, args = self.spilled.popleft()
+                identity, test_name, alternative = args[:3]
+                try:
+                    stored = self.storage.get_alternative(identity, test_name)
+                    if stored is None:
+                        self.storage.set_alternative(identity, test_name, alternative)
+                        stored = alternative
+                        if op == 'set_alternative':
+                            written += 1
+                    if op == 'record' and stored == alternative:
+                        self.storage.record(*args)
+                        written += 1
+                except Exception:
+                    self.spilled.appendleft((op, args))
+                    break
+        finally:
+            self.replaying.release()
+
+        return written
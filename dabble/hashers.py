@@ -0,0 +1,119 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('IdentityHasher', 'SHA1Hasher', 'Blake2bHasher', 'KeyedHasher',
+           'MigratingHasher')
+
+from dabble.compat import to_bytes
+
+from hashlib import sha1
+
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+
+class IdentityHasher(object):
+    """:class:`IdentityHasher` turns the identities returned by an
+    :class:`~dabble.IdentityProvider` into the short byte strings
+    which dabble passes to, and keeps in, its :class:`~dabble.ResultStorage`.
+    """
+
+    # the hasher whose identities this hasher replaces, if any;
+    # see MigratingHasher
+    previous = None
+
+    def hash(self, identity):
+        """Return the hashed identity, a byte string, for `identity`."""
+        raise Exception('Not implemented. Use a sub-class of IdentityHasher')
+
+class SHA1Hasher(IdentityHasher):
+    """Hash identities with SHA-1 (20 bytes). This is the default,
+    and the hash all versions of dabble before hashers could be
+    configured used.
+    """
+
+    def hash(self, identity):
+        return sha1(to_bytes(identity)).digest()
+
+class Blake2bHasher(IdentityHasher):
+
+    def __init__(self, digest_size=16, key=b''):
+        """Hash identities with BLAKE2b, which is faster than SHA-1,
+        and by default produces shorter (16 byte) hashes.
+
+        BLAKE2b is in :mod:`hashlib` from Python 3.6; on earlier
+        versions the `pyblake2` package is required.
+
+        :Parameters:
+          - `digest_size`: the size, in bytes, of the hashes
+          - `key`: an optional secret key (up to 64 bytes)
+        """
+        if blake2b is None:
+            raise Exception('BLAKE2b requires Python 3.6 or the pyblake2 package')
+
+        self.digest_size = digest_size
+        self.key = key
+
+        # set up (and key) the hash once, and copy it per identity
+        self.initial = blake2b(digest_size=digest_size, key=to_bytes(key))
+
+    def hash(self, identity):
+        h = self.initial.copy()
+        h.update(to_bytes(identity))
+        return h.digest()
+
+class KeyedHasher(Blake2bHasher):
+
+    def __init__(self, key):
+        """Hash identities to 8 bytes with keyed BLAKE2b. Keeping
+        the key secret prevents anyone from choosing identities that
+        collide, which matters more with hashes this short.
+        """
+        super(KeyedHasher, self).__init__(digest_size=8, key=key)
+
+class MigratingHasher(IdentityHasher):
+
+    def __init__(self, hasher, previous=None):
+        """Hash identities with `hasher`, while carrying over the
+        alternatives of users who were assigned one under the
+        identities of `previous` (by default, :class:`SHA1Hasher`).
+
+        When a user has no alternative stored under their new
+        identity, their old one is looked up, and if found, is stored
+        under the new identity, so that they keep seeing the same
+        alternative. Actions recorded before the migration remain
+        under the old identity, so reports only count funnels
+        completed entirely before or entirely after the change.
+        """
+        self.hasher = hasher
+        self.previous = previous or SHA1Hasher()
+
+    def hash(self, identity):
+        return self.hasher.hash(identity)
@@ -0,0 +1,390 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('LoadIdentityProvider', 'Population', 'Funnel', 'LoadGenerator',
+           'TimedLock', 'percentiles')
+
+from dabble import ABParameter, ABTest, IdentityProvider, ProxyResultStorage, configure
+from dabble.compat import range
+
+from bisect import bisect
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+import random
+import threading
+import time
+
+
+class LoadIdentityProvider(IdentityProvider):
+    """An :class:`~dabble.IdentityProvider` giving the identity of
+    the user simulated by the current thread.
+    """
+
+    def __init__(self):
+        super(LoadIdentityProvider, self).__init__()
+        self.local = threading.local()
+
+    def set_identity(self, identity):
+        self.local.identity = identity
+
+    def get_identity(self):
+        return self.local.identity
+
+
+class Population(object):
+
+    def __init__(self, users=10000, returning=0.8, skew=1.0):
+        """Simulated users. A visit is made by a new user, seen only
+        once, or by one of `users` returning users, who visit at rates
+        following Zipf's law: the user of rank `k` visits in proportion
+        to ``1 / k ** skew``.
+
+        :Parameters:
+          - `users`: the number of returning users
+          - `returning`: the fraction of visits made by returning users
+          - `skew`: the exponent of the Zipf distribution; 0 makes every
+            returning user equally likely, and larger values concentrate
+            visits on fewer users
+        """
+        self.users = users
+        self.returning = returning
+        self.cumulative = []
+        total = 0.0
+        for rank in range(1, users + 1):
+            total += 1.0 / rank ** skew
+            self.cumulative.append(total)
+
+    def visitor(self, rand):
+        """Return the identity of the next visitor, using the
+        :class:`random.Random` `rand`.
+        """
+        if not self.users or rand.random() >= self.returning:
+            return 'new-%016x' % rand.getrandbits(64)
+        rank = bisect(self.cumulative, rand.random() * self.cumulative[-1])
+        return 'user-%d' % min(rank, self.users - 1)
+
+
+class Funnel(object):
+
+    def __init__(self, test_name, alternatives, steps, conversion=0.5):
+        """A page running an A/B test. Each visit reads the test's
+        parameter, records the first step, and then each following
+        step with the probability given by `conversion`, until the
+        simulated user drops off.
+
+        :Parameters:
+          - `test_name`, `alternatives`, `steps`: as for
+            :class:`~dabble.ABTest`
+          - `conversion`: the probability of taking each step after the
+            first, having taken the one before it; a float for every
+            step, or a list with one for each step after the first
+        """
+        if not isinstance(conversion, (list, tuple)):
+            conversion = [conversion] * (len(steps) - 1)
+        if len(conversion) != len(steps) - 1:
+            raise Exception('conversion must have one rate per step after the first')
+
+        self.test_name = test_name
+        self.alternatives = alternatives
+        self.steps = steps
+        self.conversion = conversion
+        self.page = None
+
+    def setup(self):
+        # the test is declared once dabble is configured,
+        # as an application would when its pages are loaded
+        class Page(object):
+            abtest = ABTest(self.test_name, self.alternatives, self.steps)
+            parameter = ABParameter(self.test_name, self.alternatives)
+        self.page = Page()
+
+    def visit(self, rand):
+        page = self.page
+        # assigns the visitor an alternative on their first visit
+        page.parameter
+        page.abtest.record(self.steps[0])
+        for step, rate in zip(self.steps[1:], self.conversion):
+            if rand.random() >= rate:
+                break
+            page.abtest.record(step)
+
+
+class TimedLock(object):
+
+    def __init__(self, lock, waits):
+        """Wrap a lock, appending the time spent waiting for each
+        acquisition (in seconds) to the list `waits`.
+        """
+        self.lock = lock
+        self.waits = waits
+
+    def __getattr__(self, name):
+        return getattr(self.lock, name)
+
+    def acquire(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return self.lock.acquire(*args, **kwargs)
+        finally:
+            self.waits.append(time.time() - start)
+
+    def release(self):
+        return self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Return a dictionary of the given percentiles of `values`,
+    keyed like ``'p50'``, along with the ``'max'``, ``'mean'`` and
+    ``'count'``.
+    """
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    result = dict(('p%d' % point, values[min(len(values) - 1, len(values) * point // 100)])
+                  for point in points)
+    result['max'] = values[-1]
+    result['mean'] = sum(values) / len(values)
+    result['count'] = len(values)
+    return result
+
+
+class LoadGenerator(object):
+
+    def __init__(self, storage_factory, funnels, population=None, threads=4,
+                 processes=0, requests=10000, duration=None, seed=None):
+        """Run simulated visits against a storage, to find out how much
+        traffic a deployment can take. Visitors, drawn from a
+        :class:`Population` of new and returning users, visit pages
+        running A/B tests (each a :class:`Funnel`), in many threads and
+        optionally processes.
+
+        :Parameters:
+          - `storage_factory`: a callable returning the
+            :class:`~dabble.ResultStorage` to use; it is called once in
+            each process
+          - `funnels`: a list of :class:`Funnel`; each visit is to one,
+            chosen at random
+          - `population`: the :class:`Population` of visitors
+          - `threads`: the number of threads making visits, in each process
+          - `processes`: the number of processes to run, or 0 to run the
+            threads in this process (which must not have configured
+            dabble already)
+          - `requests`: the total number of visits to make
+          - `duration`: if given, stop after this many seconds even if
+            fewer visits were made
+          - `seed`: seed for choosing visitors, pages and drop-offs,
+            for repeatable runs
+        """
+        self.storage_factory = storage_factory
+        self.funnels = funnels
+        self.population = population or Population()
+        self.threads = threads
+        self.processes = processes
+        self.requests = requests
+        self.duration = duration
+        self.seed = seed
+
+    def run(self):
+        """Make the visits and return the results as a dictionary:
+        ``requests`` (the number of visits made), ``errors`` (the
+        number of those which raised an exception), ``elapsed`` (in
+        seconds), ``throughput`` (visits per second), ``latency`` (the
+        :func:`percentiles` of the time dabble took per visit) and
+        ``lock_wait`` (percentiles of the time spent waiting for the
+        ``thread`` and ``file`` locks of the filesystem storage, or
+        `None` for other storages).
+        """
+        if not self.processes:
+            return self._summarize([self._run(0, self.requests)])
+
+        queue = Queue()
+        share = self.requests // self.processes
+        children = [Process(target=self._child, args=(
+                            queue, n, share + (n < self.requests % self.processes)))
+                    for n in range(self.processes)]
+        for child in children:
+            child.start()
+        results = [queue.get() for child in children]
+        for child in children:
+            child.join()
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return self._summarize(results)
+
+    def _child(self, queue, index, requests):
+        try:
+            queue.put(self._run(index, requests))
+        except Exception as e:
+            queue.put(e)
+
+    def _run(self, index, requests):
+        # run the threads of one process
+        provider = LoadIdentityProvider()
+        storage = self.storage_factory()
+        configure(provider, storage)
+        for funnel in self.funnels:
+            funnel.setup()
+
+        # the locks of a filesystem storage (beneath any wrappers)
+        while isinstance(storage, ProxyResultStorage):
+            storage = storage.storage
+        waits = None
+        if hasattr(storage, 'thread_lock'):
+            waits = {'thread': [], 'file': []}
+            locks = storage.thread_lock, storage.lock
+            storage.thread_lock = TimedLock(storage.thread_lock, waits['thread'])
+            storage.lock = TimedLock(storage.lock, waits['file'])
+
+        latencies = []
+        errors = []
+        counts = [requests // self.threads + (n < requests % self.threads)
+                  for n in range(self.threads)]
+        deadline = self.duration and time.time() + self.duration
+
+        def work(n):
+            seed = self.seed is not None and (self.seed, index, n) or None
+            rand = random.Random(seed and hash(seed))
+            mine = []
+            failed = 0
+            for i in range(counts[n]):
+                if deadline and time.time() > deadline:
+                    break
+                provider.set_identity(self.population.visitor(rand))
+                funnel = rand.choice(self.funnels)
+                start = time.time()
+                try:
+                    funnel.visit(rand)
+                except Exception:
+                    # e.g. concurrent first visits by the same user
+                    # racing to set different alternatives
+                    failed += 1
+                mine.append(time.time() - start)
+            latencies.extend(mine)
+            errors.append(failed)
+
+        threads = [threading.Thread(target=work, args=(n, )) for n in range(self.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        if waits is not None:
+            storage.thread_lock, storage.lock = locks
+        return {'latencies': latencies, 'errors': sum(errors), 'elapsed': elapsed,
+                'waits': waits}
+
+    def _summarize(self, results):
+        latencies = sum((result['latencies'] for result in results), [])
+        elapsed = max(result['elapsed'] for result in results)
+        lock_wait = None
+        if all(result['waits'] is not None for result in results):
+            lock_wait = dict((name, percentiles(sum((result['waits'][name] for result in results), [])))
+                             for name in ('thread', 'file'))
+        return {
+            'requests': len(latencies),
+            'errors': sum(result['errors'] for result in results),
+            'elapsed': elapsed,
+            'throughput': elapsed and len(latencies) / elapsed or 0.0,
+            'latency': percentiles(latencies),
+            'lock_wait': lock_wait,
+        }
+
+
+# from the command line, for instance:
+#
+#   python -m dabble.loadgen --fs /tmp/dabble --threads 8 --requests 20000
+def main(argv=None):
+    parser = OptionParser(usage='%prog (--fs DIRECTORY | --mongodb DATABASE) [options]')
+    parser.add_option('--fs', metavar='DIRECTORY', help='use FSResultStorage in DIRECTORY')
+    parser.add_option('--segmented', action='store_true',
+                      help='with --fs, append to a file per process without locking')
+    parser.add_option('--mongodb', metavar='DATABASE', help='use MongoResultStorage in DATABASE')
+    parser.add_option('--host', default='localhost', help='MongoDB host [%default]')
+    parser.add_option('--threads', type='int', default=4, help='threads per process [%default]')
+    parser.add_option('--processes', type='int', default=0,
+                      help='processes, or 0 to run in this one [%default]')
+    parser.add_option('--requests', type='int', default=10000, help='visits to make [%default]')
+    parser.add_option('--duration', type='float', help='stop after this many seconds')
+    parser.add_option('--users', type='int', default=10000, help='returning users [%default]')
+    parser.add_option('--returning', type='float', default=0.8,
+                      help='fraction of visits by returning users [%default]')
+    parser.add_option('--skew', type='float', default=1.0,
+                      help='Zipf exponent of returning visits [%default]')
+    parser.add_option('--tests', type='int', default=2, help='number of A/B tests [%default]')
+    parser.add_option('--steps', type='int', default=3, help='steps per test [%default]')
+    parser.add_option('--conversion', type='float', default=0.3,
+                      help='probability of taking each next step [%default]')
+    parser.add_option('--seed', type='int')
+    options, args = parser.parse_args(argv)
+
+    if bool(options.fs) == bool(options.mongodb):
+        parser.error('give one of --fs or --mongodb')
+    if options.fs:
+        def storage_factory():
+            from dabble.backends.fs import FSResultStorage
+            return FSResultStorage(options.fs, segmented=options.segmented)
+    else:
+        def storage_factory():
+            import pymongo
+            from dabble.backends.mongodb import MongoResultStorage
+            return MongoResultStorage(pymongo.MongoClient(options.host)[options.mongodb])
+
+    funnels = [Funnel('load test %d' % n, ['a', 'b'],
+                      ['step %d' % step for step in range(options.steps)],
+                      options.conversion)
+               for n in range(options.tests)]
+    generator = LoadGenerator(
+        storage_factory, funnels,
+        Population(options.users, options.returning, options.skew),
+        threads=options.threads, processes=options.processes,
+        requests=options.requests, duration=options.duration, seed=options.seed)
+    result = generator.run()
+
+    def ms(stats, key):
+        return '%8.2f' % (stats.get(key, 0) * 1000)
+
+    print('%d visits (%d failed) in %.2fs: %.1f visits/s' % (
+        result['requests'], result['errors'], result['elapsed'], result['throughput']))
+    print('%-18s %8s %8s %8s %8s' % ('(ms)', 'p50', 'p90', 'p99', 'max'))
+    rows = [('latency', result['latency'])]
+    if result['lock_wait']:
+        rows += [('%s lock wait' % name, result['lock_wait'][name]) for name in ('thread', 'file')]
+    for name, stats in rows:
+        print('%-18s %s %s %s %s' % (name, ms(stats, 'p50'), ms(stats, 'p90'),
+                                     ms(stats, 'p99'), ms(stats, 'max')))
+
+if __name__ == '__main__':
+    main()
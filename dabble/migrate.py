@@ -0,0 +1,214 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('Migration', 'migrate')
+
+from dabble.compat import Empty, Queue, hexlify, range
+from dabble.util import epoch_start
+
+from binascii import unhexlify
+from datetime import timedelta
+from itertools import islice
+from os import rename
+from os.path import exists
+import json
+import threading
+
+
+class Migration(object):
+
+    def __init__(self, source, target, batch_size=10000, workers=4,
+                 checkpoint=None, progress=None):
+        """Copy A/B tests, with their alternatives and results, from one
+        :class:`~dabble.ResultStorage` to another, for instance to move
+        a deployment from :class:`~dabble.backends.fs.FSResultStorage`
+        to :class:`~dabble.backends.mongodb.MongoResultStorage`.
+
+        Alternatives and results are streamed from the source (see
+        :meth:`~dabble.ResultStorage.export_results`) and written to
+        the target in batches, so only a few batches of them are held
+        in memory at once. Only the results which count towards a
+        report are copied, so :meth:`~dabble.ResultStorage.report`
+        gives the same results on both sides; to tell which those
+        are, :class:`~dabble.backends.fs.FSResultStorage` keeps the
+        furthest step of every identity in the test in memory.
+
+        Tests are copied in parallel, each by one worker. If a checkpoint
+        file is given, the last alternative and result copied for each
+        test are saved there after each batch, and a migration which is
+        run again resumes after them (see
+        :meth:`~dabble.ResultStorage.export_alternatives`). Results
+        recorded in the source while it is being copied may or may not
+        be copied.
+
+        :Parameters:
+          - `source`: the :class:`~dabble.ResultStorage` to copy from
+          - `target`: the :class:`~dabble.ResultStorage` to copy to
+          - `batch_size`: the number of alternatives or results written
+            to the target at once
+          - `workers`: the number of tests copied at once
+          - `checkpoint`: the path of a file in which to keep progress
+          - `progress`: a callable, called after each batch as
+            ``progress(test_name, kind, count)``, where `kind` is
+            ``'alternatives'`` or ``'results'`` and `count` the number of
+            them copied so far for the test
+        """
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.progress = progress
+
+        self.lock = threading.Lock()
+        self.state = {}
+        if checkpoint and exists(checkpoint):
+            with open(checkpoint, 'r') as fp:
+                self.state = json.load(fp)
+
+    def run(self, test_names=None):
+        """Copy the named tests, or every test in the source, and
+        return the number of alternatives and results copied for each
+        test, as a dictionary like ``{test_name: {'alternatives': n,
+        'results': n}}``. Counts include those copied by earlier runs
+        (and those copied again on resuming).
+        """
+        tests = self.source.load_tests()
+        if test_names is None:
+            test_names = sorted(tests)
+        for test_name in test_names:
+            if test_name not in tests:
+                raise Exception('unknown test "%s"' % test_name)
+
+        # save every test before copying any results, so that
+        # a conflicting test in the target stops the migration
+        for test_name in test_names:
+            test = tests[test_name]
+            self.target.save_test(test_name, test['alternatives'], test['steps'],
+                                  test['sampling'])
+            self.state.setdefault(test_name, {'alternatives': 0, 'results': 0})
+
+        queue = Queue()
+        for test_name in test_names:
+            queue.put(test_name)
+
+        errors = []
+        def work():
+            while True:
+                try:
+                    test_name = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    self._copy(test_name)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=work)
+                   for i in range(min(self.workers, len(test_names)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+
+        return dict((test_name, {'alternatives': self.state[test_name]['alternatives'],
+                                 'results': self.state[test_name]['results']})
+                    for test_name in test_names)
+
+    def _copy(self, test_name):
+        def set_alternatives(batch):
+            self.target.set_alternatives(
+                [(identity, test_name, alternative) for identity, alternative in batch])
+
+        def record_many(batch):
+            self.target.record_many(
+                [(identity, test_name, alternative, action, timestamp)
+                 for identity, alternative, action, timestamp in batch])
+
+        self._stream(test_name, 'alternatives', self.source.export_alternatives,
+                     set_alternatives)
+        self._stream(test_name, 'results', self.source.export_results, record_many)
+
+    def _stream(self, test_name, kind, export, write):
+        with self.lock:
+            state = self.state[test_name]
+            count = state[kind]
+            after = state.get('after', {}).get(kind)
+
+        if after is not None:
+            items = export(test_name, _decode(after))
+        else:
+            # checkpoints saved before the last items copied were
+            # kept only have counts, of the first items exported
+            items = islice(export(test_name), count, None)
+        while True:
+            batch = list(islice(items, self.batch_size))
+            if not batch:
+                break
+
+            write(batch)
+            count += len(batch)
+            with self.lock:
+                state[kind] = count
+                state.setdefault('after', {})[kind] = _encode(batch[-1])
+                self._save()
+            if self.progress:
+                self.progress(test_name, kind, count)
+
+    def _save(self):
+        if not self.checkpoint:
+            return
+
+        # replaced in one step, so that a crash cannot
+        # leave a partly written checkpoint behind
+        temp = self.checkpoint + '.tmp'
+        with open(temp, 'w') as fp:
+            json.dump(self.state, fp)
+        rename(temp, self.checkpoint)
+
+
+def _encode(exported):
+    # an exported tuple, as JSON: the identity in hexadecimal, and
+    # the timestamp (of results) in microseconds since the epoch
+    encoded = [hexlify(exported[0])] + list(exported[1:])
+    if len(exported) == 4 and exported[3] is not None:
+        elapsed = exported[3] - epoch_start
+        encoded[3] = (elapsed.days * 86400 + elapsed.seconds) * 1000000 + elapsed.microseconds
+    return encoded
+
+def _decode(encoded):
+    exported = [unhexlify(encoded[0])] + encoded[1:]
+    if len(encoded) == 4 and encoded[3] is not None:
+        exported[3] = epoch_start + timedelta(microseconds=encoded[3])
+    return tuple(exported)
+
+def migrate(source, target, test_names=None, **kwargs):
+    """Copy tests from `source` to `target`; a shortcut for
+    ``Migration(source, target, **kwargs).run(test_names)``.
+    """
+    return Migration(source, target, **kwargs).run(test_names)
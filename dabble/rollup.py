@@ -0,0 +1,235 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('Rollup', 'RollupResultStorage', 'resolutions')
+
+from dabble import ProxyResultStorage
+from dabble.compat import range
+from dabble.util import epoch, utcnow
+
+from datetime import datetime, timedelta
+import heapq
+import threading
+
+
+# the bucket sizes kept, in seconds
+resolutions = {'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class Rollup(object):
+
+    def __init__(self, tests, retention=None):
+        """Count the identities reaching each step of each test's
+        funnel, per alternative, in buckets of a minute, an hour and
+        a day. An identity is counted at a step the first time it
+        takes the step after reaching the one before, as in
+        :meth:`~dabble.ResultStorage.report`, so the counts summed
+        over all time match the report's.
+
+        Actions are counted in all three resolutions at once; buckets
+        older than the retention of their resolution (measured from
+        the latest action counted) are dropped, so older periods are
+        only available in coarser buckets. The step each identity has
+        reached is forgotten once it has taken no action for the
+        longest of the retentions, after which its actions are
+        counted as if it were new.
+
+        :Parameters:
+          - `tests`: a callable returning tests as
+            :meth:`~dabble.ResultStorage.load_tests` does, called when
+            an action of a test not seen before is added
+          - `retention`: a dictionary mapping each resolution to the
+            number of seconds of its buckets to keep, or to `None` to
+            keep them all; by default two days of minutes, 90 days of
+            hours and every day
+        """
+        self.tests = tests
+        self.retention = {'minute': 2 * 86400, 'hour': 90 * 86400, 'day': None}
+        self.retention.update(retention or {})
+        kept = [seconds for seconds in self.retention.values() if seconds is not None]
+        self.horizon = max(kept) if kept else None
+        self.lock = threading.Lock()
+        self.known = {}
+        self.clear()
+
+    def clear(self):
+        """Forget every action counted."""
+        with self.lock:
+            # (test, resolution) => {bucket start: {(alternative, step): count}}
+            self.series = {}
+            # (test, resolution) => heap of bucket starts, to expire
+            self.starts = {}
+            # (test, identity) => [step reached, when, {later step: first time},
+            #                       last action]
+            self.reached = {}
+            # heap of (last action, (test, identity)), to forget
+            self.idle = []
+            self.latest = None
+            # tests not found when the tests were last read
+            self.missing = set()
+
+    def _test(self, test_name):
+        if test_name not in self.known and test_name not in self.missing:
+            self.known = self.tests()
+            self.missing = set()
+            if test_name not in self.known:
+                self.missing.add(test_name)
+        return self.known.get(test_name)
+
+    def add(self, identity, test_name, alternative, action, timestamp):
+        """Count an action, at `timestamp` (in seconds since the
+        epoch). Actions which are not steps of the test, and repeats
+        of steps already taken, are ignored. Actions are expected in
+        about the order they were taken, though a step read before the
+        one preceding it is counted once that step is, if it was
+        taken after it.
+        """
+        with self.lock:
+            test = self._test(test_name)
+            if test is None or action not in test['steps']:
+                return
+            step = test['steps'].index(action)
+
+            self._forget()
+            key = (test_name, identity)
+            state = self.reached.get(key)
+            if state is None:
+                state = self.reached[key] = [-1, None, {}, timestamp]
+                heapq.heappush(self.idle, (timestamp, key))
+            state[3] = max(state[3], timestamp)
+            reached, when, early, seen = state
+            if step <= reached:
+                return
+
+            # a step first taken before the one preceding it was is
+            # left in early, and never counted
+            early[step] = min(early.get(step, timestamp), timestamp)
+            while reached + 1 in early and (when is None or early[reached + 1] >= when):
+                reached += 1
+                when = early.pop(reached)
+                self._count(test_name, alternative, reached, when)
+            state[0], state[1] = reached, when
+
+    def _count(self, test_name, alternative, step, timestamp):
+        if self.latest is None or timestamp > self.latest:
+            self.latest = timestamp
+        for resolution, size in resolutions.items():
+            key = (test_name, resolution)
+            series = self.series.setdefault(key, {})
+            start = int(timestamp // size * size)
+            counts = series.get(start)
+            if counts is None:
+                counts = series[start] = {}
+                heapq.heappush(self.starts.setdefault(key, []), start)
+                self._expire(key, resolution)
+            counts[(alternative, step)] = counts.get((alternative, step), 0) + 1
+
+    def _expire(self, key, resolution):
+        retention = self.retention.get(resolution)
+        if retention is None:
+            return
+        series, starts = self.series[key], self.starts[key]
+        while starts and starts[0] + resolutions[resolution] <= self.latest - retention:
+            del series[heapq.heappop(starts)]
+
+    def _forget(self):
+        if self.horizon is None or self.latest is None:
+            return
+        idle = self.idle
+        while idle and idle[0][0] < self.latest - self.horizon:
+            seen, key = heapq.heappop(idle)
+            state = self.reached[key]
+            if state[3] > seen:
+                # active since it was pushed
+                heapq.heappush(idle, (state[3], key))
+            else:
+                del self.reached[key]
+
+    def timeseries(self, test_name, start, end, resolution='minute'):
+        """Return the counts of a test from `start` (inclusive) to
+        `end` (exclusive), both naive UTC :class:`~datetime.datetime`,
+        at the given resolution ("minute", "hour" or "day"), in the
+        format described by :meth:`~dabble.ResultStorage.timeseries`.
+        Only the buckets in that period are read.
+        """
+        if resolution not in resolutions:
+            raise Exception('unknown resolution "%s"' % resolution)
+        size = resolutions[resolution]
+
+        with self.lock:
+            test = self._test(test_name)
+            if test is None:
+                raise Exception('unknown test "%s"' % test_name)
+
+            series = self.series.get((test_name, resolution), {})
+            first = int(epoch(start) // size * size)
+            buckets = [(bucket, series.get(bucket, {}))
+                       for bucket in range(first, int(epoch(end)), size)]
+
+        epoch_start = datetime(1970, 1, 1)
+        return {
+            'test_name': test_name,
+            'resolution': resolution,
+            'times': [epoch_start + timedelta(seconds=bucket) for bucket, counts in buckets],
+            'results': [{
+                'alternative': alternative,
+                'steps': dict((action, [counts.get((n, step), 0) for bucket, counts in buckets])
+                              for step, action in enumerate(test['steps'])),
+            } for n, alternative in enumerate(test['alternatives'])],
+        }
+
+
+class RollupResultStorage(ProxyResultStorage):
+
+    def __init__(self, storage, retention=None):
+        """Keep a :class:`Rollup` of the actions recorded through
+        this storage, for :meth:`timeseries`. Only the actions this
+        process records are counted; storages which can read the
+        actions of every process (like
+        :class:`~dabble.backends.fs.FSResultStorage`) implement
+        :meth:`~dabble.ResultStorage.timeseries` themselves.
+
+        :Parameters:
+          - `storage`: the :class:`~dabble.ResultStorage` to wrap
+          - `retention`: see :class:`Rollup`
+        """
+        super(RollupResultStorage, self).__init__(storage)
+        self.rollup = Rollup(storage.load_tests, retention)
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        timestamp = timestamp or utcnow()
+        self.storage.record(identity, test_name, alternative, action, timestamp)
+        self.rollup.add(identity, test_name, alternative, action, epoch(timestamp))
+
+    def record_many(self, records):
+        now = utcnow()
+        records = [(identity, test_name, alternative, action, timestamp or now)
+                   for identity, test_name, alternative, action, timestamp in records]
+        self.storage.record_many(records)
+        for identity, test_name, alternative, action, timestamp in records:
+            self.rollup.add(identity, test_name, alternative, action, epoch(timestamp))
+
+    def timeseries(self, test_name, start, end, resolution='minute'):
+        return self.rollup.timeseries(test_name, start, end, resolution)
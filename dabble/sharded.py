@@ -0,0 +1,275 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('HashRing', 'ShardedResultStorage', 'merge_reports')
+
+from dabble import ResultStorage
+from dabble.compat import range
+from dabble.sketch import TDigest
+from dabble.util import bucket, funnel_report, sparsearray
+
+from bisect import bisect
+from hashlib import md5
+import threading
+
+
+# positions on the ring are the leading 64 bits of a hash
+_ring = 1 << 64
+
+class HashRing(object):
+
+    def __init__(self, names, replicas=100):
+        """Map identities onto the named shards by consistent hashing:
+        each shard is placed at `replicas` points on a ring, and an
+        identity belongs to the shard at the first point after its
+        own. Adding or removing a shard only moves the identities
+        between its points and the ones before them.
+
+        :Parameters:
+          - `names`: the (string) names of the shards
+          - `replicas`: the number of points per shard
+        """
+        if not names:
+            raise Exception('a hash ring needs at least one shard')
+
+        points = sorted((bucket(md5(('%s-%d' % (name, replica)).encode('utf-8')).digest(), _ring),
+                         name)
+                        for name in names for replica in range(replicas))
+        self.points = [point for point, name in points]
+        self.names = [name for point, name in points]
+
+    def lookup(self, identity):
+        """Return the name of the shard `identity` belongs to."""
+        index = bisect(self.points, bucket(identity, _ring)) % len(self.points)
+        return self.names[index]
+
+
+def _fan_out(call, storages):
+    # call `call` with each of the storages, in a thread apiece,
+    # returning the results in order; the first error is re-raised
+    if len(storages) == 1:
+        return [call(storages[0])]
+
+    results = [None] * len(storages)
+    errors = []
+    def run(index, storage):
+        try:
+            results[index] = call(storage)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(index, storage))
+               for index, storage in enumerate(storages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
+
+def merge_reports(reports, quantiles=None):
+    """Combine reports on one test, from storages holding disjoint sets
+    of identities, into the report a single storage holding all of
+    them would give.
+
+    :Parameters:
+      - `reports`: a list of reports, as returned by
+        :meth:`~dabble.ResultStorage.report`
+      - `quantiles`: the quantiles the reports were requested with
+    """
+    first = reports[0]
+    funnel = first['results'] and first['results'][0]['funnel']
+    if not funnel:
+        # a single step has no stages to count
+        return first
+
+    steps = [stage['stage'][0] for stage in funnel] + [funnel[-1]['stage'][1]]
+    sampling = None
+    if 'sampling' in first:
+        sampling = [first['sampling']['rates'][step] for step in steps]
+
+    trials = sparsearray(int)
+    timings = sparsearray(TDigest)
+    for report in reports:
+        for n, alt in enumerate(report['results']):
+            for s, stage in enumerate(alt['funnel']):
+                counts = stage.get('sampled', stage)
+                if s == 0:
+                    trials[n][0] += counts['attempted']
+                trials[n][s + 1] += counts['converted']
+                if quantiles is not None:
+                    timings[n][s].update(stage['time_to_convert']['digest'])
+
+    return funnel_report(first['test_name'], [alt['alternative'] for alt in first['results']],
+                         steps, trials, sampling, timings, quantiles)
+
+
+class ShardedResultStorage(ResultStorage):
+
+    def __init__(self, shards, previous=None, replicas=100):
+        """Spread identities across several storages (of any kind), by
+        consistent hashing of their identity with a :class:`HashRing`.
+        All of an identity's alternatives and actions are kept by one
+        shard, so reports are the sums of the shards' reports, which
+        are requested in parallel, as are :meth:`save_test` and
+        :meth:`list_tests`.
+
+        To reshard, pass the shards before the change as `previous`:
+        identities already assigned an alternative by the shard the
+        previous ring gave them stay there, and only new identities
+        are placed by the current ring. Until the identities whose
+        shard changed are migrated (or no longer matter), looking one
+        up costs a read of both shards. Tests are only loaded if
+        every shard has them, so that :func:`~dabble.configure` saves
+        them to new shards.
+
+        :Parameters:
+          - `shards`: a dictionary mapping shard names to
+            :class:`~dabble.ResultStorage` instances
+          - `previous`: a dictionary of the shards before resharding,
+            or `None`; shards of the same name must be the same storage
+          - `replicas`: see :class:`HashRing`
+        """
+        self.storages = dict(previous or {})
+        self.storages.update(shards)
+        self.ring = HashRing(sorted(shards), replicas)
+        self.previous = previous and HashRing(sorted(previous), replicas) or None
+
+    def _shards(self):
+        return [self.storages[name] for name in sorted(self.storages)]
+
+    def _route(self, identity, test_name):
+        # return the name of the shard holding (or to hold)
+        # identity's alternative and actions in the test
+        name = self.ring.lookup(identity)
+        if self.previous is not None:
+            before = self.previous.lookup(identity)
+            if before != name and \
+               self.storages[name].get_alternative(identity, test_name) is None and \
+               self.storages[before].get_alternative(identity, test_name) is not None:
+                return before
+        return name
+
+    def _route_many(self, items):
+        # group (identity, test_name, ...) tuples by shard
+        shards = {}
+        for item in items:
+            shards.setdefault(self._route(item[0], item[1]), []).append(item)
+        return shards
+
+    def save_test(self, test_name, alternatives, steps, sampling=None):
+        _fan_out(lambda shard: shard.save_test(test_name, alternatives, steps, sampling),
+                 self._shards())
+
+    def load_tests(self):
+        # only tests every shard has (a shard added when resharding
+        # has none), so that the others are saved to all of them
+        loaded = _fan_out(lambda shard: shard.load_tests(), self._shards())
+        return dict((test_name, test) for test_name, test in loaded[0].items()
+                    if all(test_name in tests for tests in loaded[1:]))
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        self.storages[self._route(identity, test_name)].record(
+            identity, test_name, alternative, action, timestamp)
+
+    def record_many(self, records):
+        shards = self._route_many(records)
+        _fan_out(lambda name: self.storages[name].record_many(shards[name]), sorted(shards))
+
+    def has_action(self, identity, test_name, alternative, action):
+        return self.storages[self._route(identity, test_name)].has_action(
+            identity, test_name, alternative, action)
+
+    def set_alternative(self, identity, test_name, alternative):
+        self.storages[self._route(identity, test_name)].set_alternative(
+            identity, test_name, alternative)
+
+    def set_alternatives(self, assignments):
+        shards = self._route_many(assignments)
+        _fan_out(lambda name: self.storages[name].set_alternatives(shards[name]), sorted(shards))
+
+    def get_alternative(self, identity, test_name):
+        return self.storages[self._route(identity, test_name)].get_alternative(
+            identity, test_name)
+
+    def get_alternatives(self, identities, test_name):
+        shards = self._route_many((identity, test_name) for identity in identities)
+        found = {}
+        for alternatives in _fan_out(
+                lambda name: self.storages[name].get_alternatives(
+                    [item[0] for item in shards[name]], test_name),
+                sorted(shards)):
+            found.update(alternatives)
+        return found
+
+    def report(self, test_name, since=None, until=None, quantiles=None):
+        return self.report_many([test_name], since, until, quantiles)[test_name]
+
+    def report_many(self, test_names, since=None, until=None, quantiles=None):
+        test_names = list(test_names)
+        reports = _fan_out(lambda shard: shard.report_many(test_names, since, until, quantiles),
+                           self._shards())
+        return dict((test_name, merge_reports([report[test_name] for report in reports],
+                                              quantiles))
+                    for test_name in test_names)
+
+    def timeseries(self, test_name, start, end, resolution='minute'):
+        series = _fan_out(lambda shard: shard.timeseries(test_name, start, end, resolution),
+                          self._shards())
+        merged = series[0]
+        for other in series[1:]:
+            for alt, other_alt in zip(merged['results'], other['results']):
+                for step, counts in other_alt['steps'].items():
+                    alt['steps'][step] = [a + b for a, b in zip(alt['steps'][step], counts)]
+        return merged
+
+    def list_tests(self):
+        names = []
+        for listed in _fan_out(lambda shard: shard.list_tests(), self._shards()):
+            names.extend(name for name in listed if name not in names)
+        return names
+
+    def _resume(self, test_name, after):
+        # (shard, after) for each shard left to export from: the
+        # shard holding `after`'s identity resumes after it, and
+        # those exported from before it are skipped
+        resumed = after is None and True or self.storages[self._route(after[0], test_name)]
+        for shard in self._shards():
+            if resumed is True:
+                yield shard, None
+            elif shard is resumed:
+                resumed = True
+                yield shard, after
+
+    def export_alternatives(self, test_name, after=None):
+        for shard, resumed in self._resume(test_name, after):
+            for exported in shard.export_alternatives(test_name, resumed):
+                yield exported
+
+    def export_results(self, test_name, after=None):
+        for shard, resumed in self._resume(test_name, after):
+            for exported in shard.export_results(test_name, resumed):
+                yield exported
@@ -0,0 +1,148 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('TDigest', )
+
+from math import asin, pi, sin
+
+
+class TDigest(object):
+
+    def __init__(self, compression=100):
+        """A mergeable sketch of a distribution of numbers, from which
+        quantiles can be estimated (Dunning and Ertl's "merging"
+        t-digest). Values are summarized by at most about
+        `compression` centroids, however many are added; centroids
+        near the tails hold fewer values than those near the median,
+        so extreme quantiles (like the 99th percentile) stay accurate.
+
+        Digests built separately (for instance, by each shard of a
+        storage) are combined with :meth:`update`.
+        """
+        self.compression = compression
+        self.centroids = []
+        self.buffer = []
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value, weight=1):
+        self.buffer.append((value, weight))
+        self.count += weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.buffer) >= 5 * self.compression:
+            self._compress()
+
+    def update(self, other):
+        """Add the values summarized by `other` (a :class:`TDigest`)."""
+        if not other.count:
+            return
+        other._compress()
+        self.buffer.extend(other.centroids)
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._compress()
+
+    def _limit(self, q):
+        # the greatest quantile a centroid starting at q may
+        # reach, from the scale function k(q) = d/2pi asin(2q - 1)
+        k = self.compression / (2 * pi) * asin(max(-1.0, min(1.0, 2 * q - 1))) + 1
+        if k >= self.compression / 4.0:
+            return 1.0
+        return (sin(k * 2 * pi / self.compression) + 1) / 2
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        points = sorted(self.centroids + self.buffer)
+        self.buffer = []
+
+        total = float(self.count)
+        centroids = []
+        mean, weight = points[0]
+        sofar = 0
+        limit = self._limit(0)
+        for value, w in points[1:]:
+            if (sofar + weight + w) / total <= limit:
+                weight += w
+                mean += (value - mean) * w / weight
+            else:
+                centroids.append((mean, weight))
+                sofar += weight
+                limit = self._limit(sofar / total)
+                mean, weight = value, w
+        centroids.append((mean, weight))
+        self.centroids = centroids
+
+    def quantile(self, q):
+        """Return an estimate of the `q`-th quantile (between 0 and
+        1) of the values added, or `None` if there are none.
+        """
+        if not self.count:
+            return None
+        self._compress()
+        centroids = self.centroids
+        if len(centroids) == 1:
+            return centroids[0][0]
+
+        # values are interpolated between the centres of the
+        # centroids, and between the extremes and the outer centroids
+        target = q * self.count
+        mean, weight = centroids[0]
+        if target < weight / 2.0:
+            return self.min + (mean - self.min) * target / (weight / 2.0)
+
+        sofar = weight / 2.0
+        for (left, lw), (right, rw) in zip(centroids, centroids[1:]):
+            step = (lw + rw) / 2.0
+            if target <= sofar + step:
+                return left + (right - left) * (target - sofar) / step
+            sofar += step
+
+        mean, weight = centroids[-1]
+        return mean + (self.max - mean) * min(1.0, (target - sofar) / (weight / 2.0))
+
+    def to_dict(self):
+        """Return the digest as a dictionary of plain values (which
+        can be serialized as JSON), for :meth:`from_dict`.
+        """
+        self._compress()
+        return {'compression': self.compression, 'centroids': self.centroids,
+                'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        digest = cls(data['compression'])
+        digest.centroids = [tuple(centroid) for centroid in data['centroids']]
+        digest.count = sum(weight for mean, weight in digest.centroids)
+        digest.min = data['min']
+        digest.max = data['max']
+        return digest
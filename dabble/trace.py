@@ -0,0 +1,298 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('Span', 'Tracer', 'TracingResultStorage', 'LoggingSink')
+
+from dabble import ProxyResultStorage
+
+from os.path import join
+import cProfile
+import logging
+import pstats
+import random
+import threading
+import time
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    # before Python 3.7, spans are kept per thread
+    ContextVar = None
+
+
+class Span(object):
+    """A timed dabble operation. `name` names the operation (like
+    ``'record'`` or ``'lock wait'``), `attributes` holds details such
+    as the test name and the storage backend, `start` and `duration`
+    are in seconds, and `children` lists the spans of the operations
+    it made, its phases.
+    """
+
+    def __init__(self, name, attributes, parent=None):
+        self.name = name
+        self.attributes = attributes
+        self.parent = parent
+        self.children = []
+        self.start = time.time()
+        self.duration = None
+
+    def phases(self):
+        """Return a list of ``(name, seconds)`` for this span's
+        children, followed by the time spent in none of them as
+        ``'self'``.
+        """
+        phases = [(child.name, child.duration) for child in self.children]
+        phases.append(('self', self.duration - sum(child.duration for child in self.children)))
+        return phases
+
+    def __repr__(self):
+        return '<Span %s %r %.3fms>' % (self.name, self.attributes, (self.duration or 0) * 1000)
+
+
+class LoggingSink(object):
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        """A span sink which logs every span.
+
+        :Parameters:
+          - `logger`: the :class:`logging.Logger` to log to; by
+            default, the ``dabble.trace`` logger
+          - `level`: the level to log spans at
+        """
+        self.logger = logger or logging.getLogger('dabble.trace')
+        self.level = level
+
+    def __call__(self, span):
+        self.logger.log(self.level, '%s %.3fms %s', span.name, span.duration * 1000,
+                        ' '.join('%s=%s' % item for item in sorted(span.attributes.items())))
+
+
+class Tracer(object):
+
+    def __init__(self, sink=None, slow=None, logger=None, profile=0.0, profile_dir=None):
+        """Time dabble's operations. Pass a :class:`Tracer` to
+        :func:`dabble.configure` to trace the identity hash, the
+        lookup and assignment of alternatives, actions recorded, and
+        (for :class:`~dabble.backends.fs.FSResultStorage`) the time
+        spent waiting for locks.
+
+        :Parameters:
+          - `sink`: a callable, called with each finished :class:`Span`
+            (including those of phases within other spans), or `None`
+          - `slow`: a number of seconds; calls which take longer than
+            this are logged as warnings, with the test name, backend and
+            time spent in each phase
+          - `logger`: the :class:`logging.Logger` for slow calls and
+            profiles; by default, the ``dabble.trace`` logger
+          - `profile`: the fraction of reports to run under
+            :mod:`cProfile`
+          - `profile_dir`: a directory in which to save the profiles, to
+            be read with :mod:`pstats`; if `None`, the most expensive
+            functions of each profile are logged instead
+        """
+        self.sink = sink
+        self.slow = slow
+        self.logger = logger or logging.getLogger('dabble.trace')
+        self.profile = profile
+        self.profile_dir = profile_dir
+        # the span being timed: per context, so that coroutines
+        # running concurrently (each in a task, with a context of
+        # its own) do not nest their spans in each other's
+        if ContextVar is not None:
+            self.current = ContextVar('dabble.trace.%d' % id(self), default=None)
+        else:
+            self.local = threading.local()
+
+    def _current(self):
+        if ContextVar is not None:
+            return self.current.get()
+        return getattr(self.local, 'current', None)
+
+    def _set_current(self, span):
+        if ContextVar is not None:
+            self.current.set(span)
+        else:
+            self.local.current = span
+
+    def span(self, name, **attributes):
+        """Return a context manager timing the operation `name`,
+        as a phase of the operation being timed in this thread (or
+        coroutine), if there is one.
+        """
+        return _Timing(self, name, attributes)
+
+    def _open(self, name, attributes):
+        span = Span(name, attributes, self._current())
+        self._set_current(span)
+        return span
+
+    def _close(self, span):
+        span.duration = time.time() - span.start
+        if self._current() is span:
+            self._set_current(span.parent)
+        self._finish(span)
+
+    def add(self, name, duration, **attributes):
+        """Record an operation timed elsewhere, which took
+        `duration` seconds and ended just now.
+        """
+        span = Span(name, attributes, self._current())
+        span.start -= duration
+        span.duration = duration
+        self._finish(span)
+
+    def _finish(self, span):
+        if span.parent is not None:
+            span.parent.children.append(span)
+            for key, value in span.parent.attributes.items():
+                span.attributes.setdefault(key, value)
+        if self.sink is not None:
+            self.sink(span)
+        if span.parent is None and self.slow is not None and span.duration > self.slow:
+            self.logger.warning('slow dabble call: %s %.3fms %s (%s)',
+                span.name, span.duration * 1000,
+                ' '.join('%s=%s' % item for item in sorted(span.attributes.items())),
+                ', '.join('%s %.3fms' % (name, seconds * 1000) for name, seconds in span.phases()))
+
+    def lock_wait(self, filename, seconds):
+        # installed as the lock_wait_hook of the FSResultStorages
+        # wrapped by a TracingResultStorage
+        self.add('lock wait', seconds, file=filename)
+
+    def profiled(self, name, func, *args):
+        """Call ``func(*args)``, under :mod:`cProfile` for the
+        configured fraction of calls, and return its result.
+        """
+        if not self.profile or random.random() >= self.profile:
+            return func(*args)
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args)
+        finally:
+            if self.profile_dir:
+                path = join(self.profile_dir, '%s-%d.prof' % (name, time.time() * 1000))
+                profiler.dump_stats(path)
+                self.logger.info('saved profile of %s to %s', name, path)
+            else:
+                stream = _Lines()
+                pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(20)
+                self.logger.info('profile of %s:\n%s', name, ''.join(stream.lines))
+
+
+class _Timing(object):
+    # the context manager returned by Tracer.span()
+
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.span = self.tracer._open(self.name, self.attributes)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        self.tracer._close(self.span)
+
+
+def _hook_lock_waits(storage, hook):
+    # set the lock_wait_hook of every FSResultStorage within
+    # storage, through proxies and shards
+    if isinstance(storage, ProxyResultStorage):
+        _hook_lock_waits(storage.storage, hook)
+        return
+    if 'lock_wait_hook' in vars(storage):
+        storage.lock_wait_hook = hook
+    for shard in getattr(storage, 'storages', {}).values():
+        _hook_lock_waits(shard, hook)
+
+
+class _Lines(object):
+    # a file-like object collecting what is written to it
+
+    def __init__(self):
+        self.lines = []
+
+    def write(self, data):
+        self.lines.append(data)
+
+
+class TracingResultStorage(ProxyResultStorage):
+
+    def __init__(self, storage, tracer):
+        """Time each call to `storage` with `tracer`, and profile
+        reports as the tracer is configured to. :func:`dabble.configure`
+        wraps the storage in a :class:`TracingResultStorage` when it is
+        given a tracer.
+
+        :Parameters:
+          - `storage`: the :class:`~dabble.ResultStorage` to wrap
+          - `tracer`: the :class:`Tracer`
+        """
+        super(TracingResultStorage, self).__init__(storage)
+        self.tracer = tracer
+        self.backend = type(storage).__name__
+
+        _hook_lock_waits(storage, tracer.lock_wait)
+
+    def _span(self, name, test_name):
+        return self.tracer.span(name, test=test_name, backend=self.backend)
+
+    def get_alternative(self, identity, test_name):
+        with self._span('get_alternative', test_name):
+            return self.storage.get_alternative(identity, test_name)
+
+    def set_alternative(self, identity, test_name, alternative):
+        with self._span('set_alternative', test_name):
+            return self.storage.set_alternative(identity, test_name, alternative)
+
+    def has_action(self, identity, test_name, alternative, action):
+        with self._span('has_action', test_name):
+            return self.storage.has_action(identity, test_name, alternative, action)
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        with self._span('record', test_name):
+            return self.storage.record(identity, test_name, alternative, action, timestamp)
+
+    def record_many(self, records):
+        records = list(records)
+        with self.tracer.span('record_many', records=len(records), backend=self.backend):
+            return self.storage.record_many(records)
+
+    def report(self, test_name, since=None, until=None, quantiles=None):
+        with self._span('report', test_name):
+            return self.tracer.profiled('report', self.storage.report, test_name, since, until,
+                                        quantiles)
+
+    def report_many(self, test_names, since=None, until=None, quantiles=None):
+        with self.tracer.span('report_many', backend=self.backend):
+            return self.tracer.profiled('report_many', self.storage.report_many,
+                                        test_names, since, until, quantiles)
+
+    def report_all(self, since=None, until=None, quantiles=None):
+        with self.tracer.span('report_all', backend=self.backend):
+            return self.tracer.profiled('report_all', self.storage.report_all, since, until,
+                                        quantiles)
@@ -23,10 +23,17 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-__all__ = ('pairwise', 'sparsearray')
+__all__ = ('pairwise', 'sparsearray', 'bucket', 'fraction', 'epoch', 'epoch_start',
+           'utcnow', 'utc_from_epoch', 'counted', 'funnel_report')
 
-from itertools import tee, izip
+from dabble.compat import hexlify, izip, to_bytes
+
+from itertools import tee
 from collections import defaultdict
+from calendar import timegm
+from datetime import datetime, timedelta
+from zlib import crc32
+import time
 
 def pairwise(iterable):
     # s => (s0,s1), (s1,s2), (s2, s3), ...
@@ -36,4 +43,101 @@ def pairwise(iterable):
 
 def sparsearray(ctor):
     # return a 2D "sparse array" (nested dicts)
-    return defaultdict(lambda: defaultdict(int))
+    return defaultdict(lambda: defaultdict(ctor))
+
+def bucket(identity, n):
+    # deterministically map a hashed identity (bytes) to one
+    # of `n` buckets; the identity is already uniformly
+    # distributed, so its leading bits are enough
+    return int(hexlify(identity[:8]), 16) % n
+
+def fraction(identity, salt):
+    # deterministically map a hashed identity (bytes) to a
+    # number in [0, 1), differently for each salt
+    return (crc32(identity, crc32(to_bytes(salt))) & 0xffffffff) / 4294967296.0
+
+def epoch(timestamp):
+    # seconds since the epoch of a naive UTC datetime
+    return timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+# the earliest time results can be recorded at
+epoch_start = datetime(1970, 1, 1)
+
+def utc_from_epoch(seconds):
+    # the naive UTC datetime of seconds since the epoch (as
+    # datetime.utcfromtimestamp(), deprecated since Python 3.12)
+    return epoch_start + timedelta(seconds=seconds)
+
+def utcnow():
+    # the current time as a naive UTC datetime (as
+    # datetime.utcnow(), deprecated since Python 3.12)
+    return utc_from_epoch(time.time())
+
+def counted(funnel, taken, times, since=None, until=None):
+    # the steps of the funnel which count towards a report: those
+    # first taken in order (taken lists the steps in the order they
+    # were first taken, and times the time each was first taken),
+    # and, in windowed reports, within the window
+    steps = []
+    for step in funnel:
+        if step not in taken or steps and taken.index(step) < taken.index(steps[-1]):
+            break
+        if (since is not None or until is not None) and not (
+                step in times and (since is None or times[step] >= since) and
+                (until is None or times[step] < until)):
+            # steps recorded before timestamps were kept
+            # have no time, and are left out
+            break
+        steps.append(step)
+    return steps
+
+def funnel_report(test_name, alternatives, steps, trials, sampling=None,
+                  timings=None, quantiles=None):
+    # format the counts in `trials` (a sparsearray of the
+    # number of identities reaching each step, indexed by
+    # alternative and step) as returned by report(); when
+    # quantiles are requested, `timings` is a sparsearray of
+    # TDigests of the seconds taken to complete each stage
+    report = {
+        'test_name': test_name,
+        'results': []
+    }
+
+    if sampling is not None:
+        # only identities sampled at the first step can be counted
+        # at all; scale counts by the inverse of that probability,
+        # with the variance of that (Horvitz-Thompson) estimate
+        rate = sampling[0]
+        report['sampling'] = {'rates': dict(zip(steps, sampling)), 'weight': 1 / rate}
+
+    for i, alternative in enumerate(alternatives):
+        funnel = []
+        alt = {'alternative': alternative, 'funnel': funnel}
+        report['results'].append(alt)
+        for s, stepspair in enumerate(pairwise(steps)):
+            att = trials[i][s]
+            con = trials[i][s + 1]
+            stage = {
+                'stage': stepspair,
+                'attempted': att,
+                'converted': con,
+            }
+            if sampling is not None:
+                stage.update({
+                    'attempted': att / rate,
+                    'converted': con / rate,
+                    'sampled': {'attempted': att, 'converted': con},
+                    'variance': {
+                        'attempted': att * (1 - rate) / rate ** 2,
+                        'converted': con * (1 - rate) / rate ** 2,
+                    },
+                })
+            if quantiles is not None:
+                digest = timings[i][s]
+                stage['time_to_convert'] = {
+                    'quantiles': dict((q, digest.quantile(q)) for q in quantiles),
+                    'digest': digest,
+                }
+            funnel.append(stage)
+
+    return report
@@ -0,0 +1,94 @@
+# Copyright (c) 2011, Daniel Crosta
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+__all__ = ('DeferredWritesMiddleware', )
+
+import logging
+
+log = logging.getLogger('dabble')
+
+
+class _ClosingIterable(object):
+    # wraps a WSGI response so that a callback runs when the
+    # server closes it, i.e. once the body has been sent
+
+    def __init__(self, iterable, callback):
+        self.iterable = iterable
+        self.callback = callback
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            if hasattr(self.iterable, 'close'):
+                self.iterable.close()
+        finally:
+            self.callback()
+
+
+class DeferredWritesMiddleware(object):
+
+    def __init__(self, app, storage):
+        """WSGI middleware which defers the dabble writes made
+        while handling a request until the response has been sent,
+        so that they do not add to the page's latency.
+
+        The writes are flushed when the server calls ``close()`` on
+        the response, which it does after the whole body has been
+        handed to the client. Errors while flushing are logged to
+        the ``dabble`` logger rather than raised, since the response
+        has already been sent by then. Writes left pending by a
+        response the server never closed are flushed (and logged)
+        when the thread handles its next request.
+
+        :Parameters:
+          - `app`: the WSGI application to wrap
+          - `storage`: the :class:`~dabble.deferred.DeferredResultStorage`
+            configured with :func:`dabble.configure`
+        """
+        self.app = app
+        self.storage = storage
+
+    def flush(self):
+        try:
+            self.storage.flush()
+        except Exception:
+            log.exception('failed to write deferred dabble results')
+
+    def __call__(self, environ, start_response):
+        if self.storage.deferring():
+            log.warning('writing dabble results deferred by an earlier request')
+            self.flush()
+        self.storage.begin()
+        try:
+            response = self.app(environ, start_response)
+        except:
+            self.flush()
+            raise
+
+        # a file_wrapper response loses the server's sendfile()
+        # fast path once wrapped, but must still be flushed after
+        return _ClosingIterable(response, self.flush)
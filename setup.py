@@ -10,14 +10,14 @@ setup(
     name='dabble',
     version=__version__,
     description='Simple A/B testing framework',
-    long_description=file(abspath(join(dirname(__file__), 'README.md'))).read(),
+    long_description=open(abspath(join(dirname(__file__), 'README.md'))).read(),
     license='BSD',
     classifiers=[
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2.4",
-        "Programming Language :: Python :: 2.5",
-        "Programming Language :: Python :: 2.6",
         "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: Implementation :: CPython",
+        "Programming Language :: Python :: Implementation :: PyPy",
     ],
     author='Dan Crosta',
     author_email='dcrosta@late.am',
@@ -0,0 +1,118 @@
+import sys
+import unittest
+
+import dabble
+from dabble import *
+
+from test.test_backend import fs_setUp, fs_tearDown
+
+from dabble.trace import Tracer
+from dabble.util import bucket
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from dabble.aio import *
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio support requires Python 3.5')
+class AsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        fs_setUp(self)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        fs_tearDown(self)
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def check_record(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+            param = ABParameter('foobar', ['one', 'two'])
+
+        self.provider.identity = 1
+        self.assertEqual('one', self.run_async(T.__dict__['param'].aget()))
+        self.run_async(T.abtest.arecord('show'))
+        self.assertTrue(self.run_async(T.abtest.ahas_action('show')))
+        self.assertFalse(self.run_async(T.abtest.ahas_action('fill')))
+
+        self.provider.identity = 2
+        self.run_async(T.abtest.arecord('show'))
+        self.run_async(T.abtest.arecord('fill'))
+        self.assertEqual('two', T.param)
+
+        report = self.storage.report('foobar')
+        counts = [(r['funnel'][0]['attempted'], r['funnel'][0]['converted'])
+                  for r in report['results']]
+        self.assertEqual([(1, 0), (1, 1)], counts)
+
+    def test_threaded(self):
+        self.check_record()
+        self.assertTrue(isinstance(dabble.AB._astorage, ThreadedResultStorage))
+
+    def test_native_fs(self):
+        configure(AsyncFSResultStorage(self.storage.directory))
+        self.check_record()
+
+    def test_spans(self):
+        spans = []
+        dabble.AB._tracer = Tracer(spans.append)
+        try:
+            configure(AsyncFSResultStorage(self.storage.directory))
+            class T(object):
+                abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+
+            self.provider.identity = 1
+            self.run_async(T.abtest.arecord('show'))
+        finally:
+            dabble.AB._tracer = None
+
+        root = spans[-1]
+        self.assertEqual('record', root.name)
+        self.assertEqual(['hash', 'alternative'], [child.name for child in root.children])
+
+    def test_concurrent_spans(self):
+        spans = []
+        dabble.AB._tracer = Tracer(spans.append)
+        try:
+            configure(AsyncFSResultStorage(self.storage.directory))
+            class T(object):
+                abtests = [ABTest('foobar%d' % n, ['foo', 'bar'], ['show', 'fill'])
+                           for n in range(3)]
+
+            self.provider.identity = 1
+            asyncio.set_event_loop(self.loop)
+            self.run_async(asyncio.gather(*[abtest.arecord('show') for abtest in T.abtests]))
+        finally:
+            asyncio.set_event_loop(None)
+            dabble.AB._tracer = None
+
+        # each call's spans nest within it, however they interleave
+        roots = [span for span in spans if span.name == 'record']
+        self.assertEqual(3, len(roots))
+        for root in roots:
+            self.assertEqual(None, root.parent)
+            self.assertEqual(['hash', 'alternative'], [child.name for child in root.children])
+            self.assertTrue(all(child.attributes['test'] == root.attributes['test']
+                                for child in root.children))
+
+    def test_unavailable(self):
+        class Unavailable(ResultStorage):
+            def get_alternative(self, identity, test_name):
+                raise StorageUnavailable()
+            def has_action(self, identity, test_name, alternative, action):
+                raise StorageUnavailable()
+
+        configure(ThreadedResultStorage(Unavailable()))
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+
+        self.provider.identity = 1
+        identity = T.abtest.identity
+        self.assertEqual(bucket(identity, 2), self.run_async(T.abtest.aalternative()))
+        self.assertFalse(self.run_async(T.abtest.ahas_action('show')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+
+from dabble import analysis
+from dabble.analysis import *
+
+def report(test_name, *counts):
+    # a report with one stage per (attempted, converted)
+    # pair, for each alternative
+    return {
+        'test_name': test_name,
+        'results': [{
+            'alternative': 'alt%d' % n,
+            'funnel': [{'stage': ('step%d' % s, 'step%d' % (s + 1)),
+                        'attempted': attempted, 'converted': converted}
+                       for s, (attempted, converted) in enumerate(stages)],
+        } for n, stages in enumerate(counts)],
+    }
+
+@unittest.skipIf(analysis.numpy is None, 'dabble.analysis requires numpy')
+class AnalysisTest(unittest.TestCase):
+
+    def test_stage(self):
+        result = analyze(report('foobar', [(1000, 100)], [(1000, 130)]), seed=1)
+        control, other = [r['funnel'][0] for r in result['results']]
+
+        self.assertEqual(0.1, control['rate'])
+        self.assertEqual(None, control['z'])
+        self.assertEqual(None, control['posterior']['p_better'])
+
+        self.assertEqual(1000, other['attempted'])
+        self.assertAlmostEqual(0.03, other['difference'])
+        self.assertAlmostEqual(2.1027, other['z'], 4)
+        self.assertAlmostEqual(0.0355, other['p_value'], 4)
+        self.assertEqual((131, 871), (other['posterior']['alpha'], other['posterior']['beta']))
+        self.assertAlmostEqual(131 / 1002.0, other['posterior']['mean'])
+        self.assertTrue(0.95 < other['posterior']['p_better'] < 1)
+
+        lower, upper = other['interval']
+        self.assertTrue(0.105 < lower < 0.115 and 0.145 < upper < 0.155, (lower, upper))
+        lower, upper = other['difference_interval']
+        self.assertTrue(lower < 0.03 < upper and lower > -0.01 and upper < 0.07)
+        lower, upper = other['posterior']['interval']
+        self.assertTrue(0.105 < lower < 0.115 and 0.145 < upper < 0.155, (lower, upper))
+
+    def test_many(self):
+        # tests of different shapes are analyzed together, and
+        # the same as when analyzed alone
+        reports = {
+            'first': report('first', [(100, 10), (10, 5)], [(100, 20), (20, 10)]),
+            'second': report('second', [(50, 5)], [(50, 10)], [(0, 0)]),
+        }
+        results = analyze_many(reports, seed=1)
+        self.assertEqual(['first', 'second'], sorted(results))
+        self.assertEqual(2, len(results['first']['results'][1]['funnel']))
+
+        second = results['second']['results'][2]['funnel'][0]
+        self.assertEqual(None, second['rate'])
+        self.assertEqual(None, second['interval'])
+        self.assertEqual(None, second['p_value'])
+
+        first = analyze(reports['first'])['results'][1]['funnel'][1]
+        self.assertEqual(first['z'], results['first']['results'][1]['funnel'][1]['z'])
+
+    def test_seed(self):
+        foobar = report('foobar', [(100, 10)], [(100, 15)])
+        self.assertEqual(analyze(foobar, seed=5), analyze(foobar, seed=5))
+        self.assertNotEqual(analyze(foobar, seed=5), analyze(foobar, seed=6))
+
+    def test_control(self):
+        foobar = report('foobar', [(100, 10)], [(100, 15)])
+        result = analyze(foobar, control=1, seed=1)['results']
+        self.assertAlmostEqual(-0.05, result[0]['funnel'][0]['difference'])
+        self.assertEqual(None, result[1]['funnel'][0]['difference'])
+        self.assertRaises(Exception, analyze, foobar, control=2)
+
+    def test_sampled(self):
+        # scaled counts are not used, as they overstate the evidence
+        foobar = report('foobar', [(1000, 100)], [(1000, 130)])
+        for result in foobar['results']:
+            stage = result['funnel'][0]
+            stage['sampled'] = dict(stage)
+            stage['attempted'] *= 10
+            stage['converted'] *= 10
+
+        unsampled = report('foobar', [(1000, 100)], [(1000, 130)])
+        self.assertEqual(analyze(unsampled)['results'][1]['funnel'][0]['z'],
+                         analyze(foobar)['results'][1]['funnel'][0]['z'])
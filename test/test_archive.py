@@ -0,0 +1,153 @@
+import unittest
+
+from dabble.backends import fs
+from dabble.backends.fs import FSResultStorage, codecs, find_lines, prefetch, read_segment
+from dabble.util import utcnow
+
+from datetime import datetime, timedelta
+from os import remove
+from os.path import join
+import time
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_dir = make_storage_dir()
+
+        self.storage = FSResultStorage(self.storage_dir, readers=2)
+        self.scan_size = fs.scan_size
+        self.storage.save_test('foo bar', ['foo', 'bar'], ['show', 'fill'])
+        self.storage.save_test('other', ['foo', 'bar'], ['show', 'fill'])
+
+        self.start = datetime(2012, 3, 1, 12)
+        self.record_days(self.start, 3)
+
+    def tearDown(self):
+        fs.scan_size = self.scan_size
+        remove_storage_dir(self.storage_dir)
+
+    def record_days(self, start, days):
+        records = []
+        for day in range(days):
+            for n in range(20):
+                identity = b'user%02d-%d' % (n, day)
+                timestamp = start + timedelta(days=day, minutes=n)
+                for test_name in ('foo bar', 'other'):
+                    records.append((identity, test_name, n % 2, 'show', timestamp))
+                    if n % 3:
+                        records.append((identity, test_name, n % 2, 'fill', timestamp))
+        self.storage.record_many(records)
+
+    def live(self, test_name):
+        return sum(len(list(find_lines(path, t=test_name)))
+                   for path in self.storage.partitions())
+
+    def reports(self):
+        window = dict(since=self.start + timedelta(days=1), until=self.start + timedelta(days=2))
+        return (self.storage.report_all(), self.storage.report_all(**window))
+
+    def test_archive(self):
+        for compression in sorted(codecs):
+            self.setUp()
+            before = self.reports()
+            exported = list(self.storage.export_results('foo bar'))
+
+            self.assertEqual(99, self.storage.archive('foo bar', compression))
+            self.assertEqual(0, self.live('foo bar'))
+            self.assertEqual(99, self.live('other'))
+            self.assertEqual(3, len(self.storage.segments('foo bar')))
+
+            self.assertEqual(before, self.reports())
+            self.assertEqual(exported, list(self.storage.export_results('foo bar')))
+
+    def test_archive_again(self):
+        self.storage.archive('foo bar')
+
+        # results recorded after archiving join the archived ones
+        self.record_days(self.start + timedelta(days=2), 2)
+        before = self.reports()
+        self.assertEqual(66, self.storage.archive('foo bar', 'bz2'))
+        self.assertEqual(0, self.storage.archive('foo bar'))
+
+        segments = self.storage.segments('foo bar')
+        self.assertEqual(2, len(segments['2012-03-03.dabble']))
+        self.assertTrue(segments['2012-03-03.dabble'][1].endswith('.1.bz2'))
+        self.assertEqual(before, self.reports())
+
+        self.assertEqual(['2012-03-02.dabble'], list(self.storage.segments(
+            'foo bar', datetime(2012, 3, 2), datetime(2012, 3, 3))))
+
+    def test_segmented_writer(self):
+        # a segmented process holding a file of an earlier day
+        # open keeps writing after the file is archived
+        def counts():
+            funnel = self.storage.report('foo bar')['results'][0]['funnel']
+            return funnel[0]['attempted'], funnel[0]['converted']
+        attempted, converted = counts()
+
+        segmented = FSResultStorage(self.storage_dir, segmented=True)
+        when = self.start + timedelta(minutes=30)
+        segmented.record(b'late1', 'foo bar', 0, 'show', when)
+        self.assertEqual(100, self.storage.archive('foo bar'))
+
+        segmented.record_many([(b'late2', 'foo bar', 0, 'show', when),
+                               (b'late2', 'foo bar', 0, 'fill', when)])
+        self.assertEqual(2, self.live('foo bar'))
+        self.assertEqual((attempted + 2, converted + 1), counts())
+
+        # while the files of the last two days are not archived
+        today = utcnow()
+        segmented.record(b'today', 'foo bar', 0, 'show', today)
+        self.assertEqual(2, self.storage.archive('foo bar'))
+        self.assertEqual(1, self.live('foo bar'))
+
+    def test_streaming(self):
+        before = self.reports()
+        self.storage.archive('foo bar')
+
+        # segments are read a few lines at a time
+        fs.scan_size = 100
+        segment = self.storage.segments('foo bar')['2012-03-01.dabble'][0]
+        blocks = list(read_segment(segment))
+        self.assertTrue(len(blocks) > 10)
+        self.assertTrue(all(block.endswith(b'\n') for block in blocks))
+        self.assertEqual(before, self.reports())
+
+        # threads reading ahead stop once their values are not wanted
+        produced = []
+        def values(n):
+            for i in range(100):
+                produced.append(i)
+                yield i
+        fetched = prefetch(values, range(2), ahead=2, buffered=2)
+        self.assertEqual(0, next(next(fetched)))
+        fetched.close()
+        time.sleep(0.3)
+        count = len(produced)
+        time.sleep(0.3)
+        self.assertEqual(count, len(produced))
+        self.assertTrue(count < 20)
+
+    def test_has_action(self):
+        self.storage.archive('foo bar')
+        self.assertTrue(self.storage.has_action(b'user01-0', 'foo bar', 1, 'fill'))
+
+        # a directory opened for the first time indexes its archive
+        remove(self.storage.first_steps.path)
+        storage = FSResultStorage(self.storage_dir)
+        find_lines = fs.find_lines
+        fs.find_lines = None
+        try:
+            self.assertTrue(storage.has_action(b'user01-0', 'foo bar', 1, 'fill'))
+            self.assertFalse(storage.has_action(b'user03-0', 'foo bar', None, 'fill'))
+        finally:
+            fs.find_lines = find_lines
+
+    def test_unknown_compression(self):
+        self.assertRaises(Exception, self.storage.archive, 'foo bar', 'rar')
+        self.assertEqual(99, self.live('foo bar'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,13 @@ import unittest
 import dabble
 from dabble import *
 from dabble.backends.fs import *
+from dabble.hashers import *
+from dabble.util import fraction
 from dabble.backends.mongodb import *
 import pymongo
 
+from datetime import datetime, timedelta
+from functools import partial
 from os import makedirs
 from os.path import dirname, exists, join
 from shutil import rmtree
@@ -70,7 +74,7 @@ def ReportTestFor(name, setUp_func, tearDown_func):
         }
 
         try:
-            self.assertEquals(report, expected)
+            self.assertEqual(report, expected)
         except:
             from pprint import pprint
             pprint(report)
@@ -127,7 +131,7 @@ def ReportTestFor(name, setUp_func, tearDown_func):
             ],
         }
 
-        self.assertEquals(report, expected)
+        self.assertEqual(report, expected)
 
     def test_funnel(self):
         class T(object):
@@ -206,7 +210,7 @@ def ReportTestFor(name, setUp_func, tearDown_func):
         }
 
         report = self.storage.report('foobar')
-        self.assertEquals(report, expected)
+        self.assertEqual(report, expected)
 
     def test_list_tests(self):
         class T(object):
@@ -216,16 +220,320 @@ def ReportTestFor(name, setUp_func, tearDown_func):
         T()
 
         tests = self.storage.list_tests()
-        self.assertEquals(2, len(tests))
+        self.assertEqual(2, len(tests))
         self.assertTrue('first' in tests, '"first" should be in tests')
         self.assertTrue('second' in tests, '"second" should be in tests')
 
 
+    def test_has_action(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+
+        t = T()
+
+        self.provider.identity = 1
+        self.assertFalse(t.abtest.has_action('show'))
+        t.abtest.record('show')
+        self.assertTrue(t.abtest.has_action('show'))
+        self.assertFalse(t.abtest.completed)
+        t.abtest.record('fill')
+        self.assertTrue(t.abtest.completed)
+
+        identity = t.abtest.identity
+        self.assertTrue(self.storage.has_action(identity, 'foobar', 0, 'fill'))
+        self.assertFalse(self.storage.has_action(identity, 'foobar', 1, 'fill'))
+
+        self.provider.identity = 2
+        self.assertFalse(t.abtest.has_action('show'))
+        self.assertFalse(t.abtest.completed)
+
+    def test_window(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo'], ['show', 'fill'])
+
+        day = timedelta(days=1)
+        start = datetime(2012, 3, 1, 12)
+
+        # shown and filled the same day
+        self.storage.record(b'1', 'foobar', 0, 'show', start)
+        self.storage.record(b'1', 'foobar', 0, 'fill', start + timedelta(hours=1))
+        # shown one day, filled the next
+        self.storage.record(b'2', 'foobar', 0, 'show', start)
+        self.storage.record(b'2', 'foobar', 0, 'fill', start + day)
+        # shown the next day
+        self.storage.record(b'3', 'foobar', 0, 'show', start + day)
+
+        def counts(since=None, until=None):
+            funnel = self.storage.report('foobar', since, until)['results'][0]['funnel']
+            return funnel[0]['attempted'], funnel[0]['converted']
+
+        self.assertEqual((3, 2), counts())
+        self.assertEqual((2, 1), counts(until=start + day))
+        self.assertEqual((1, 0), counts(since=start + day))
+        self.assertEqual((0, 0), counts(since=start + 2 * day))
+        self.assertEqual((2, 1), counts(start, start + timedelta(hours=2)))
+
+    def test_window_repeats(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo'], ['show', 'fill'])
+
+        day = timedelta(days=1)
+        start = datetime(2012, 3, 1, 12)
+
+        # shown before the window, and again within it
+        self.storage.record(b'1', 'foobar', 0, 'show', start)
+        self.storage.record(b'1', 'foobar', 0, 'show', start + 4 * day)
+        self.storage.record(b'1', 'foobar', 0, 'fill', start + 5 * day)
+        # filled before being shown, and again after
+        self.storage.record(b'2', 'foobar', 0, 'fill', start + day)
+        self.storage.record(b'2', 'foobar', 0, 'show', start + 3 * day)
+        self.storage.record(b'2', 'foobar', 0, 'fill', start + 4 * day)
+        # shown and filled within the window
+        self.storage.record(b'3', 'foobar', 0, 'show', start + 3 * day)
+        self.storage.record(b'3', 'foobar', 0, 'fill', start + 4 * day)
+
+        def counts(since=None, until=None):
+            funnel = self.storage.report('foobar', since, until)['results'][0]['funnel']
+            return funnel[0]['attempted'], funnel[0]['converted']
+
+        self.assertEqual((3, 2), counts())
+        self.assertEqual((2, 1), counts(since=start + 2 * day))
+        self.assertEqual((1, 0), counts(until=start + 2 * day))
+        self.assertEqual((2, 0), counts(start + 2 * day, start + 4 * day))
+        self.assertEqual((3, 2), counts(since=start))
+
+    def test_report_many(self):
+        class T(object):
+            first = ABTest('first', ['a', 'b'], ['show', 'fill'])
+            second = ABTest('second', ['a', 'b', 'c'], ['show', 'click', 'fill'])
+            third = ABTest('third', ['a'], ['show', 'fill'])
+
+        t = T()
+        for identity in range(6):
+            self.provider.identity = identity
+            t.first.record('show')
+            t.second.record('show')
+            if identity % 2:
+                t.first.record('fill')
+                t.second.record('click')
+            if identity % 3:
+                t.second.record('fill')
+
+        reports = self.storage.report_many(['first', 'second'])
+        self.assertEqual(['first', 'second'], sorted(reports))
+        self.assertEqual(self.storage.report('first'), reports['first'])
+        self.assertEqual(self.storage.report('second'), reports['second'])
+
+        reports = self.storage.report_all()
+        self.assertEqual(['first', 'second', 'third'], sorted(reports))
+        self.assertEqual(self.storage.report('third'), reports['third'])
+
+        self.assertRaises(Exception, self.storage.report_many, ['first', 'fourth'])
+
+    def test_registry(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+
+        # as if the process had restarted
+        generic_tearDown(self)
+        self.storage = self.storage_class(*self.storage_args)
+        self.provider = MockIdentityProvider()
+        configure(self.provider, self.storage)
+
+        saved = []
+        save_test = self.storage.save_test
+        def counting_save_test(*args):
+            saved.append(args[0])
+            return save_test(*args)
+        self.storage.save_test = counting_save_test
+
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+            other = ABTest('other', ['foo', 'bar'], ['show', 'fill'])
+
+        self.assertEqual(['other'], saved)
+        self.assertEqual(['foobar', 'other'], sorted(self.storage.list_tests()))
+        self.assertRaises(Exception, ABTest, 'foobar', ['foo', 'baz'], ['show', 'fill'])
+
+    def test_migrating_hasher(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar', 'baz'], ['show', 'fill'])
+
+        t = T()
+        self.provider.identity = 1
+        t.abtest.record('show')
+        self.assertEqual(0, t.abtest.alternative)
+
+        dabble.AB._hasher = MigratingHasher(KeyedHasher('secret'))
+        self.assertEqual(8, len(t.abtest.identity))
+        self.assertEqual(0, t.abtest.alternative)
+        self.assertEqual(0, self.storage.get_alternative(t.abtest.identity, 'foobar'))
+
+        self.provider.identity = 2
+        self.assertEqual(1, t.abtest.alternative)
+
+    def test_sampling(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo'], ['show', 'fill'], sample={'show': 0.25})
+
+        t = T()
+        sampled = 0
+        for identity in range(400):
+            self.provider.identity = identity
+            for i in range(3):
+                t.abtest.record('show')
+            if identity % 2:
+                t.abtest.record('fill')
+                self.assertTrue(t.abtest.completed)
+            if fraction(t.abtest.identity, 'foobar') < 0.25:
+                sampled += 1
+            self.assertEqual(t.abtest.has_action('show'),
+                             fraction(t.abtest.identity, 'foobar') < 0.25)
+
+        report = self.storage.report('foobar')
+        self.assertEqual({'rates': {'show': 0.25, 'fill': 1.0}, 'weight': 4.0},
+                         report['sampling'])
+
+        stage = report['results'][0]['funnel'][0]
+        self.assertEqual(sampled, stage['sampled']['attempted'])
+        self.assertEqual(sampled * 4.0, stage['attempted'])
+        self.assertEqual(stage['sampled']['converted'] * 4.0, stage['converted'])
+        self.assertEqual(sampled * 0.75 / 0.25 ** 2, stage['variance']['attempted'])
+        self.assertTrue(300 < stage['attempted'] < 500)
+
+        self.assertRaises(Exception, ABTest, 'other', ['foo'], ['show', 'fill'],
+                          sample={'fill': 0.5})
+
+    def test_export_identities(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show'])
+
+        # hashed identities are arbitrary bytes, which
+        # come back out of the storage unchanged
+        identities = [SHA1Hasher().hash(n) for n in range(20)] + [b'\x00\xff']
+        self.storage.set_alternatives([(identity, 'foobar', 1) for identity in identities])
+        self.storage.record_many([(identity, 'foobar', 1, 'show', None)
+                                  for identity in identities])
+
+        exported = list(self.storage.export_alternatives('foobar'))
+        self.assertEqual(sorted(identities), sorted(identity for identity, n in exported))
+        for identity, n in exported:
+            self.assertTrue(type(identity) is bytes)
+        self.assertEqual(sorted(identities), sorted(
+            identity for identity, n, action, when in self.storage.export_results('foobar')))
+
+    def test_get_alternatives(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show'])
+
+        identities = [SHA1Hasher().hash(n) for n in range(5)] + [b'\x00\xff']
+        self.storage.set_alternatives([(identity, 'foobar', n % 2)
+                                       for n, identity in enumerate(identities[1:])])
+        self.storage.set_alternative(identities[1], 'foobar', 0)
+
+        found = self.storage.get_alternatives(identities + [b'unknown'], 'foobar')
+        self.assertEqual(dict((identity, n % 2) for n, identity in enumerate(identities[1:])),
+                         found)
+        for identity in found:
+            self.assertTrue(type(identity) is bytes)
+        self.assertEqual({}, self.storage.get_alternatives(identities, 'other'))
+        self.assertEqual({}, self.storage.get_alternatives([], 'foobar'))
+
+    def test_export(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill', 'buy'])
+
+        start = datetime(2012, 3, 1, 12)
+        minute = timedelta(minutes=1)
+
+        # repeated and out of order actions are not exported
+        self.storage.set_alternatives([(b'1', 'foobar', 1), (b'2', 'foobar', 0)])
+        self.storage.record_many([
+            (b'1', 'foobar', 1, 'show', start),
+            (b'1', 'foobar', 1, 'show', start + minute),
+            (b'1', 'foobar', 1, 'fill', start + 2 * minute),
+            (b'2', 'foobar', 0, 'fill', start + 3 * minute),
+        ])
+        self.storage.record(b'1', 'foobar', 1, 'buy', start + 4 * minute)
+        # filled again after being shown, but first filled before
+        self.storage.record(b'2', 'foobar', 0, 'show', start + 5 * minute)
+        self.storage.record(b'2', 'foobar', 0, 'fill', start + 6 * minute)
+
+        self.assertEqual(1, self.storage.get_alternative(b'1', 'foobar'))
+        self.assertEqual([(b'1', 1), (b'2', 0)],
+                         sorted(self.storage.export_alternatives('foobar')))
+        self.assertEqual([
+            (b'1', 1, 'show', start),
+            (b'1', 1, 'fill', start + 2 * minute),
+            (b'1', 1, 'buy', start + 4 * minute),
+            (b'2', 0, 'show', start + 5 * minute),
+        ], list(self.storage.export_results('foobar')))
+
+        # exports resume after a tuple they yielded, or start
+        # over if it is no longer exported
+        results = list(self.storage.export_results('foobar'))
+        for n, exported in enumerate(results):
+            self.assertEqual(results[n + 1:],
+                             list(self.storage.export_results('foobar', exported)))
+        self.assertEqual(results, list(self.storage.export_results(
+            'foobar', (b'3', 0, 'show', start))))
+        alternatives = list(self.storage.export_alternatives('foobar'))
+        self.assertEqual(alternatives[1:],
+                         list(self.storage.export_alternatives('foobar', alternatives[0])))
+        self.assertEqual(alternatives,
+                         list(self.storage.export_alternatives('foobar', (b'3', 0))))
+
+        self.assertRaises(Exception, list, self.storage.export_results('other'))
+
+    def test_time_to_convert(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill', 'buy'])
+
+        start = datetime(2012, 3, 1, 12)
+        minute = timedelta(minutes=1)
+
+        # each identity fills n minutes after it is shown, and those
+        # shown foo buy the next minute; repeated steps are not timed
+        for n in range(1, 11):
+            identity = b'%d' % n
+            self.storage.record(identity, 'foobar', n % 2, 'show', start)
+            self.storage.record(identity, 'foobar', n % 2, 'show', start + minute)
+            self.storage.record(identity, 'foobar', n % 2, 'fill', start + n * minute)
+            if n % 2 == 0:
+                self.storage.record(identity, 'foobar', 0, 'buy', start + (n + 1) * minute)
+
+        self.assertTrue('time_to_convert' not in
+                        self.storage.report('foobar')['results'][0]['funnel'][0])
+
+        report = self.storage.report('foobar', quantiles=(0, 0.5, 1))
+        foo, bar = [r['funnel'] for r in report['results']]
+        self.assertEqual({0: 120, 0.5: 360, 1: 600}, foo[0]['time_to_convert']['quantiles'])
+        self.assertEqual({0: 60, 0.5: 60, 1: 60}, foo[1]['time_to_convert']['quantiles'])
+        self.assertEqual({0: 60, 0.5: 300, 1: 540}, bar[0]['time_to_convert']['quantiles'])
+        self.assertEqual({0: None, 0.5: None, 1: None},
+                         bar[1]['time_to_convert']['quantiles'])
+        self.assertEqual(5, foo[0]['time_to_convert']['digest'].count)
+
+        report = self.storage.report_many(['foobar'], until=start + 5 * minute,
+                                          quantiles=(1, ))['foobar']
+        self.assertEqual({1: 240}, report['results'][0]['funnel'][0]['time_to_convert']['quantiles'])
+
     funcs = {
         'test_one': test_one,
         'test_two': test_two,
         'test_funnel': test_funnel,
         'test_list_tests': test_list_tests,
+        'test_has_action': test_has_action,
+        'test_window': test_window,
+        'test_window_repeats': test_window_repeats,
+        'test_report_many': test_report_many,
+        'test_registry': test_registry,
+        'test_migrating_hasher': test_migrating_hasher,
+        'test_sampling': test_sampling,
+        'test_export_identities': test_export_identities,
+        'test_get_alternatives': test_get_alternatives,
+        'test_export': test_export,
+        'test_time_to_convert': test_time_to_convert,
     }
     if setUp_func:
         funcs['setUp'] = setUp_func
@@ -241,37 +549,80 @@ def generic_setUp(self):
     self.randrange = RandRange()
     dabble.random.randrange = self.randrange
 
+_mongo_client = []
+
+def mongo_client():
+    # connect once, and fail fast when no server is running
+    if not _mongo_client:
+        try:
+            try:
+                client = pymongo.MongoClient(serverSelectionTimeoutMS=1000)
+            except pymongo.errors.ConfigurationError:
+                # PyMongo 2 has no server selection timeout, and
+                # connects as the client is created
+                client = pymongo.MongoClient(connectTimeoutMS=1000)
+            client.admin.command('ping')
+        except pymongo.errors.ConnectionFailure:
+            client = None
+        _mongo_client.append(client)
+    return _mongo_client[0]
+
+def mongo_collections(db):
+    if hasattr(db, 'list_collection_names'):
+        return db.list_collection_names()
+    return db.collection_names()
+
 def mongo_setUp(self):
+    client = mongo_client()
+    if client is None:
+        self.skipTest('no MongoDB server')
     generic_setUp(self)
 
-    conn = pymongo.Connection()
-    db = conn.dabble_test
-    for collection in db.collection_names():
+    db = client.dabble_test
+    for collection in mongo_collections(db):
         if collection.startswith('dabble'):
             db.drop_collection(collection)
 
+    self.storage_class = MongoResultStorage
+    self.storage_args = (db, )
     self.storage = MongoResultStorage(db)
     self.provider = MockIdentityProvider()
     configure(self.provider, self.storage)
 
-def fs_setUp(self):
-    generic_setUp(self)
+def make_storage_dir(name='storage'):
+    # an empty directory under test/ for FSResultStorage
+    storage_dir = join(dirname(__file__), name)
+    remove_storage_dir(storage_dir)
+    makedirs(storage_dir)
+    return storage_dir
 
-    here = dirname(__file__)
-    storage_dir = join(here, 'storage')
+def remove_storage_dir(storage_dir):
     if exists(storage_dir):
         rmtree(storage_dir)
-    makedirs(storage_dir)
 
-    self.storage = FSResultStorage(storage_dir)
+def fs_setUp(self, **kwargs):
+    generic_setUp(self)
+
+    storage_dir = make_storage_dir()
+
+    self.storage_class = partial(FSResultStorage, **kwargs)
+    self.storage_args = (storage_dir, )
+    self.storage = self.storage_class(storage_dir)
     self.provider = MockIdentityProvider()
     configure(self.provider, self.storage)
 
+def segmented_fs_setUp(self):
+    fs_setUp(self, segmented=True)
+
+def group_commit_fs_setUp(self):
+    fs_setUp(self, durability='group', sync_interval=0.001)
+
 
 def generic_tearDown(self):
     # pretend like the previous test never happened
     dabble.AB._id_provider = None
     dabble.AB._storage = None
+    dabble.AB._astorage = None
     dabble.AB._AB__n_per_test = {}
 
     del self.storage
@@ -280,22 +631,33 @@ def generic_tearDown(self):
 def mongo_tearDown(self):
     generic_tearDown(self)
 
-    conn = pymongo.Connection()
-    db = conn.dabble_test
+    db = mongo_client().dabble_test
     for collection in ('dabble.tests', 'dabble.results'):
         db.drop_collection(collection)
 
 def fs_tearDown(self):
     generic_tearDown(self)
+    remove_storage_dir(join(dirname(__file__), 'storage'))
 
-    here = dirname(__file__)
-    storage_dir = join(here, 'storage')
-    if exists(storage_dir):
-        rmtree(storage_dir)
 
+class MongoTest(unittest.TestCase):
+
+    setUp = mongo_setUp
+    tearDown = mongo_tearDown
+
+    def test_step_names(self):
+        self.assertRaises(Exception, self.storage.save_test, 'foobar', ['foo'], ['a.b'])
+        self.assertRaises(Exception, self.storage.save_test, 'foobar', ['foo'], ['$a'])
+
+        # tests saved before step names were checked can still be used
+        self.storage.tests.insert_one({'_id': 'old', 'a': ['foo'], 's': ['a.b']})
+        self.storage.save_test('old', ['foo'], ['a.b'])
 
 MongoReportTest = ReportTestFor('MongoReportTest', mongo_setUp, mongo_tearDown)
 FSReportTest = ReportTestFor('FSReportTest', fs_setUp, fs_tearDown)
+SegmentedFSReportTest = ReportTestFor('SegmentedFSReportTest', segmented_fs_setUp, fs_tearDown)
+GroupCommitFSReportTest = ReportTestFor('GroupCommitFSReportTest', group_commit_fs_setUp,
+                                        fs_tearDown)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+
+import dabble
+from dabble import *
+from dabble import bulk
+from dabble.backends.fs import FSResultStorage
+from dabble.bulk import *
+from dabble.hashers import *
+
+from os import makedirs
+from os.path import join
+
+from test.test_backend import (MockIdentityProvider, RandRange, generic_tearDown,
+                               make_storage_dir, remove_storage_dir)
+
+class BulkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.randrange = RandRange()
+        dabble.random.randrange = self.randrange
+        self.numpy = bulk.numpy
+
+        self.storage_dir = make_storage_dir()
+
+    def configure(self, hasher=None):
+        self.storage = FSResultStorage(self.storage_dir)
+        self.provider = MockIdentityProvider()
+        configure(self.provider, self.storage, hasher=hasher)
+
+        class T(object):
+            abtest = ABTest('campaign', ['foo', 'bar', 'baz'], ['sent', 'clicked'])
+        self.t = T()
+
+    def tearDown(self):
+        generic_tearDown(self)
+        bulk.numpy = self.numpy
+        remove_storage_dir(self.storage_dir)
+
+    def check_online(self, assigned):
+        # the online path finds every assignment, drawing none
+        drawn = self.randrange.n
+        for identity, alternative in assigned:
+            self.provider.identity = identity
+            self.assertEqual(alternative, self.t.abtest.alternative)
+        self.assertEqual(drawn, self.randrange.n)
+
+    def test_assign(self):
+        self.configure()
+        assigned = list(assignments('campaign', range(1000), weights=[2, 1, 1],
+                                    batch_size=300, seed=1))
+
+        self.assertEqual(list(range(1000)), [identity for identity, alternative in assigned])
+        counts = [0, 0, 0]
+        for identity, alternative in assigned:
+            counts[alternative] += 1
+        self.assertTrue(430 < counts[0] < 570)
+        self.assertTrue(180 < counts[1] < 320)
+        self.assertTrue(180 < counts[2] < 320)
+        self.check_online(assigned[::10])
+
+    def test_without_numpy(self):
+        bulk.numpy = None
+        self.configure()
+        assigned = list(assignments('campaign', range(300), weights=[0, 1, 1], seed=1))
+        self.assertEqual(0, len([a for i, a in assigned if a == 0]))
+        self.check_online(assigned)
+
+    def test_repeatable(self):
+        self.configure()
+        users = ['a', 'b', 'c', 'd', 'e', 'f']
+        first = list(assignments('campaign', users, seed=5))
+
+        other = join(self.storage_dir, 'other')
+        makedirs(other)
+        dabble.AB._storage = FSResultStorage(other)
+        dabble.AB._storage.save_test('campaign', ['foo', 'bar', 'baz'], ['sent', 'clicked'])
+        self.assertEqual(first, list(assignments('campaign', users, seed=5)))
+
+    def test_existing(self):
+        self.configure()
+        self.provider.identity = 'known'
+        online = self.t.abtest.alternative
+
+        assigned = list(assignments('campaign', ['known', 'a', 'known', 'b', 'a']))
+        self.assertEqual(online, assigned[0][1])
+        self.assertEqual(online, assigned[2][1])
+        self.assertEqual(assigned[1][1], assigned[4][1])
+        self.check_online(assigned)
+
+        # each user is written once
+        self.assertEqual(3, len(list(self.storage.export_alternatives('campaign'))))
+        self.assertEqual(5, sum(assign('campaign', ['known', 'a', 'known', 'b', 'a'])))
+        self.assertEqual(3, len(list(self.storage.export_alternatives('campaign'))))
+
+        # repeats in a later batch find the earlier batch's write
+        assigned = list(assignments('campaign', ['c', 'd', 'c'], batch_size=2))
+        self.assertEqual(assigned[0][1], assigned[2][1])
+        self.assertEqual(5, len(list(self.storage.export_alternatives('campaign'))))
+
+    def test_reads_once(self):
+        # each batch reads only the assignments written since the last
+        self.configure()
+        read = []
+        add = self.storage.alt_index.add
+        def counted(data):
+            read.append(data)
+            add(data)
+        self.storage.alt_index.add = counted
+        self.assertEqual(1000, sum(assign('campaign', range(1000), batch_size=100)))
+        self.assertEqual(900, len(read))
+
+    def test_migrating_hasher(self):
+        self.configure()
+        old = list(assignments('campaign', ['a', 'b']))
+        generic_tearDown(self)
+        self.configure(MigratingHasher(Blake2bHasher()))
+
+        new = list(assignments('campaign', ['a', 'b', 'c']))
+        self.assertEqual(old, new[:2])
+        self.check_online(new)
+
+    def test_bad_arguments(self):
+        self.configure()
+        self.assertRaises(Exception, assign, 'other', ['a'])
+        self.assertRaises(Exception, assign, 'campaign', ['a'], weights=[1, 1])
+        self.assertRaises(Exception, assign, 'campaign', ['a'], weights=[0, 0, 0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+import dabble
+from dabble import *
+from dabble.dedup import *
+
+from test.test_backend import fs_setUp, fs_tearDown
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add(b'key %d' % n)
+        for n in range(1000):
+            self.assertTrue(b'key %d' % n in bloom)
+
+    def test_error_rate(self):
+        bloom = BloomFilter(1000, 0.01)
+        for n in range(1000):
+            bloom.add(b'key %d' % n)
+        false = sum(1 for n in range(10000) if b'other %d' % n in bloom)
+        self.assertTrue(false < 200, false)
+
+    def test_rotation(self):
+        dedup = Deduplicator(capacity=10)
+        for n in range(25):
+            dedup.add(b'key %d' % n)
+        self.assertTrue(b'key 24' in dedup)
+        self.assertTrue(b'key 10' in dedup)
+        self.assertFalse(b'key 0' in dedup)
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        fs_setUp(self)
+        self.dedup = Deduplicator()
+        dabble.AB._dedup = self.dedup
+
+    tearDown = fs_tearDown
+
+    def lines(self):
+        count = 0
+        for path in self.storage.partitions():
+            with open(path) as fp:
+                count += len(fp.readlines())
+        return count
+
+    def test_repeats_skipped(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+
+        for identity in range(5):
+            self.provider.identity = identity
+            for i in range(4):
+                T.abtest.record('show')
+            T.abtest.record('fill')
+            T.abtest.record('fill')
+
+        self.assertEqual(15, self.lines())
+        for result in self.storage.report('foobar')['results']:
+            self.assertEqual(result['funnel'][0]['attempted'],
+                             result['funnel'][0]['converted'])
+
+    def test_false_positive_verified(self):
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+
+        # every key appears to have been seen
+        self.dedup.current.array[:] = b'\xff' * len(self.dedup.current.array)
+
+        self.provider.identity = 1
+        T.abtest.record('show')
+        T.abtest.record('show')
+        self.assertEqual(1, self.lines())
+
+if __name__ == '__main__':
+    unittest.main()
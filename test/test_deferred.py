@@ -0,0 +1,144 @@
+import unittest
+
+import dabble
+from dabble import *
+from dabble.backends.fs import FSResultStorage, find_lines
+from dabble.deferred import *
+from dabble.wsgi import *
+
+from test.test_backend import MockIdentityProvider, RandRange, fs_tearDown, make_storage_dir
+
+class DeferredTest(unittest.TestCase):
+
+    def setUp(self):
+        self.randrange = RandRange()
+        dabble.random.randrange = self.randrange
+
+        storage_dir = make_storage_dir()
+
+        self.backend = FSResultStorage(storage_dir)
+        self.storage = DeferredResultStorage(self.backend)
+        self.provider = MockIdentityProvider()
+        configure(self.provider, self.storage)
+
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar', 'baz'], ['show', 'fill'])
+        self.t = T()
+
+    tearDown = fs_tearDown
+
+    def results(self):
+        return sum(len(list(find_lines(path)))
+                   for path in self.backend.partitions(None, None))
+
+    def test_passthrough(self):
+        self.provider.identity = 1
+        self.t.abtest.record('show')
+
+        self.assertEqual(1, self.results())
+        self.assertEqual(0, self.backend.get_alternative(self.t.abtest.identity, 'foobar'))
+
+    def test_deferred(self):
+        self.provider.identity = 1
+        identity = self.t.abtest.identity
+
+        with self.storage.deferred():
+            self.t.abtest.record('show')
+            self.assertEqual(0, self.t.abtest.alternative)
+            self.assertTrue(self.t.abtest.has_action('show'))
+            self.assertFalse(self.t.abtest.has_action('fill'))
+            self.t.abtest.record('fill')
+
+            self.assertEqual(None, self.backend.get_alternative(identity, 'foobar'))
+            self.assertEqual(0, self.results())
+
+        # the alternative was only chosen once
+        self.assertEqual(1, self.randrange.n)
+        self.assertEqual(0, self.backend.get_alternative(identity, 'foobar'))
+        self.assertEqual(2, self.results())
+
+        report = self.storage.report('foobar')
+        self.assertEqual(1, report['results'][0]['funnel'][0]['converted'])
+
+    def test_discard(self):
+        self.provider.identity = 1
+
+        self.storage.begin()
+        self.t.abtest.record('show')
+        self.storage.discard()
+
+        self.assertEqual(0, self.results())
+        self.assertEqual(None, self.backend.get_alternative(self.t.abtest.identity, 'foobar'))
+
+    def test_flush_conflict(self):
+        self.storage.begin()
+        for identity in (1, 2):
+            self.provider.identity = identity
+            self.t.abtest.record('show')
+            self.t.abtest.record('fill')
+        self.provider.identity = 1
+        first = self.t.abtest.identity
+        self.provider.identity = 2
+        second = self.t.abtest.identity
+
+        # another request assigned the first identity meanwhile
+        self.backend.set_alternative(first, 'foobar', 2)
+        self.assertRaises(Exception, self.storage.flush)
+
+        self.assertEqual(2, self.backend.get_alternative(first, 'foobar'))
+        self.assertEqual(1, self.backend.get_alternative(second, 'foobar'))
+        self.assertFalse(self.backend.has_action(first, 'foobar', None, 'show'))
+        self.assertTrue(self.backend.has_action(second, 'foobar', 1, 'fill'))
+        self.assertFalse(self.storage.deferring())
+
+    def test_middleware(self):
+        calls = []
+        def app(environ, start_response):
+            self.provider.identity = environ['user']
+            self.t.abtest.record('show')
+            calls.append(self.results())
+            start_response('200 OK', [])
+            return ['page for %s' % self.t.abtest.alternative]
+
+        app = DeferredWritesMiddleware(app, self.storage)
+        for user in (1, 2):
+            response = app({'user': user}, lambda status, headers: None)
+            self.assertEqual(['page for %d' % (user - 1)], list(response))
+            self.assertEqual(user - 1, self.results())
+            response.close()
+            self.assertEqual(user, self.results())
+
+        self.assertEqual([0, 1], calls)
+
+    def test_middleware_error(self):
+        def app(environ, start_response):
+            self.provider.identity = 1
+            self.t.abtest.record('show')
+            raise ValueError('boom')
+
+        app = DeferredWritesMiddleware(app, self.storage)
+        self.assertRaises(ValueError, app, {}, lambda status, headers: None)
+        self.assertEqual(1, self.results())
+
+        # the thread is ready for its next request
+        self.storage.begin()
+        self.storage.discard()
+
+    def test_middleware_unclosed(self):
+        def app(environ, start_response):
+            self.provider.identity = environ['user']
+            self.t.abtest.record('show')
+            start_response('200 OK', [])
+            return ['page']
+
+        app = DeferredWritesMiddleware(app, self.storage)
+        app({'user': 1}, lambda status, headers: None)
+        self.assertEqual(0, self.results())
+
+        # the server never closed the first response
+        app({'user': 2}, lambda status, headers: None).close()
+        self.assertEqual(2, self.results())
+        self.assertFalse(self.storage.deferring())
+
+if __name__ == '__main__':
+    unittest.main()
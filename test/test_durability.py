@@ -0,0 +1,96 @@
+import unittest
+
+from dabble.backends import fs
+from dabble.backends.fs import FSResultStorage, FileWriter
+
+from os.path import join
+from threading import Thread
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class DurabilityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_dir = make_storage_dir()
+
+        # count the syncs made
+        self.syncs = []
+        self.fsync = fs.fsync
+        def fsync(fd):
+            self.syncs.append(fd)
+            self.fsync(fd)
+        fs.fsync = fsync
+
+    def tearDown(self):
+        fs.fsync = self.fsync
+        remove_storage_dir(self.storage_dir)
+
+    def storage(self, **kwargs):
+        storage = FSResultStorage(self.storage_dir, **kwargs)
+        storage.save_test('foobar', ['foo', 'bar'], ['show', 'buy'])
+        return storage
+
+    def record(self, storage, threads, records):
+        def run(worker):
+            for n in range(records):
+                storage.record(b'user%d-%d' % (worker, n), 'foobar', n % 2, 'show')
+        workers = [Thread(target=run, args=(worker, )) for worker in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def shown(self, storage):
+        return sum(r['funnel'][0]['attempted'] for r in storage.report('foobar')['results'])
+
+    def test_unknown(self):
+        self.assertRaises(Exception, FSResultStorage, self.storage_dir, durability='sometimes')
+
+    def test_none(self):
+        storage = self.storage()
+        self.record(storage, 4, 10)
+        self.assertEqual(40, self.shown(storage))
+        self.assertEqual([], self.syncs)
+
+    def test_fsync(self):
+        for segmented in (False, True):
+            del self.syncs[:]
+            storage = self.storage(durability='fsync', segmented=segmented)
+            self.record(storage, 4, 10)
+            self.assertEqual(40, self.shown(storage))
+            # and one for the test, when it was first saved
+            self.assertEqual(40 if segmented else 41, len(self.syncs))
+
+    def test_group(self):
+        for segmented in (False, True):
+            del self.syncs[:]
+            storage = self.storage(durability='group', sync_interval=0.01, segmented=segmented)
+            self.record(storage, 8, 20)
+            self.assertEqual(160, self.shown(storage))
+            self.assertTrue(0 < len(self.syncs) < 160)
+
+    def test_replaced(self):
+        # archiving replaces the results files, which
+        # writers holding them open must notice
+        storage = self.storage(durability='group', sync_interval=0.001)
+        storage.save_test('other', ['foo', 'bar'], ['show', 'buy'])
+        storage.record(b'user1', 'other', 0, 'show')
+        storage.record(b'user1', 'foobar', 0, 'show')
+        self.assertEqual(1, storage.archive('other'))
+
+        storage.record(b'user2', 'foobar', 1, 'show')
+        self.assertEqual(2, self.shown(storage))
+
+    def test_close(self):
+        # files closed to make room are synced first
+        writer = FileWriter('group', 0.001)
+        writer.max_open = 2
+        paths = [join(self.storage_dir, 'file%d' % n) for n in range(3)]
+        writer.append(paths[0], 'line\n')
+        writer.append(paths[1], 'line\n')
+        del self.syncs[:]
+        evicted = set(writer.fds.values())
+        writer.append(paths[2], 'line\n')
+        self.assertEqual(evicted, set(self.syncs))
+        writer.close()
+        self.assertEqual(['line\n'] * 3, [open(path).read() for path in paths])
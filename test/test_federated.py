@@ -0,0 +1,90 @@
+import unittest
+
+from dabble.backends.fs import FSResultStorage
+from dabble.federated import *
+
+from datetime import datetime, timedelta
+from os import remove
+from os.path import exists, join
+from random import Random
+from shutil import rmtree
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class FederatedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirs = [make_storage_dir('storage-%d' % n) for n in range(4)]
+
+        # hosts (the first three directories) each record some of
+        # the actions of every identity; the last directory holds
+        # all of them, for comparison
+        self.start = datetime(2012, 3, 1, 23)
+        self.hosts = [FSResultStorage(storage_dir) for storage_dir in self.dirs]
+        for storage in self.hosts:
+            storage.save_test('foobar', ['foo', 'bar'], ['show', 'fill', 'buy'])
+            storage.save_test('other', ['foo'], ['show', 'buy'])
+
+        random = Random(1)
+        records = []
+        for n in range(300):
+            when = self.start + timedelta(minutes=random.randrange(120))
+            for action in ['show', 'show', 'fill', 'buy'][:random.randrange(5)]:
+                when += timedelta(minutes=random.randrange(1, 30))
+                records.append((random.randrange(3), (b'user%d' % n, 'foobar', n % 2, action, when)))
+            if n % 3 == 0:
+                records.append((random.randrange(3), (b'user%d' % n, 'other', 0, 'show', when)))
+
+        # the hosts' records are each in order, though a host may
+        # record an identity's later step before another records
+        # its earlier one
+        records.sort(key=lambda record: record[1][4])
+        for host, record in records:
+            self.hosts[host].record(*record)
+        self.hosts[-1].record_many([record for host, record in records])
+
+    def tearDown(self):
+        for storage_dir in self.dirs:
+            remove_storage_dir(storage_dir)
+
+    def test_report(self):
+        hosts = self.dirs[:3]
+        reports = federated_report_many(hosts, ['foobar', 'other'], workers=2, partitions=3)
+        self.assertEqual(self.hosts[-1].report_many(['foobar', 'other']), reports)
+
+        # the hosts' own reports do not add up
+        self.assertNotEqual(reports['foobar']['results'][0]['funnel'][1]['converted'],
+                            sum(storage.report('foobar')['results'][0]['funnel'][1]['converted']
+                                for storage in self.hosts[:3]))
+
+        window = (self.start + timedelta(minutes=30), self.start + timedelta(minutes=90))
+        self.assertEqual(self.hosts[-1].report('foobar', *window),
+                         federated_report(hosts, 'foobar', *window, workers=2))
+
+        self.assertRaises(Exception, federated_report, hosts, 'unknown')
+
+    def test_window(self):
+        # the first steps taken before the window are looked up in
+        # the hosts' indexes, or read, if any index is missing
+        window = (datetime(2012, 3, 2, 0, 30), datetime(2012, 3, 2, 2))
+        expected = self.hosts[-1].report('foobar', *window)
+        self.assertEqual(expected, federated_report(self.dirs[:3], 'foobar', *window, workers=2))
+        remove(self.hosts[0].first_steps.path)
+        self.assertEqual(expected, federated_report(self.dirs[:3], 'foobar', *window, workers=2))
+
+    def test_quantiles(self):
+        report = federated_report(self.dirs[:3], 'foobar', quantiles=(0.5, 0.9), workers=2)
+        expected = self.hosts[-1].report('foobar', quantiles=(0.5, 0.9))
+        for result, alternative in zip(report['results'], expected['results']):
+            for stage, other in zip(result['funnel'], alternative['funnel']):
+                self.assertEqual(other['converted'], stage['converted'])
+                self.assertEqual(other['time_to_convert']['quantiles'],
+                                 stage['time_to_convert']['quantiles'])
+
+    def test_read_only(self):
+        # directories are only read: a host which has recorded
+        # nothing yet is not given a results directory
+        rmtree(join(self.dirs[3], 'results'))
+        reports = federated_report_many(self.dirs, ['foobar'], workers=2)
+        self.assertFalse(exists(join(self.dirs[3], 'results')))
+        self.assertEqual(federated_report_many(self.dirs[:3], ['foobar'], workers=2), reports)
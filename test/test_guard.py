@@ -0,0 +1,176 @@
+import unittest
+import time
+from datetime import datetime
+
+import dabble
+from dabble import *
+from dabble.guard import *
+from dabble.util import bucket, utcnow
+
+from test.test_backend import MockIdentityProvider, RandRange, generic_tearDown
+
+class MemoryResultStorage(ResultStorage):
+    # a minimal in-memory storage whose calls can be made
+    # to hang or fail, to exercise GuardedResultStorage
+
+    def __init__(self):
+        self.alternatives = {}
+        self.results = []
+        self.timestamps = []
+        self.delay = 0
+        self.broken = False
+
+    def _wait(self):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.broken:
+            raise Exception('storage is broken')
+
+    def save_test(self, test_name, alternatives, steps, sampling=None):
+        pass
+
+    def record(self, identity, test_name, alternative, action, timestamp=None):
+        self._wait()
+        self.results.append((identity, test_name, alternative, action))
+        self.timestamps.append(timestamp)
+
+    def set_alternative(self, identity, test_name, alternative):
+        self._wait()
+        self.alternatives[(identity, test_name)] = alternative
+
+    def get_alternative(self, identity, test_name):
+        self._wait()
+        return self.alternatives.get((identity, test_name))
+
+class GuardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.randrange = RandRange()
+        dabble.random.randrange = self.randrange
+
+        self.backend = MemoryResultStorage()
+        self.storage = GuardedResultStorage(
+            self.backend, budget=0.05, threshold=2, reset_timeout=0.2)
+        self.provider = MockIdentityProvider()
+        configure(self.provider, self.storage)
+
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar', 'baz'], ['show', 'fill'])
+        self.t = T()
+
+    tearDown = generic_tearDown
+
+    def test_passthrough(self):
+        self.provider.identity = 1
+        self.t.abtest.record('show')
+
+        identity = self.t.abtest.identity
+        self.assertEqual({(identity, 'foobar'): 0}, self.backend.alternatives)
+        self.assertEqual([(identity, 'foobar', 0, 'show')], self.backend.results)
+        self.assertTrue(isinstance(self.backend.timestamps[0], datetime))
+
+    def test_slow_read_falls_back(self):
+        self.provider.identity = 1
+        self.backend.delay = 0.5
+
+        start = time.time()
+        alternative = self.t.abtest.alternative
+        self.assertTrue(time.time() - start < 0.25)
+
+        identity = self.t.abtest.identity
+        self.assertEqual(bucket(identity, 3), alternative)
+        self.assertEqual(None, self.randrange.last)
+
+    def test_breaker_spills_and_replays(self):
+        self.backend.broken = True
+        for identity in (1, 2, 3):
+            self.provider.identity = identity
+            self.t.abtest.record('show')
+
+        # each record is spilled with the fallback alternative it was made under
+        self.assertFalse(self.storage.breaker.closed)
+        self.assertEqual(6, len(self.storage.spilled))
+        self.assertEqual([], self.backend.results)
+
+        self.backend.broken = False
+        self.assertEqual(6, self.storage.replay())
+        self.assertEqual(3, len(self.backend.results))
+        for identity, test_name, alternative, action in self.backend.results:
+            self.assertEqual(bucket(identity, 3), alternative)
+            self.assertEqual(alternative, self.backend.alternatives[(identity, test_name)])
+
+    def test_replay_drops_mismatched_records(self):
+        self.provider.identity = 1
+        identity = self.t.abtest.identity
+        stored = (bucket(identity, 3) + 1) % 3
+        self.backend.alternatives[(identity, 'foobar')] = stored
+
+        self.backend.broken = True
+        self.t.abtest.record('show')
+        self.t.abtest.record('fill')
+        self.assertEqual(4, len(self.storage.spilled))
+
+        self.backend.broken = False
+        self.assertEqual(0, self.storage.replay())
+        self.assertEqual([], self.backend.results)
+        self.assertEqual(0, len(self.storage.spilled))
+
+    def test_late_write_keeps_fallback(self):
+        # a record made under the fallback alternative, which lands
+        # once storage recovers, does not leave the user unassigned
+        self.storage.breaker.threshold = 10
+        self.provider.identity = 1
+        identity = self.t.abtest.identity
+        self.backend.delay = 0.1
+        self.t.abtest.record('show')
+        time.sleep(0.3)
+
+        self.backend.delay = 0
+        self.assertEqual([(identity, 'foobar', bucket(identity, 3), 'show')],
+                         self.backend.results)
+        self.assertEqual(bucket(identity, 3), self.t.abtest.alternative)
+        self.assertEqual(None, self.randrange.last)
+
+    def test_failed_batch_spills_records(self):
+        now = utcnow()
+        records = [('a', 'foobar', 1, 'show', now), ('a', 'foobar', 1, 'fill', now)]
+
+        self.backend.broken = True
+        self.storage.record_many(records)
+        self.assertEqual([('record', r) for r in records], list(self.storage.spilled))
+
+        self.backend.broken = False
+        self.assertEqual(2, self.storage.replay())
+        self.assertEqual([r[:4] for r in records], self.backend.results)
+
+    def test_replays_after_success(self):
+        # a single failure spills the write, but leaves the breaker closed
+        self.backend.broken = True
+        self.storage.record('a', 'foobar', 1, 'show')
+        self.assertTrue(self.storage.breaker.closed)
+        self.assertEqual(1, len(self.storage.spilled))
+
+        self.backend.broken = False
+        self.storage.record('b', 'foobar', 1, 'show')
+        for i in range(100):
+            if not self.storage.spilled:
+                break
+            time.sleep(0.01)
+        self.assertEqual(0, len(self.storage.spilled))
+        self.assertEqual(set([('a', 'foobar', 1, 'show'), ('b', 'foobar', 1, 'show')]),
+                         set(self.backend.results))
+
+    def test_breaker_recloses(self):
+        self.backend.broken = True
+        self.provider.identity = 1
+        self.t.abtest.record('show')
+        self.t.abtest.record('show')
+        self.assertFalse(self.storage.breaker.closed)
+
+        self.backend.broken = False
+        time.sleep(0.25)
+        self.t.abtest.record('fill')
+        self.assertTrue(self.storage.breaker.closed)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from dabble.compat import hexlify
+from dabble.hashers import *
+from dabble.util import bucket, fraction
+
+class HasherTest(unittest.TestCase):
+
+    def test_sha1_matches_earlier_identities(self):
+        # on every interpreter
+        for identity, digest in ((1, '356a192b7913b04c54574d18c28d46e6395428ab'),
+                                 ('abc', 'a9993e364706816aba3e25717850c26c9cd0d89d'),
+                                 (u'abc', 'a9993e364706816aba3e25717850c26c9cd0d89d'),
+                                 (u'caf\xe9', 'f424452a9673918c6f09b0cdd35b20be8e6ae7d7')):
+            self.assertEqual(digest, hexlify(SHA1Hasher().hash(identity)))
+
+    def test_blake2b(self):
+        try:
+            hasher = Blake2bHasher()
+        except Exception:
+            return self.skipTest('BLAKE2b is not available')
+
+        self.assertEqual(16, len(hasher.hash(1)))
+        self.assertEqual(hasher.hash(1), Blake2bHasher().hash(1))
+        self.assertNotEqual(hasher.hash(1), hasher.hash(2))
+
+    def test_keyed(self):
+        try:
+            hasher = KeyedHasher('secret')
+        except Exception:
+            return self.skipTest('BLAKE2b is not available')
+
+        self.assertEqual(8, len(hasher.hash(1)))
+        self.assertNotEqual(hasher.hash(1), KeyedHasher('other').hash(1))
+
+    def test_bucket(self):
+        hasher = SHA1Hasher()
+        counts = [0, 0, 0]
+        for identity in range(3000):
+            counts[bucket(hasher.hash(identity), 3)] += 1
+        for count in counts:
+            self.assertTrue(900 < count < 1100, counts)
+
+    def test_fraction(self):
+        # sampling decisions do not change between interpreters
+        hasher = SHA1Hasher()
+        self.assertEqual(2, bucket(hasher.hash(1), 7))
+        self.assertAlmostEqual(0.7372778709977865, fraction(hasher.hash(1), 'foo'))
+        self.assertAlmostEqual(0.7372778709977865, fraction(hasher.hash(1), u'foo'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+import random
+
+import dabble
+from dabble.backends.fs import FSResultStorage
+from dabble.loadgen import *
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+
+class PopulationTest(unittest.TestCase):
+
+    def test_visitors(self):
+        population = Population(users=100, returning=0.75, skew=1.2)
+        rand = random.Random(1)
+        visitors = [population.visitor(rand) for i in range(4000)]
+
+        new = [v for v in visitors if v.startswith('new-')]
+        self.assertTrue(900 < len(new) < 1100)
+        self.assertEqual(len(new), len(set(new)))
+
+        counts = dict((v, visitors.count(v)) for v in set(visitors) - set(new))
+        self.assertEqual('user-0', max(counts, key=counts.get))
+        self.assertTrue(counts['user-0'] > 3 * counts.get('user-9', 0))
+
+    def test_percentiles(self):
+        stats = percentiles(range(1, 101))
+        self.assertEqual(51, stats['p50'])
+        self.assertEqual(100, stats['p99'])
+        self.assertEqual(100, stats['max'])
+        self.assertEqual(100, stats['count'])
+        self.assertEqual({'count': 0}, percentiles([]))
+
+class LoadGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_dir = make_storage_dir()
+
+        self.funnels = [Funnel('load', ['a', 'b'], ['show', 'click', 'buy'], [0.5, 0.5])]
+
+    def tearDown(self):
+        dabble.AB._id_provider = None
+        dabble.AB._storage = None
+        dabble.AB._tests = {}
+        dabble.AB._AB__n_per_test = {}
+        remove_storage_dir(self.storage_dir)
+
+    def storage(self):
+        return FSResultStorage(self.storage_dir)
+
+    def check(self, result, requests):
+        self.assertEqual(requests, result['requests'])
+        self.assertEqual(requests, result['latency']['count'])
+        self.assertTrue(result['throughput'] > 0)
+        self.assertTrue(result['lock_wait']['file']['count'] >= requests)
+
+        report = self.storage().report('load')
+        shown = sum(r['funnel'][0]['attempted'] for r in report['results'])
+        clicked = sum(r['funnel'][0]['converted'] for r in report['results'])
+        self.assertTrue(0 < shown <= requests)
+        self.assertTrue(0 < clicked < shown)
+
+    def test_threads(self):
+        generator = LoadGenerator(self.storage, self.funnels, Population(50),
+                                  threads=3, requests=200, seed=1)
+        self.check(generator.run(), 200)
+
+    def test_processes(self):
+        generator = LoadGenerator(self.storage, self.funnels, Population(50),
+                                  threads=2, processes=2, requests=101)
+        self.check(generator.run(), 101)
+
+if __name__ == '__main__':
+    unittest.main()
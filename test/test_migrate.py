@@ -0,0 +1,108 @@
+import unittest
+
+from dabble import *
+from dabble.backends.fs import FSResultStorage
+from dabble.migrate import *
+
+from datetime import datetime, timedelta
+from os.path import join
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirs = [make_storage_dir('storage'), make_storage_dir('storage-target')]
+        self.checkpoint = join(self.dirs[1], 'checkpoint.json')
+
+        self.source = FSResultStorage(self.dirs[0])
+        self.source.save_test('foobar', ['foo', 'bar'], ['show', 'fill', 'buy'])
+        self.source.save_test('sampled', ['foo', 'bar'], ['show', 'fill'], [0.5, 0.5])
+
+        start = datetime(2012, 3, 1, 12)
+        minute = timedelta(minutes=1)
+        records = []
+        for n in range(50):
+            identity = b'user%02d' % n
+            for test_name in ('foobar', 'sampled'):
+                self.source.set_alternative(identity, test_name, n % 2)
+                actions = ['show', 'show', 'fill', 'buy'][:n % 5]
+                if test_name == 'sampled':
+                    actions = actions[:3]
+                for i, action in enumerate(actions):
+                    records.append((identity, test_name, n % 2, action, start + (n + i) * minute))
+        # an out of order action, which report() ignores
+        records.append((b'user00', 'foobar', 0, 'fill', start))
+        self.source.record_many(records)
+
+    def tearDown(self):
+        for storage_dir in self.dirs:
+            remove_storage_dir(storage_dir)
+
+    def target(self):
+        return FSResultStorage(self.dirs[1])
+
+    def test_migrate(self):
+        calls = []
+        def progress(test_name, kind, count):
+            calls.append((test_name, kind, count))
+
+        target = self.target()
+        counts = migrate(self.source, target, batch_size=16, workers=2,
+                         checkpoint=self.checkpoint, progress=progress)
+
+        self.assertEqual({'foobar': {'alternatives': 50, 'results': 70},
+                          'sampled': {'alternatives': 50, 'results': 60}}, counts)
+        self.assertEqual(self.source.load_tests(), target.load_tests())
+        self.assertEqual(self.source.report_all(), target.report_all())
+        self.assertEqual(1, target.get_alternative(b'user01', 'foobar'))
+
+        self.assertEqual([16, 32, 48, 50],
+                         [c for t, k, c in calls if (t, k) == ('foobar', 'alternatives')])
+
+    def test_resume(self):
+        class Interrupted(Exception):
+            pass
+
+        def progress(test_name, kind, count):
+            if kind == 'results' and count >= 32:
+                raise Interrupted()
+
+        target = self.target()
+        self.assertRaises(Interrupted, migrate, self.source, target, batch_size=16,
+                          workers=1, checkpoint=self.checkpoint, progress=progress)
+        self.assertNotEqual(self.source.report_all(), target.report_all())
+
+        counts = migrate(self.source, target, batch_size=16, checkpoint=self.checkpoint)
+        self.assertEqual(70, counts['foobar']['results'])
+        self.assertEqual(self.source.report_all(), target.report_all())
+
+        # nothing is copied twice
+        self.assertEqual(70, len(list(target.export_results('foobar'))))
+        self.assertEqual(70, len(list(target._results(t='foobar'))))
+
+    def test_resume_changed(self):
+        class Interrupted(Exception):
+            pass
+
+        def progress(test_name, kind, count):
+            if kind == 'results' and count >= 32:
+                raise Interrupted()
+
+        target = self.target()
+        self.assertRaises(Interrupted, migrate, self.source, target, batch_size=16,
+                          workers=1, checkpoint=self.checkpoint, progress=progress)
+
+        # a result recorded meanwhile, ahead of those copied so far
+        self.source.record(b'late', 'foobar', 0, 'show', datetime(2012, 2, 1))
+
+        # the copy resumes after the last result copied, so none
+        # is copied twice, or skipped
+        migrate(self.source, target, batch_size=16, checkpoint=self.checkpoint)
+        self.assertEqual(70, len(list(target._results(t='foobar'))))
+        self.assertEqual(sorted(exported for exported in self.source.export_results('foobar')
+                                if exported[0] != b'late'),
+                         sorted(target.export_results('foobar')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+import dabble
+from dabble import *
+
+from test.test_backend import fs_setUp, fs_tearDown
+
+# built by the Lazy import path below
+built = []
+class Expensive(object):
+    def __init__(self):
+        built.append(self)
+
+class ParameterTest(unittest.TestCase):
+
+    def setUp(self):
+        fs_setUp(self)
+        del built[:]
+
+    def tearDown(self):
+        fs_tearDown(self)
+
+    def show(self, identity, alternative):
+        # the value shown to an identity assigned the alternative
+        self.provider.identity = identity
+        self.storage.set_alternative(dabble.AB._hasher.hash(identity), 'foobar', alternative)
+
+    def test_lazy(self):
+        calls = []
+        def build(value):
+            def func():
+                calls.append(value)
+                return value
+            return func
+
+        class T(object):
+            param = ABParameter('foobar', [Lazy(build('one')), Lazy(build('two'))])
+
+        self.assertEqual([], calls)
+        self.show('1', 1)
+        self.assertEqual('two', T.param)
+        self.assertEqual('two', T().param)
+        self.show('2', 1)
+        self.assertEqual('two', T.param)
+        self.assertEqual(['two'], calls)
+
+        self.show('3', 0)
+        self.assertEqual('one', T.param)
+        self.assertEqual(['two', 'one'], calls)
+
+    def test_import_path(self):
+        class T(object):
+            param = ABParameter('foobar', [Lazy('test.test_parameter:Expensive'),
+                                           Lazy('test.test_parameter.built')])
+
+        self.show('1', 0)
+        self.assertTrue(T.param is Expensive)
+        self.show('2', 1)
+        self.assertTrue(T.param is built)
+
+        class U(object):
+            param = ABParameter('foobar', [Lazy('test.test_parameter:Missing'), 'two'])
+        self.show('1', 0)
+        self.assertRaises(AttributeError, getattr, U, 'param')
+
+    def test_factory(self):
+        class T(object):
+            param = ABParameter('foobar', [Factory(Expensive), 'plain'])
+
+        self.show('1', 1)
+        self.assertEqual('plain', T.param)
+        self.assertEqual([], built)
+
+        self.show('2', 0)
+        first, second = T.param, T.param
+        self.assertTrue(isinstance(first, Expensive))
+        self.assertFalse(first is second)
+        self.assertEqual([first, second], built)
@@ -0,0 +1,152 @@
+import unittest
+
+from dabble.backends.fs import FSResultStorage
+from dabble.rollup import *
+from dabble.util import epoch
+
+from datetime import datetime, timedelta
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tests = {'foobar': {'alternatives': ['foo', 'bar'], 'steps': ['show', 'buy'],
+                                 'sampling': None}}
+        self.start = datetime(2012, 3, 1, 12)
+        self.minute = timedelta(minutes=1)
+
+    def add(self, rollup, identity, alternative, action, minutes):
+        rollup.add(identity, 'foobar', alternative, action,
+                   epoch(self.start + minutes * self.minute))
+
+    def test_funnel(self):
+        rollup = Rollup(lambda: self.tests)
+        self.add(rollup, '1', 0, 'show', 0)
+        self.add(rollup, '1', 0, 'show', 1)
+        self.add(rollup, '1', 0, 'buy', 2)
+        self.add(rollup, '1', 0, 'buy', 3)
+        # bought before being shown
+        self.add(rollup, '2', 1, 'buy', 0)
+        self.add(rollup, '2', 1, 'show', 1)
+        # shown, then read out of order
+        self.add(rollup, '3', 1, 'buy', 3)
+        self.add(rollup, '3', 1, 'show', 2)
+        self.add(rollup, '4', 1, 'other', 2)
+
+        series = rollup.timeseries('foobar', self.start, self.start + 4 * self.minute)
+        self.assertEqual('minute', series['resolution'])
+        self.assertEqual([self.start + n * self.minute for n in range(4)], series['times'])
+        foo, bar = series['results']
+        self.assertEqual('foo', foo['alternative'])
+        self.assertEqual({'show': [1, 0, 0, 0], 'buy': [0, 0, 1, 0]}, foo['steps'])
+        self.assertEqual({'show': [0, 1, 1, 0], 'buy': [0, 0, 0, 1]}, bar['steps'])
+
+        series = rollup.timeseries('foobar', self.start, self.start + self.minute, 'hour')
+        self.assertEqual([datetime(2012, 3, 1, 12)], series['times'])
+        self.assertEqual({'show': [2], 'buy': [1]}, series['results'][1]['steps'])
+
+        self.assertRaises(Exception, rollup.timeseries, 'other', self.start, self.start)
+        self.assertRaises(Exception, rollup.timeseries, 'foobar', self.start, self.start,
+                          'week')
+
+    def test_retention(self):
+        rollup = Rollup(lambda: self.tests, {'minute': 600, 'hour': 3600 * 3})
+        for n in range(6 * 60):
+            self.add(rollup, str(n), 0, 'show', n)
+
+        end = self.start + 6 * 60 * self.minute
+        minutes = rollup.timeseries('foobar', self.start, end)['results'][0]['steps']['show']
+        self.assertEqual([0] * (6 * 60 - 11) + [1] * 11, minutes)
+        hours = rollup.timeseries('foobar', self.start, end, 'hour')['results'][0]['steps']['show']
+        self.assertEqual([0, 0, 60, 60, 60, 60], hours)
+        days = rollup.timeseries('foobar', self.start, end, 'day')['results'][0]['steps']['show']
+        self.assertEqual([360], days)
+
+    def test_forget(self):
+        rollup = Rollup(lambda: self.tests, {'minute': 600, 'hour': 3600})
+        self.add(rollup, 'gone', 0, 'show', 0)
+        self.add(rollup, 'kept', 0, 'show', 0)
+        for n in range(1, 120):
+            self.add(rollup, str(n), 0, 'show', n)
+            if n % 30 == 0:
+                self.add(rollup, 'kept', 0, 'show', n)
+
+        # identities idle for longer than the retention are forgotten
+        self.assertEqual(set([str(n) for n in range(58, 120)] + ['kept']),
+                         set(identity for test_name, identity in rollup.reached))
+        self.assertEqual(len(rollup.reached), len(rollup.idle))
+
+        # ... and their actions counted again, unlike those of the rest
+        self.add(rollup, 'gone', 0, 'show', 120)
+        self.add(rollup, 'kept', 0, 'show', 120)
+        end = self.start + 121 * self.minute
+        hours = rollup.timeseries('foobar', self.start, end, 'hour')['results'][0]['steps']['show']
+        self.assertEqual([0, 60, 1], hours)
+
+    def test_unknown_test(self):
+        loads = []
+        def tests():
+            loads.append(1)
+            return self.tests
+        rollup = Rollup(tests)
+        for n in range(5):
+            rollup.add(str(n), 'other', 0, 'show', epoch(self.start))
+        self.assertEqual(1, len(loads))
+
+        # a test not seen before still reads the tests again
+        self.tests = dict(self.tests, other=self.tests['foobar'])
+        rollup.add('1', 'foobar', 0, 'show', epoch(self.start))
+        rollup.add('1', 'other', 0, 'show', epoch(self.start))
+        self.assertEqual(1, len(loads))
+        rollup.add('1', 'new', 0, 'show', epoch(self.start))
+        rollup.add('1', 'other', 0, 'show', epoch(self.start))
+        self.assertEqual(2, len(loads))
+        series = rollup.timeseries('other', self.start, self.start + self.minute)
+        self.assertEqual([1], series['results'][0]['steps']['show'])
+
+class StorageRollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_dir = make_storage_dir()
+        self.start = datetime(2012, 3, 1, 23, 58)
+        self.minute = timedelta(minutes=1)
+
+    def tearDown(self):
+        remove_storage_dir(self.storage_dir)
+
+    def record(self, storage, first, last):
+        for n in range(first, last):
+            timestamp = self.start + (n % 5) * self.minute
+            storage.record(b'%d' % n, 'foobar', n % 2, 'show', timestamp)
+            if n % 3 == 0:
+                storage.record(b'%d' % n, 'foobar', n % 2, 'buy', timestamp + self.minute)
+
+    def check(self, storage, reader):
+        series = reader.timeseries('foobar', self.start, self.start + 10 * self.minute)
+        report = storage.report('foobar')
+        for alt, result in zip(series['results'], report['results']):
+            self.assertEqual(result['funnel'][0]['attempted'], sum(alt['steps']['show']))
+            self.assertEqual(result['funnel'][0]['converted'], sum(alt['steps']['buy']))
+        return series
+
+    def test_fs(self):
+        # the rollup is kept up to date with the results other
+        # storages (as if other processes) write
+        storage = FSResultStorage(self.storage_dir)
+        storage.save_test('foobar', ['foo', 'bar'], ['show', 'buy'])
+        for segmented in (False, True):
+            reader = FSResultStorage(self.storage_dir)
+            self.record(FSResultStorage(self.storage_dir, segmented=segmented), 0, 20)
+            self.check(storage, reader)
+            self.record(FSResultStorage(self.storage_dir, segmented=segmented), 20, 50)
+            series = self.check(storage, reader)
+            self.assertEqual([5, 5, 5, 5, 5, 0, 0, 0, 0, 0], series['results'][0]['steps']['show'])
+
+    def test_proxy(self):
+        storage = RollupResultStorage(FSResultStorage(self.storage_dir))
+        storage.save_test('foobar', ['foo', 'bar'], ['show', 'buy'])
+        self.record(storage, 0, 50)
+        storage.record_many([(b'50', 'foobar', 0, 'show', self.start)])
+        series = self.check(storage, storage)
+        self.assertEqual([6, 5, 5, 5, 5, 0, 0, 0, 0, 0], series['results'][0]['steps']['show'])
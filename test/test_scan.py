@@ -0,0 +1,176 @@
+import unittest
+
+from dabble.backends import fs
+from dabble.backends.fs import AlternativeIndex, FSResultStorage, FirstStepIndex, \
+    encode_line, find_lines
+
+from datetime import datetime, timedelta
+from os import utime
+from os.path import basename, dirname, join
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class ScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage_dir = make_storage_dir()
+        self.path = join(self.storage_dir, 'lines.dabble')
+        self.scan_size = fs.scan_size
+
+    def tearDown(self):
+        fs.scan_size = self.scan_size
+        remove_storage_dir(self.storage_dir)
+
+    def write(self, lines, tail=''):
+        with open(self.path, 'w') as fp:
+            for line in lines:
+                fp.write(encode_line(line))
+            fp.write(tail)
+
+    def test_block_boundaries(self):
+        self.write([{'i': 'user%d' % n, 't': 'foobar', 'n': n % 2} for n in range(100)])
+
+        # blocks far smaller than a line, and not a multiple of its length
+        for scan_size in (1, 7, 64, 1 << 20):
+            fs.scan_size = scan_size
+            found = list(find_lines(self.path, t='foobar', n=1))
+            self.assertEqual(['user%d' % n for n in range(1, 100, 2)],
+                             [line['i'] for line in found])
+            self.assertEqual([{'i': 'user42', 't': 'foobar', 'n': 0}],
+                             list(find_lines(self.path, i='user42')))
+
+    def test_values_elsewhere(self):
+        # lines containing the values, but not under the keys
+        # being matched, are rejected once they are parsed
+        self.write([
+            {'i': 'foobar', 't': 'user1', 'n': 0},
+            {'i': 'user1', 't': 'foobar', 'n': 0},
+            {'i': 'user1', 't': 'foobar2', 'n': 0},
+        ])
+        self.assertEqual([{'i': 'user1', 't': 'foobar', 'n': 0}],
+                         list(find_lines(self.path, i='user1', t='foobar')))
+
+    def test_escaped_values(self):
+        name = u'caf\xe9 "quoted"'
+        self.write([{'t': 'other', 'a': [name]}, {'t': name, 'a': ['foo']}])
+        self.assertEqual([{'t': name, 'a': ['foo']}],
+                         list(find_lines(self.path, t=name)))
+
+    def test_unterminated_line(self):
+        self.write([{'t': 'foo'}], tail='{"t":"bar"}')
+        self.assertEqual([{'t': 'bar'}], list(find_lines(self.path, t='bar')))
+
+        self.write([{'t': 'foo'}], tail='{"t":"bar"')
+        self.assertEqual([], list(find_lines(self.path, t='bar')))
+
+    def test_report(self):
+        storage = FSResultStorage(self.storage_dir)
+        storage.save_test('foo', ['a', 'b'], ['show', 'buy'])
+        storage.save_test('foobar', ['a', 'b'], ['show', 'buy'])
+        for n in range(10):
+            for test_name in ('foo', 'foobar'):
+                storage.record(b'user%d' % n, test_name, n % 2, 'show')
+            storage.record(b'user%d' % n, 'foo', n % 2, 'buy')
+
+        fs.scan_size = 50
+        self.assertEqual([5, 5], [r['funnel'][0]['converted']
+                                  for r in storage.report('foo')['results']])
+        self.assertEqual([0, 0], [r['funnel'][0]['converted']
+                                  for r in storage.report('foobar')['results']])
+        self.assertEqual(storage.report('foo'), storage.report_many(['foo', 'foobar'])['foo'])
+
+    def test_window(self):
+        storage = FSResultStorage(self.storage_dir)
+        storage.save_test('foobar', ['a', 'b'], ['show', 'buy'])
+        start = datetime(2012, 3, 1)
+        for day in range(30):
+            # each user is shown the test on five days in a row,
+            # and some buy on the first
+            for n in range(day, day + 5):
+                when = start + timedelta(days=day, hours=n % 24)
+                storage.record(b'user%d' % n, 'foobar', n % 2, 'show', when)
+                if n % 3 == 0:
+                    storage.record(b'user%d' % n, 'foobar', n % 2, 'buy', when)
+
+        opened = []
+        def find_lines(filename, **pattern):
+            if dirname(filename) == storage.results_dir:
+                opened.append(basename(filename))
+            return find(filename, **pattern)
+        find, fs.find_lines = fs.find_lines, find_lines
+        try:
+            window = (start + timedelta(days=20), start + timedelta(days=21))
+            report = storage.report('foobar', *window)
+            self.assertEqual(['2012-03-21.dabble'], opened)
+
+            # the same as reading every result from before the window
+            storage.first_steps = FirstStepIndex(join(self.storage_dir, 'none.sqlite'),
+                                                 read_only=True)
+            self.assertEqual(storage.report('foobar', *window), report)
+            self.assertEqual(22, len(opened))
+        finally:
+            fs.find_lines = find
+
+        # of the users shown the test on the day, all but user24
+        # were first shown it before
+        self.assertEqual([1, 0], [r['funnel'][0]['attempted'] for r in report['results']])
+
+    def test_export_same_instant(self):
+        storage = FSResultStorage(self.storage_dir)
+        storage.save_test('foobar', ['a', 'b'], ['show', 'buy'])
+        when = datetime(2012, 3, 1)
+        # steps recorded at once count in the order of the test's
+        # steps, and a step recorded twice at once counts once
+        storage.record_many([(b'user1', 'foobar', 0, 'buy', when),
+                             (b'user1', 'foobar', 0, 'show', when),
+                             (b'user2', 'foobar', 1, 'show', when),
+                             (b'user2', 'foobar', 0, 'show', when)])
+        self.assertEqual([(b'user1', 0, 'show', when), (b'user2', 1, 'show', when),
+                          (b'user1', 0, 'buy', when)],
+                         list(storage.export_results('foobar')))
+        self.assertEqual([(1, 1), (1, 0)],
+                         [(r['funnel'][0]['attempted'], r['funnel'][0]['converted'])
+                          for r in storage.report('foobar')['results']])
+
+    def test_tail_index(self):
+        index = AlternativeIndex(lambda: [self.path])
+        self.write([{'i': 'user%d' % n, 't': 'foobar', 'n': 0} for n in range(10)],
+                   tail='{"i":"user10","t":"foobar",')
+        fs.scan_size = 7
+        index.refresh()
+        self.assertEqual(10, len(index.alternatives))
+        self.assertEqual(0, index.alternatives[('user9', 'foobar')])
+
+        # the line still being written is read once it is finished
+        with open(self.path, 'a') as fp:
+            fp.write('"n":1}\n')
+        index.refresh()
+        self.assertEqual(1, index.alternatives[('user10', 'foobar')])
+
+    def test_live_files(self):
+        live = join(self.storage_dir, 'live.dabble')
+        listed = []
+        def filenames():
+            listed.append(1)
+            return [self.path, live]
+        index = AlternativeIndex(filenames, (self.storage_dir, ), lambda path: path == live)
+        self.write([{'i': 'user1', 't': 'foobar', 'n': 0}])
+        with open(live, 'w') as fp:
+            fp.write(encode_line({'i': 'user2', 't': 'foobar', 'n': 0}))
+        utime(self.storage_dir, (0, 0))
+        index.refresh()
+        index.refresh()
+        self.assertEqual(1, len(listed))
+
+        # only the live file is checked until the directory changes,
+        # or it is time to check every file again
+        for path, identity in ((self.path, 'user3'), (live, 'user4')):
+            with open(path, 'a') as fp:
+                fp.write(encode_line({'i': identity, 't': 'foobar', 'n': 0}))
+        index.refresh()
+        self.assertFalse(('user3', 'foobar') in index.alternatives)
+        self.assertTrue(('user4', 'foobar') in index.alternatives)
+        index.recheck = 0
+        index.refresh()
+        self.assertTrue(('user3', 'foobar') in index.alternatives)
+        self.assertEqual(2, len(listed))
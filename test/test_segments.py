@@ -0,0 +1,136 @@
+import unittest
+
+from dabble.backends.fs import FSResultStorage, encode_line, process_id
+
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from os import listdir
+from os.path import exists, join
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class NoLock(object):
+
+    def __enter__(self):
+        raise Exception('segmented storage took the lock')
+
+    def __exit__(self, *exc_info):
+        pass
+
+class SegmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirs = [make_storage_dir('storage'), make_storage_dir('storage-target')]
+
+        self.start = datetime(2012, 3, 1, 23, 50)
+        self.minute = timedelta(minutes=1)
+
+    def tearDown(self):
+        for storage_dir in self.dirs:
+            remove_storage_dir(storage_dir)
+
+    def storage(self, n=0, **kwargs):
+        storage = FSResultStorage(self.dirs[n], **kwargs)
+        storage.save_test('foobar', ['foo', 'bar'], ['show', 'fill', 'buy'])
+        return storage
+
+    def records(self, worker):
+        # each user's steps are recorded by different processes,
+        # a minute apart, across midnight
+        records = []
+        for n in range(30):
+            for step, action in enumerate(['show', 'fill', 'buy']):
+                if (n + step) % 3 == worker:
+                    timestamp = self.start + (n + step) * self.minute
+                    records.append((b'user%02d' % n, 'foobar', n % 2, action, timestamp))
+        return records
+
+    def write(self, worker):
+        storage = FSResultStorage(self.dirs[0], segmented=True)
+        for record in self.records(worker):
+            storage.record(*record)
+        storage.set_alternative(b'user-%d' % worker, 'foobar', worker % 2)
+
+    def test_processes(self):
+        storage = self.storage(segmented=True)
+        workers = [Process(target=self.write, args=(worker, )) for worker in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # one file per process per day
+        names = listdir(storage.results_dir)
+        self.assertEqual(6, len(names))
+        self.assertEqual(6, len(storage.partitions()))
+        self.assertEqual(3, len(storage.alt_files()) - 1)
+
+        # the same results, written in order to a single file
+        unsegmented = self.storage(1)
+        records = sum([self.records(worker) for worker in range(3)], [])
+        unsegmented.record_many(sorted(records, key=lambda record: record[4]))
+
+        report = storage.report('foobar')
+        self.assertEqual(unsegmented.report('foobar'), report)
+        self.assertEqual([15, 15], [r['funnel'][1]['converted'] for r in report['results']])
+        self.assertEqual(list(unsegmented.export_results('foobar')),
+                         list(storage.export_results('foobar')))
+
+        for worker in range(3):
+            self.assertEqual(worker % 2, storage.get_alternative(b'user-%d' % worker, 'foobar'))
+        self.assertTrue(storage.has_action(b'user00', 'foobar', 0, 'buy'))
+
+    def test_no_lock(self):
+        storage = self.storage(segmented=True)
+        storage.lock = NoLock()
+        storage.record(b'a', 'foobar', 0, 'show')
+        storage.set_alternative(b'a', 'foobar', 0)
+        storage.record_many([(b'b', 'foobar', 1, 'show', None)])
+        self.assertTrue(exists(join(self.dirs[0], 'alts.%s.dabble' % process_id())))
+
+    def test_earliest_assignment(self):
+        storage = self.storage(segmented=True)
+        lines = [('alts.dabble', {'i': '01', 't': 'foobar', 'n': 1}),
+                 ('alts.a.dabble', {'i': '01', 't': 'foobar', 'n': 0, 'd': 5.0}),
+                 ('alts.b.dabble', {'i': '02', 't': 'foobar', 'n': 0, 'd': 10.0}),
+                 ('alts.a.dabble', {'i': '02', 't': 'foobar', 'n': 1, 'd': 20.0})]
+        for name, line in lines:
+            with open(join(self.dirs[0], name), 'a') as fp:
+                fp.write(encode_line(line))
+
+        # lines without timestamps were written before any with
+        self.assertEqual(1, storage.get_alternative(b'\x01', 'foobar'))
+        self.assertEqual(0, storage.get_alternative(b'\x02', 'foobar'))
+        self.assertEqual([(b'\x01', 1), (b'\x01', 0), (b'\x02', 0), (b'\x02', 1)],
+                         list(storage.export_alternatives('foobar')))
+        self.assertRaises(Exception, storage.set_alternative, b'\x02', 'foobar', 1)
+
+        # storages which do not segment find the same assignments
+        plain = self.storage()
+        self.assertEqual(1, plain.get_alternative(b'\x01', 'foobar'))
+        self.assertEqual(0, plain.get_alternative(b'\x02', 'foobar'))
+
+    def test_mixed(self):
+        # segmented and plain storages sharing a directory
+        # see, and respect, each other's assignments
+        segmented = self.storage(segmented=True)
+        plain = self.storage()
+
+        segmented.set_alternative(b'a', 'foobar', 1)
+        self.assertEqual(1, plain.get_alternative(b'a', 'foobar'))
+        self.assertRaises(Exception, plain.set_alternative, b'a', 'foobar', 0)
+
+        plain.set_alternative(b'b', 'foobar', 0)
+        self.assertEqual(0, segmented.get_alternative(b'b', 'foobar'))
+        self.assertRaises(Exception, segmented.set_alternative, b'b', 'foobar', 1)
+
+        segmented.record(b'a', 'foobar', 1, 'show')
+        plain.record(b'b', 'foobar', 0, 'show')
+        for storage in (segmented, plain):
+            self.assertTrue(storage.has_action(b'a', 'foobar', 1, 'show'))
+            self.assertTrue(storage.has_action(b'b', 'foobar', 0, 'show'))
+            self.assertEqual([1, 1], [alt['funnel'][0]['attempted']
+                                      for alt in storage.report('foobar')['results']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+
+from dabble.backends.fs import FSResultStorage
+from dabble.sharded import *
+
+from datetime import datetime, timedelta
+from hashlib import sha1
+from random import Random
+
+from test.test_backend import make_storage_dir, remove_storage_dir
+
+class ShardedTest(unittest.TestCase):
+
+    def setUp(self):
+        # each directory stands in for a separate node; the
+        # last holds every record, for comparison
+        self.dirs = [make_storage_dir('storage-%d' % n) for n in range(5)]
+
+        self.nodes = dict(('node%d' % n, FSResultStorage(self.dirs[n])) for n in range(4))
+        self.single = FSResultStorage(self.dirs[-1])
+
+        self.start = datetime(2012, 3, 1, 23)
+        random = Random(1)
+        self.records = []
+        for n in range(300):
+            identity = sha1(('user%d' % n).encode('ascii')).digest()
+            when = self.start + timedelta(minutes=random.randrange(120))
+            for action in ['show', 'show', 'fill', 'buy'][:random.randrange(5)]:
+                when += timedelta(minutes=random.randrange(1, 30))
+                self.records.append((identity, 'foobar', n % 2, action, when))
+
+    def tearDown(self):
+        for storage_dir in self.dirs:
+            remove_storage_dir(storage_dir)
+
+    def populate(self, storage):
+        storage.save_test('foobar', ['foo', 'bar'], ['show', 'fill', 'buy'])
+        storage.set_alternatives(set(record[:3] for record in self.records))
+        storage.record_many(self.records)
+
+    def test_ring(self):
+        ring = HashRing(['a', 'b', 'c'])
+        identities = [sha1(('user%d' % n).encode('ascii')).digest() for n in range(3000)]
+        placed = [ring.lookup(identity) for identity in identities]
+        for name in ('a', 'b', 'c'):
+            self.assertTrue(700 < placed.count(name) < 1300)
+
+        # a new shard only takes identities from the others
+        grown = HashRing(['a', 'b', 'c', 'd'])
+        for identity, name in zip(identities, placed):
+            self.assertTrue(grown.lookup(identity) in (name, 'd'))
+
+        self.assertRaises(Exception, HashRing, [])
+
+    def test_report(self):
+        shards = dict((name, self.nodes[name]) for name in ('node0', 'node1', 'node2'))
+        storage = ShardedResultStorage(shards)
+        self.populate(storage)
+        self.populate(self.single)
+
+        # every shard holds some of the identities
+        for shard in shards.values():
+            self.assertTrue(0 < len(list(shard.export_alternatives('foobar'))) < 300)
+
+        # exports resume after any tuple, across shards
+        results = list(storage.export_results('foobar'))
+        for n in (0, 100, len(results) - 1):
+            self.assertEqual(results[n + 1:],
+                             list(storage.export_results('foobar', results[n])))
+
+        self.assertEqual(self.single.report('foobar'), storage.report('foobar'))
+        window = (self.start + timedelta(minutes=30), self.start + timedelta(minutes=90))
+        self.assertEqual(self.single.report('foobar', *window),
+                         storage.report('foobar', *window))
+
+        report = storage.report('foobar', quantiles=(0.5, 0.9))
+        expected = self.single.report('foobar', quantiles=(0.5, 0.9))
+        for result, alternative in zip(report['results'], expected['results']):
+            for stage, other in zip(result['funnel'], alternative['funnel']):
+                self.assertEqual(other['converted'], stage['converted'])
+                for q, value in other['time_to_convert']['quantiles'].items():
+                    self.assertAlmostEqual(value, stage['time_to_convert']['quantiles'][q],
+                                           delta=value * 0.1)
+
+    def test_routing(self):
+        storage = ShardedResultStorage(self.nodes)
+        self.populate(storage)
+
+        for identity, test_name, alternative, action, when in self.records[:50]:
+            self.assertEqual(alternative, storage.get_alternative(identity, test_name))
+            self.assertTrue(storage.has_action(identity, test_name, alternative, action))
+            self.assertEqual(alternative,
+                             self.nodes[storage.ring.lookup(identity)].get_alternative(
+                                 identity, test_name))
+
+    def test_reshard(self):
+        before = dict((name, self.nodes[name]) for name in ('node0', 'node1', 'node2'))
+        self.populate(ShardedResultStorage(before))
+        self.populate(self.single)
+
+        # adding a shard reassigns no identity; the new shard
+        # lacks the test until it is saved again
+        storage = ShardedResultStorage(self.nodes, previous=before)
+        self.assertEqual({}, storage.load_tests())
+        storage.save_test('foobar', ['foo', 'bar'], ['show', 'fill', 'buy'])
+        moved = [record for record in self.records
+                 if storage.ring.lookup(record[0]) != storage.previous.lookup(record[0])]
+        self.assertTrue(moved)
+        for identity, test_name, alternative, action, when in moved:
+            self.assertEqual(alternative, storage.get_alternative(identity, test_name))
+
+        # and their later actions are recorded alongside the earlier
+        later = self.start + timedelta(days=1)
+        extra = [(identity, 'foobar', alternative, 'buy', later)
+                 for identity, test_name, alternative, action, when in moved]
+        storage.record_many(extra)
+        self.single.record_many(extra)
+        self.assertEqual([], list(self.nodes['node3'].export_results('foobar')))
+        self.assertEqual(self.single.report('foobar'), storage.report('foobar'))
+
+        # new identities go where the current ring puts them
+        identity = sha1(b'newcomer').digest()
+        storage.set_alternative(identity, 'foobar', 1)
+        self.assertEqual(1, self.nodes[storage.ring.lookup(identity)].get_alternative(
+            identity, 'foobar'))
+
+    def test_fan_out(self):
+        storage = ShardedResultStorage(self.nodes)
+        storage.save_test('foobar', ['foo', 'bar'], ['show', 'buy'])
+        for shard in self.nodes.values():
+            self.assertEqual(['foobar'], shard.list_tests())
+            self.assertRaises(Exception, shard.save_test, 'foobar', ['foo'], ['show'])
+        self.assertRaises(Exception, storage.save_test, 'foobar', ['foo'], ['show'])
+
+        self.nodes['node1'].save_test('other', ['foo'], ['show'])
+        self.assertEqual(['foobar', 'other'], sorted(storage.list_tests()))
+        self.assertEqual(['foo', 'bar'], storage.load_tests()['foobar']['alternatives'])
@@ -0,0 +1,59 @@
+import unittest
+
+import json
+from bisect import bisect
+from math import sqrt
+from random import Random
+
+from dabble.sketch import *
+
+class TDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        random = Random(1)
+        self.values = [random.expovariate(1 / 30.0) for n in range(50000)]
+        self.ordered = sorted(self.values)
+
+    def assertClose(self, digest, q):
+        # the estimate's rank among the values is close to q,
+        # relatively more so towards the tails
+        rank = bisect(self.ordered, digest.quantile(q)) / float(len(self.ordered))
+        self.assertTrue(abs(rank - q) < 0.02 * sqrt(q * (1 - q)) + 0.0005, (q, rank))
+
+    def test_empty(self):
+        self.assertEqual(None, TDigest().quantile(0.5))
+
+    def test_small(self):
+        digest = TDigest()
+        for value in (3, 1, 2):
+            digest.add(value)
+        self.assertEqual(1, digest.quantile(0))
+        self.assertEqual(2, digest.quantile(0.5))
+        self.assertEqual(3, digest.quantile(1))
+
+    def test_quantiles(self):
+        digest = TDigest()
+        for value in self.values:
+            digest.add(value)
+
+        self.assertEqual(len(self.values), digest.count)
+        self.assertTrue(len(digest.to_dict()['centroids']) <= digest.compression)
+        self.assertEqual(self.ordered[0], digest.quantile(0))
+        self.assertEqual(self.ordered[-1], digest.quantile(1))
+        for q in (0.01, 0.1, 0.5, 0.9, 0.99, 0.999):
+            self.assertClose(digest, q)
+
+    def test_merge(self):
+        # digests of parts of the values (as shards would hold),
+        # round-tripped through JSON, merge to a digest of them all
+        parts = [TDigest() for n in range(4)]
+        for n, value in enumerate(self.values):
+            parts[n % 4].add(value)
+
+        digest = TDigest()
+        for part in parts:
+            digest.update(TDigest.from_dict(json.loads(json.dumps(part.to_dict()))))
+
+        self.assertEqual(len(self.values), digest.count)
+        for q in (0.01, 0.5, 0.99):
+            self.assertClose(digest, q)
@@ -0,0 +1,126 @@
+import unittest
+import logging
+
+import dabble
+from dabble import *
+from dabble.backends.fs import FSResultStorage
+from dabble.sharded import ShardedResultStorage
+from dabble.trace import *
+
+from os import listdir
+
+from test.test_backend import (MockIdentityProvider, RandRange, generic_tearDown,
+                               make_storage_dir, remove_storage_dir)
+
+class Records(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+class TraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.randrange = RandRange()
+        dabble.random.randrange = self.randrange
+
+        self.storage_dir = make_storage_dir()
+
+        self.spans = []
+        self.logger = logging.getLogger('dabble.test.trace')
+        self.logger.propagate = False
+        self.log = Records()
+        self.logger.addHandler(self.log)
+        self.logger.setLevel(logging.DEBUG)
+
+    def configure(self, **kwargs):
+        self.tracer = Tracer(self.spans.append, logger=self.logger, **kwargs)
+        self.storage = FSResultStorage(self.storage_dir)
+        self.provider = MockIdentityProvider()
+        configure(self.provider, self.storage, tracer=self.tracer)
+
+        class T(object):
+            abtest = ABTest('foobar', ['foo', 'bar'], ['show', 'fill'])
+        self.t = T()
+
+    def tearDown(self):
+        generic_tearDown(self)
+        dabble.AB._tracer = None
+        self.logger.removeHandler(self.log)
+        remove_storage_dir(self.storage_dir)
+
+    def test_spans(self):
+        self.configure()
+        self.provider.identity = 1
+        self.t.abtest.record('show')
+
+        root = self.spans[-1]
+        self.assertEqual('record', root.name)
+        self.assertEqual(None, root.parent)
+        self.assertEqual({'test': 'foobar'}, root.attributes)
+        self.assertEqual(['hash', 'alternative', 'record'],
+                         [child.name for child in root.children])
+
+        alternative = root.children[1]
+        self.assertEqual(['hash', 'get_alternative', 'set_alternative'],
+                         [child.name for child in alternative.children])
+
+        record = root.children[2]
+        self.assertEqual('FSResultStorage', record.attributes['backend'])
+        self.assertEqual(['lock wait'], [child.name for child in record.children])
+        lock_wait = record.children[0]
+        self.assertEqual('foobar', lock_wait.attributes['test'])
+        self.assertTrue(lock_wait.attributes['file'].endswith('.dabble'))
+
+        # every span reaches the sink, phases first
+        self.assertEqual(len(self.spans), len(set(self.spans)))
+        self.assertTrue(self.spans.index(lock_wait) < self.spans.index(record))
+
+        phases = dict(root.phases())
+        self.assertEqual(['alternative', 'hash', 'record', 'self'], sorted(phases))
+        self.assertAlmostEqual(root.duration, sum(phases.values()))
+
+    def test_slow_calls(self):
+        self.configure(slow=0)
+        self.provider.identity = 1
+        self.t.abtest.alternative
+
+        # the lock wait of saving the test is logged too
+        messages = [record.getMessage() for record in self.log.records]
+        self.assertEqual(2, len(messages))
+        self.assertTrue(messages[0].startswith('slow dabble call: lock wait '))
+        message = messages[1]
+        self.assertTrue(message.startswith('slow dabble call: alternative '))
+        self.assertTrue('test=foobar' in message)
+        self.assertTrue('get_alternative ' in message and 'set_alternative ' in message)
+
+    def test_profile(self):
+        self.configure(profile=1.0, profile_dir=self.storage_dir)
+        dabble.AB._storage.report('foobar')
+        self.assertEqual(1, len([n for n in listdir(self.storage_dir) if n.endswith('.prof')]))
+
+        self.tracer.profile_dir = None
+        dabble.AB._storage.report('foobar')
+        self.assertTrue('report_many' in self.log.records[-1].getMessage())
+
+    def test_untraced(self):
+        self.tracer = None
+        self.storage = FSResultStorage(self.storage_dir)
+        self.provider = MockIdentityProvider()
+        configure(self.provider, self.storage)
+        self.assertFalse(isinstance(dabble.AB._storage, TracingResultStorage))
+        self.assertEqual(None, self.storage.lock_wait_hook)
+
+    def test_lock_hook(self):
+        # the hook is installed on the storages wrapped, and no others
+        self.configure()
+        storage = FSResultStorage(self.storage_dir)
+        TracingResultStorage(ShardedResultStorage({'a': storage}), self.tracer)
+        self.assertEqual(self.tracer.lock_wait, storage.lock_wait_hook)
+        self.assertEqual(None, FSResultStorage(self.storage_dir).lock_wait_hook)
+
+if __name__ == '__main__':
+    unittest.main()